@@ -0,0 +1,82 @@
+"""
+Реестр активных банов в памяти процесса.
+"""
+import heapq
+import threading
+from datetime import datetime
+
+class BanRegistry:
+    """
+    Забаненные пользователи: словарь user_id -> время окончания бана
+    и min-куча сроков для быстрого поиска истёкших.
+
+    Проверка бана - поиск в словаре, без обращения к базе. Записи кучи
+    не удаляются при разбане/повторном бане: устаревшие пропускаются
+    при извлечении (сравнивается срок в словаре).
+    """
+    def __init__(self):
+        self._until = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._until)
+
+    @staticmethod
+    def _parse(value):
+        if isinstance(value, datetime):
+            return value
+        try:
+            return datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+
+    def load(self, bans):
+        """Заполнение из {user_id: banned_until} (Database.get_active_bans)"""
+        with self._lock:
+            self._until.clear()
+            self._heap.clear()
+            for user_id, banned_until in bans.items():
+                until = self._parse(banned_until)
+                if until:
+                    self._until[user_id] = until
+                    self._heap.append((until, user_id))
+            heapq.heapify(self._heap)
+
+    def ban(self, user_id, banned_until):
+        until = self._parse(banned_until)
+        if until is None:
+            return
+        with self._lock:
+            self._until[user_id] = until
+            heapq.heappush(self._heap, (until, user_id))
+
+    def unban(self, user_id):
+        with self._lock:
+            self._until.pop(user_id, None)
+
+    def sync(self, user):
+        """Обновление по записи пользователя из базы"""
+        if user.get('is_banned') and user.get('banned_until'):
+            self.ban(user['user_id'], user['banned_until'])
+        else:
+            self.unban(user['user_id'])
+
+    def banned_until(self, user_id, now=None):
+        """Время окончания бана или None, если пользователь не забанен"""
+        until = self._until.get(user_id)
+        if until is None or until <= (now or datetime.now()):
+            return None
+        return until
+
+    def pop_expired(self, now=None):
+        """Извлечение пользователей с истёкшим баном (удаляются из реестра)"""
+        now = now or datetime.now()
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                until, user_id = heapq.heappop(self._heap)
+                if self._until.get(user_id) == until:
+                    del self._until[user_id]
+                    expired.append(user_id)
+        return expired
@@ -0,0 +1,591 @@
+"""
+Бенчмарки Торфобота.
+
+Запуск: python bench.py [имя ...]
+Без аргументов выполняются все бенчмарки. Базы создаются во временном каталоге.
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from database import Database
+
+USERS = 100_000
+
+def fill_users(db_path, count=USERS):
+    """Заполнение базы пользователями одним пакетом"""
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO users (user_id, username, first_name, trf, kkl) VALUES (?, ?, ?, ?, ?)',
+            ((uid, f'user{uid}', f'Имя{uid}', random.randint(0, 5000), random.randint(0, 50))
+             for uid in range(1, count + 1))
+        )
+        conn.executemany('INSERT OR IGNORE INTO chats (chat_id) VALUES (?)',
+                         ((-cid,) for cid in range(1, 1001)))
+
+def run_ops(db, seconds=3.0):
+    """Смесь операций одной команды: чтение/запись пользователя, чат, лог добычи"""
+    ops = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        user_id = random.randint(1, USERS)
+        user = db.get_user(user_id)
+        db.update_user(user_id, trf=user['trf'] + 1)
+        db.get_chat(-random.randint(1, 1000))
+        db.log_mining(user_id, 'bench', 1)
+        ops += 4
+    return ops / seconds
+
+class ConnectPerCallDatabase(Database):
+    """Прежнее поведение: новое соединение на каждый вызов"""
+    def __init__(self, db_path):
+        # Схему создаёт обычный Database, дальше - только соединения на вызов
+        super().__init__(db_path)
+        self.close()
+    
+    def get_connection(self, write=True):
+        return sqlite3.connect(self.db_path)
+
+def bench_pool(tmp):
+    """Пул соединений против соединения на каждый вызов"""
+    legacy_path = os.path.join(tmp, 'legacy.db')
+    legacy = ConnectPerCallDatabase(legacy_path)
+    fill_users(legacy_path)
+
+    pooled_path = os.path.join(tmp, 'pooled.db')
+    pooled = Database(pooled_path)
+    fill_users(pooled_path)
+
+    before = run_ops(legacy)
+    after = run_ops(pooled)
+    pooled.close()
+    print(f'connect-per-call: {before:10.0f} ops/s')
+    print(f'pooled (WAL):     {after:10.0f} ops/s  (x{after / before:.1f})')
+
+def bench_passive(tmp):
+    """Пассивный доход: цикл по пользователям против пакетного UPDATE"""
+    from datetime import datetime, timedelta
+    
+    def age_users(path):
+        # Всем пользователям последний доход - 3 часа назад
+        stamp = (datetime.now() - timedelta(hours=3)).isoformat()
+        with sqlite3.connect(path) as conn:
+            conn.execute('UPDATE users SET last_passive_income = ?', (stamp,))
+    
+    path = os.path.join(tmp, 'passive.db')
+    db = Database(path)
+    fill_users(path)
+    
+    # Прежний алгоритм: разбор даты и два запроса на каждого пользователя
+    age_users(path)
+    started = time.perf_counter()
+    now = datetime.now()
+    for user_id, last in db.get_passive_income_users():
+        hours = int((now - datetime.fromisoformat(last)).total_seconds() // 3600)
+        if hours >= 1:
+            db.add_trf(user_id, 15 * hours)
+            db.update_user(user_id, last_passive_income=now.isoformat())
+    loop_time = time.perf_counter() - started
+    
+    age_users(path)
+    paid, bulk_time = db.pay_passive_income()
+    db.close()
+    print(f'per-user loop: {loop_time:8.2f} s')
+    print(f'bulk UPDATE:   {bulk_time:8.2f} s  ({paid} users paid)')
+
+def bench_plans(tmp):
+    """Планы горячих запросов (проверка всех запросов - tests/test_query_plans.py)"""
+    path = os.path.join(tmp, 'plans.db')
+    db = Database(path)
+    fill_users(path, 10_000)
+    for name, plan in db.explain_query_plans().items():
+        print(f'{name}: {" | ".join(plan)}')
+    db.close()
+
+def bench_leaderboard(tmp):
+    """Таблица лидеров в памяти против запросов к базе (ошибка при расхождении)"""
+    path = os.path.join(tmp, 'leaderboard.db')
+    Database(path).close()
+    fill_users(path)
+    
+    started = time.perf_counter()
+    db = Database(path)
+    print(f'построение:  {time.perf_counter() - started:8.2f} s ({len(db.leaderboard)} пользователей)')
+    
+    def timed(label, func, calls):
+        started = time.perf_counter()
+        for _ in range(calls):
+            func()
+        print(f'{label}{(time.perf_counter() - started) / calls * 1e6:10.0f} us')
+    
+    timed('топ-10 SQL:   ', lambda: db.get_top_users(10), 200)
+    timed('топ-10 память:', lambda: db.leaderboard.top(10), 200)
+    timed('место память: ', lambda: db.leaderboard.rank(random.randint(1, USERS)), 200)
+    
+    problems = db.verify_leaderboard(samples=20)
+    db.close()
+    
+    # Новые пользователи: у всех стартовые 100 TRF, доход начислен в разное время часа
+    from datetime import datetime, timedelta
+    from leaderboard import Leaderboard
+    now = datetime.now()
+    board = Leaderboard(15)
+    board.load((uid, None, None, 100, 5, (now - timedelta(seconds=random.uniform(0, 3600))).isoformat())
+               for uid in range(1, 2 * USERS + 1))
+    timed('топ-10, все по 100 TRF:', lambda: board.top(10), 200)
+    timed('место, все по 100 TRF: ', lambda: board.rank(random.randint(1, 2 * USERS)), 200)
+    if problems:
+        raise SystemExit('расхождения: ' + '; '.join(problems))
+
+def bench_outbound(tmp):
+    """Очередь отправки против фальшивого бота: лимиты, порядок, повторы"""
+    import asyncio
+    from telegram.error import RetryAfter, TimedOut
+    from outbound import Dispatcher
+    
+    class FakeBot:
+        """Записывает отправки; первая отправка в чаты 1..5 получает RetryAfter/TimedOut"""
+        def __init__(self):
+            self.sent = []
+            self.failures = {chat_id: RetryAfter(1) if chat_id % 2 else TimedOut()
+                             for chat_id in range(1, 6)}
+        
+        async def send_message(self, chat_id, text, **kwargs):
+            await asyncio.sleep(0.01)
+            error = self.failures.pop(chat_id, None)
+            if error:
+                raise error
+            self.sent.append((time.monotonic(), chat_id, text))
+            return text
+    
+    async def run():
+        bot = FakeBot()
+        dispatcher = Dispatcher(bot, global_rate=30, chat_rate=1, group_rate=20 / 60,
+                                burst=3, max_queued=200, retry_base=0.2).start()
+        started = time.monotonic()
+        futures = [await dispatcher.enqueue(chat_id, str(n))
+                   for n in range(5) for chat_id in list(range(1, 41)) + [-1, -2]]
+        await asyncio.gather(*futures)
+        elapsed = time.monotonic() - started
+        stats = dispatcher.stats()
+        await dispatcher.close()
+        return bot.sent, elapsed, stats
+    
+    async def run_at_limits():
+        # Лимиты из config: группа упирается в 20 сообщений в минуту, а
+        # обработчики её команд не должны ждать отправки и держать места
+        import outbound
+        bot = FakeBot()
+        bot.failures.clear()
+        outbound.start(bot)
+        try:
+            started = time.perf_counter()
+            for n in range(30):
+                await outbound.send(-1, f'группа {n}')
+            handler_time = (time.perf_counter() - started) / 30
+            started = time.perf_counter()
+            await (await outbound.send(100, 'личный чат'))
+            other_chat = time.perf_counter() - started
+        finally:
+            await outbound.stop(timeout=0)
+        return handler_time, other_chat
+    
+    handler_time, other_chat = asyncio.run(run_at_limits())
+    print(f'лимиты config, 30 ответов в группу: отправка в обработчике {handler_time * 1e6:.0f} us, '
+          f'сообщение другому чату дошло за {other_chat * 1000:.0f} ms')
+    
+    sent, elapsed, stats = asyncio.run(run())
+    times = [moment for moment, _, _ in sent]
+    peak = max(sum(1 for other in times if moment <= other < moment + 1) for moment in times)
+    print(f'{len(sent)} сообщений за {elapsed:.1f} s, пик {peak}/s, статистика: {stats}')
+    
+    problems = []
+    if handler_time > 0.01 or other_chat > 1.0:
+        problems.append('обработчики ждут отправки в группу с лимитом')
+    if peak > 30 + 3:
+        problems.append(f'превышен общий лимит: {peak}/s')
+    for chat_id in {chat_id for _, chat_id, _ in sent}:
+        texts = [text for _, chat, text in sent if chat == chat_id]
+        if texts != sorted(texts) or len(texts) != 5:
+            problems.append(f'чат {chat_id}: {texts}')
+    if problems:
+        raise SystemExit('; '.join(problems))
+
+def offline_bot():
+    """Бот приложения без обращения к Telegram при инициализации"""
+    from telegram import User
+    from telegram.ext import ExtBot
+    
+    class OfflineBot(ExtBot):
+        async def get_me(self, *args, **kwargs):
+            self._bot_user = User(1, 'Торфобот', True, username='torfobot')
+            return self._bot_user
+    
+    return OfflineBot('1:bench')
+
+def bench_updates(tmp):
+    """
+    Обработка апдейтов при 1, 16 и 64 одновременных: приложение из
+    main.build_application (регистрация команд, латиница и кириллица),
+    on_startup с лимитами исходящих из config, одно заседание суда
+    """
+    import asyncio
+    from telegram import Message, Update
+    
+    # main открывает базу data/torfobot.db при импорте - пусть во временном каталоге
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    import outbound
+    
+    users = 1000
+    fill_users(os.path.join(tmp, 'data', 'torfobot.db'), users)
+    main.db.sync.load_leaderboard()
+    # Без порта /metrics - бенчмарк может идти рядом с ботом
+    main.METRICS_PORT = 0
+    
+    bot = offline_bot()
+    sent = []
+    async def answer(**kwargs):
+        """Ответ Telegram - 5 мс"""
+        await asyncio.sleep(0.005)
+        sent.append(kwargs['chat_id'])
+        return Message(len(sent), None, None)
+    # ExtBot заморожен после создания, методы подменяются в обход
+    object.__setattr__(bot, 'send_message', answer)
+    object.__setattr__(bot, 'edit_message_text', answer)
+    
+    # Команды в том виде, в каком их пишут в чатах
+    commands = ['/status', '/top', '/rank', '/место', '/diagnostika', '/диагностика',
+                '/kopat_torf', '/добыть_торф', '/sobrat_kletchatku', '/собрать_клетчатку',
+                '/top@torfobot']
+    
+    def make_updates(count, first_chat):
+        updates = []
+        for n in range(count):
+            # Участники заседания - пользователи 1 и 2
+            user_id = 1 if n == 0 else random.randint(3, users)
+            text = '/суд_кишки' if n == 0 else random.choice(commands)
+            message = {
+                'message_id': n + 1, 'date': int(time.time()),
+                'chat': {'id': -(first_chat + random.randint(0, 49)), 'type': 'group', 'title': 'bench'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'Имя{user_id}'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+            }
+            if n == 0:
+                # Истцу хватает клетчатки на заседание
+                main.db.sync.update_user(user_id, kkl=100)
+                defendant = 2
+                message['reply_to_message'] = {
+                    'message_id': 1, 'date': int(time.time()), 'chat': message['chat'],
+                    'from': {'id': defendant, 'is_bot': False, 'first_name': f'Имя{defendant}'},
+                    'text': 'торф',
+                }
+            updates.append(Update.de_json({'update_id': n + 1, 'message': message}, bot))
+        return updates
+    
+    async def run(application, first_chat, count=300):
+        updates = make_updates(count, first_chat)
+        processor = application.update_processor
+        
+        # Скорость и задержка - по апдейтам после первого (открытия заседания)
+        latencies = []
+        finished = []
+        async def process(update):
+            started = time.perf_counter()
+            await processor.process_update(update, application.process_update(update))
+            if update.update_id != 1:
+                latencies.append(time.perf_counter() - started)
+                finished.append(time.perf_counter())
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(process(update) for update in updates))
+        latencies.sort()
+        return len(finished) / (max(finished) - started), latencies[len(latencies) // 2]
+    
+    async def run_all():
+        started = None
+        try:
+            for n, concurrency in enumerate((1, 16, 64)):
+                application = main.build_application(concurrency=concurrency, polling=False, bot=bot)
+                await application.initialize()
+                if started is None:
+                    # Службы (очередь исходящих, таймеры, задачи) - одни на процесс
+                    started = application
+                    await application.post_init(application)
+                rate, median = await run(application, first_chat=1 + n * 50)
+                stats = outbound.dispatcher.stats()
+                print(f'{concurrency:3} одновременно: {rate:8.1f} апдейтов/с, медиана ожидания {median * 1000:.0f} ms, '
+                      f'отправлено {len(sent)}, в очереди {stats["queued"]} (макс. {stats["max_depth"]})')
+                if application is not started:
+                    await application.shutdown()
+        finally:
+            if started is not None:
+                # Очередь в группы с лимитом 20 сообщений в минуту не дожидаемся
+                await outbound.stop(timeout=0)
+                await started.shutdown()
+                await started.post_shutdown(started)
+    
+    asyncio.run(run_all())
+
+def bench_webhook(tmp):
+    """Вебхук: записанные апдейты POST-запросами по keep-alive, секрет и 503 при перегрузке"""
+    import asyncio
+    import json
+    from telegram.ext import ApplicationBuilder, MessageHandler, filters
+    from webhook import WebhookServer
+    
+    def record(n):
+        return json.dumps({'update_id': n, 'message': {
+            'message_id': n, 'date': int(time.time()),
+            'chat': {'id': -1, 'type': 'group', 'title': 'bench'},
+            'from': {'id': n, 'is_bot': False, 'first_name': f'Имя{n}'},
+            'text': 'торф',
+        }}).encode()
+    
+    async def post(reader, writer, body, secret='bench'):
+        writer.write(b'POST /webhook HTTP/1.1\r\nHost: localhost\r\n'
+                     b'X-Telegram-Bot-Api-Secret-Token: ' + secret.encode() + b'\r\n'
+                     b'Content-Type: application/json\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        status = int((await reader.readline()).split()[1])
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        return status
+    
+    async def run(count=2000, connections=40):
+        handled = []
+        async def handle(update, context):
+            # Обработчик с ответом Telegram - 5 мс
+            await asyncio.sleep(0.005)
+            handled.append(update.update_id)
+        
+        application = ApplicationBuilder().bot(offline_bot()).updater(None) \
+            .concurrent_updates(64).build()
+        application.add_handler(MessageHandler(filters.TEXT, handle))
+        await application.initialize()
+        await application.start()
+        server = await WebhookServer(application, '/webhook', 'bench', max_pending=256).start('127.0.0.1', 0)
+        port = server._server.sockets[0].getsockname()[1]
+        
+        bodies = [record(n) for n in range(1, count + 1)]
+        statuses = []
+        async def client(part):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for body in part:
+                status = await post(reader, writer, body)
+                while status == 503:
+                    await asyncio.sleep(0.01)
+                    status = await post(reader, writer, body)
+                statuses.append(status)
+            writer.close()
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(client(bodies[n::connections]) for n in range(connections)))
+        await server.stop()
+        elapsed = time.perf_counter() - started
+        stats = server.stats()
+        
+        # Чужой секрет и переполнение очереди
+        server = await WebhookServer(application, '/webhook', 'bench', max_pending=1).start('127.0.0.1', 0)
+        port = server._server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        checks = [await post(reader, writer, record(count + 1), secret='wrong'),
+                  await post(reader, writer, record(count + 1)),
+                  await post(reader, writer, record(count + 2))]
+        writer.close()
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        return elapsed, stats, statuses, handled, checks
+    
+    elapsed, stats, statuses, handled, checks = asyncio.run(run())
+    print(f'{len(handled)} апдейтов за {elapsed:.2f} s ({len(handled) / elapsed:.0f}/s), '
+          f'статистика: {stats}, проверки: {checks}')
+    
+    problems = []
+    if sorted(handled) != list(range(1, len(statuses) + 2)):
+        problems.append(f'обработано {len(handled)} из {len(statuses) + 1}')
+    if checks != [403, 200, 503]:
+        problems.append(f'ответы {checks} вместо [403, 200, 503]')
+    if problems:
+        raise SystemExit('; '.join(problems))
+
+def bench_dispatch(tmp):
+    """Поиск обработчика команды: CommandHandler на каждое имя против одного CommandRouter"""
+    import asyncio
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, CommandHandler
+    
+    # main открывает базу data/torfobot.db при импорте - пусть во временном каталоге
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    
+    application = ApplicationBuilder().bot(offline_bot()).updater(None).build()
+    main.setup_handlers(application)
+    router = main.command_router
+    bot = application.bot
+    asyncio.run(bot.get_me())
+    
+    # Прежняя схема: отдельный CommandHandler на каждое имя. Кириллические
+    # имена CommandHandler не принимает - вместо них латинские заглушки
+    old_handlers = [CommandHandler(name if name.isascii() else f'alias{n}', None)
+                    for n, name in enumerate(router.names())]
+    
+    def make_update(n, text):
+        message = {
+            'message_id': n, 'date': int(time.time()),
+            'chat': {'id': -1, 'type': 'group', 'title': 'bench'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Имя'},
+            'text': text,
+        }
+        if text.startswith('/') and text[1:].split('@')[0].isascii():
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return Update.de_json({'update_id': n, 'message': message}, bot)
+    
+    # Смесь: латинские команды (в том числе последние в списке), с @ботом, обычный текст
+    texts = ['/status', '/top@torfobot', '/kiparis_zashita', '/admin_stats',
+             '/kupit_kletchatku 5', 'просто сообщение', '/Kiparis_Zashita', '/unknown']
+    updates = [make_update(n, texts[n % len(texts)]) for n in range(20000)]
+    
+    def old_dispatch(update):
+        for handler in old_handlers:
+            if handler.check_update(update):
+                return handler
+    
+    for title, dispatch in (('CommandHandler x%d' % len(old_handlers), old_dispatch),
+                            ('CommandRouter', router.check_update)):
+        started = time.perf_counter()
+        for update in updates:
+            dispatch(update)
+        elapsed = time.perf_counter() - started
+        print(f'{title:22} {elapsed / len(updates) * 1e6:6.2f} мкс на апдейт')
+    
+    problems = []
+    for text, expected in (('/Kiparis_zashita', 'kiparis_zashita'), ('/КИПАРИС_ЗАЩИТА', 'kiparis_zashita'),
+                           ('/суд_селезенки', 'sud_selezenki'), ('/top@TorfoBot', 'top'),
+                           ('/top@otherbot', None), ('/kupit_kletchatku 5', 'kupit_kletchatku')):
+        result = router.check_update(make_update(1, text))
+        if (result[0].name if result else None) != expected:
+            problems.append(f'{text}: {result and result[0].name}')
+    main.db.close()
+    if problems:
+        raise SystemExit('; '.join(problems))
+
+def bench_metrics(tmp):
+    """Накладные расходы метрик: учёт команды, запроса к базе и выдача /metrics"""
+    import asyncio
+    import socket
+    import metrics
+    from database import AsyncDatabase
+    
+    calls = 200_000
+    started = time.perf_counter()
+    for n in range(calls):
+        with metrics.track(f'cmd{n % 40}'):
+            metrics.add_db_time(0.001)
+            metrics.add_telegram_wait(0.002)
+    tracked = (time.perf_counter() - started) / calls
+    print(f'учёт команды (track + база + Telegram): {tracked * 1e6:.2f} мкс')
+    
+    db = AsyncDatabase(Database(os.path.join(tmp, 'metrics.db')))
+    
+    async def run():
+        # Запрос к базе через пул потоков - с учётом и без
+        async def timed(count=5000):
+            started = time.perf_counter()
+            for n in range(count):
+                await db.run(int)
+            return (time.perf_counter() - started) / count
+        
+        # Поочерёдно по несколько раз, лучшее время - меньше шума пула потоков
+        add_db_time = metrics.add_db_time
+        with_metrics = without = float('inf')
+        for _ in range(3):
+            metrics.add_db_time = lambda seconds: None
+            try:
+                without = min(without, await timed())
+            finally:
+                metrics.add_db_time = add_db_time
+            with_metrics = min(with_metrics, await timed())
+        print(f'вызов в потоке базы: {without * 1e6:.1f} мкс, с учётом {with_metrics * 1e6:.1f} мкс')
+        
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        await metrics.start(port)
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        await metrics.stop()
+        return response, time.perf_counter() - started
+    
+    response, elapsed = asyncio.run(run())
+    db.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    print(f'/metrics: {len(body)} байт за {elapsed * 1000:.1f} ms')
+    
+    problems = []
+    if not head.startswith(b'HTTP/1.1 200'):
+        problems.append(head.decode(errors='replace'))
+    if b'torfobot_command_duration_seconds_count{command="cmd0"} 5000' not in body:
+        problems.append('нет гистограммы cmd0')
+    if tracked > 20e-6:
+        problems.append(f'учёт команды дороже 20 мкс: {tracked * 1e6:.1f}')
+    if problems:
+        raise SystemExit('; '.join(problems))
+
+def bench_profiler(tmp):
+    """Профилировщик запросов: скорость операций без него и с ним, что он показывает"""
+    db_path = os.path.join(tmp, 'profiler.db')
+    db = Database(db_path)
+    fill_users(db_path)
+    
+    plain = run_ops(db)
+    db.set_profiling(True)
+    profiled = run_ops(db)
+    db.set_profiling(False)
+    after = run_ops(db)
+    print(f'без профилировщика: {plain:10.0f} ops/s')
+    print(f'с профилировщиком:  {profiled:10.0f} ops/s  ({profiled / plain - 1:+.0%})')
+    print(f'снова без:          {after:10.0f} ops/s')
+    
+    for method, (count, seconds, rows) in list(db.profiler.by_method().items())[:6]:
+        print(f'  {method:20} {count:8} запросов {seconds:7.2f} s {rows:8} строк')
+    db.close()
+
+BENCHMARKS = {
+    'pool': bench_pool,
+    'passive': bench_passive,
+    'plans': bench_plans,
+    'leaderboard': bench_leaderboard,
+    'outbound': bench_outbound,
+    'updates': bench_updates,
+    'webhook': bench_webhook,
+    'dispatch': bench_dispatch,
+    'metrics': bench_metrics,
+    'profiler': bench_profiler,
+}
+
+def main(names):
+    for name in names or BENCHMARKS:
+        print(f'== {name}: {BENCHMARKS[name].__doc__}')
+        with tempfile.TemporaryDirectory() as tmp:
+            BENCHMARKS[name](tmp)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+"""
+Кэш записей в памяти процесса.
+"""
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Ограниченный по размеру кэш с вытеснением давно не использованных записей.
+
+    Защита от устаревших данных: generation() запоминается до чтения из базы,
+    а put(..., generation=...) ничего не сохраняет, если с тех пор была
+    хоть одна инвалидация. Так медленное чтение не перезапишет более свежую
+    запись, сделанную параллельно.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self):
+        """Номер поколения - увеличивается при каждой инвалидации"""
+        return self._generation
+
+    def get(self, key, valid=None):
+        """
+        Значение по ключу или None. valid(значение) -> bool позволяет
+        отбросить запись, которая устарела сама по себе (например, по времени).
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None and (valid is None or valid(value)):
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+            if value is not None:
+                del self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation=None):
+        """Сохранение значения; с generation - только если не было инвалидаций"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def replace(self, items):
+        """Инвалидация и запись новых значений за один шаг ({ключ: значение или None})"""
+        with self._lock:
+            self._generation += 1
+            for key, value in items.items():
+                if value is None or self.max_size <= 0:
+                    self._items.pop(key, None)
+                else:
+                    self._items[key] = value
+                    self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """Удаление ключей из кэша"""
+        self.replace(dict.fromkeys(keys))
+
+    def clear(self):
+        """Полная очистка (после массовых изменений)"""
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+
+    def stats(self):
+        """Размер и счётчики попаданий/промахов"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
@@ -5,6 +5,23 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Настройки базы данных
+DB_PATH = "data/torfobot.db"
+DB_READERS = 4  # Соединений на чтение в пуле (плюс одно на запись)
+DB_CACHE_SIZE_KB = 16384  # Кэш страниц SQLite на соединение (16 МБ)
+DB_MMAP_SIZE = 268435456  # Размер mmap (256 МБ), 0 - отключить
+DB_BUSY_TIMEOUT = 5.0  # Ожидание блокировки в секундах
+DB_EXECUTOR_WORKERS = 4  # Потоки для запросов из асинхронных обработчиков
+DB_MAX_PENDING = 256  # Максимум запросов в очереди к базе
+MIGRATION_BATCH_SIZE = 5000  # Строк за один шаг заполнения при миграции
+MIGRATION_BATCH_PAUSE = 0.01  # Пауза между шагами, чтобы пропустить другие запросы
+USER_CACHE_SIZE = 10000  # Записей пользователей в кэше процесса, 0 - отключить
+KNOWN_MEMBERS_CACHE_SIZE = 50000  # Пар (чат, участник), уже записанных в базу этим процессом
+USER_LOCK_STRIPES = 1024  # Полос блокировок пользователей (см. locks.py)
+DB_PROFILE = os.getenv("DB_PROFILE", "") == "1"  # Профилирование запросов с запуска (см. sqlprofile.py)
+DB_SLOW_QUERY_MS = 50  # Запросы дольше - в журнал медленных
+DB_SLOW_LOG_SIZE = 50  # Сколько последних медленных запросов хранить
+
 # ID админа (замените на свой)
 ADMIN_IDS = [123456789]  # Замените на ваш Telegram ID
 
@@ -15,8 +32,46 @@ COST_KKL_FOR_PROTECTION = 3
 
 # Интервалы событий (в секундах)
 DANGER_INTERVAL = 10800  # 3 часа
+DANGER_TICK = 30  # Как часто проверять, каким чатам пора получить опасность
+DANGER_MAX_CHATS_PER_TICK = 50  # Максимум чатов за одну проверку
+JOB_POLL_INTERVAL = 5  # Максимальная пауза планировщика между проверками расписания
+JOB_LEASE = 600  # Сколько секунд задача считается занятой, если процесс не отчитался
 PASSIVE_INCOME_INTERVAL = 3600  # 1 час
 CELLULOSE_COOLDOWN = 86400  # 24 часа
+PASSIVE_INCOME_CHUNK = 2000  # Пользователей за одну транзакцию начисления
+TIMER_BATCH_SIZE = 500  # Сколько сработавших таймеров обрабатывать за один проход
+TIMER_RESOLUTION = 1.0  # Шаг службы таймеров: сработавшие за шаг обрабатываются вместе
+TIMER_LEASE = 300  # Сколько секунд сработавший таймер считается занятым, если процесс не отчитался
+TIMER_RETRY_DELAY = 5  # Пауза перед повтором таймера, обработчик которого упал; удваивается
+TIMER_RETRY_MAX_DELAY = 300  # Предел паузы между повторами
+TURTLE_DAMAGE_DELAY = 300  # Время на защиту от черепашек до урона, секунды
+TURTLE_INVASION_TTL = 600  # Через сколько секунд черепашки уходят сами
+CO2_DURATION = 3600  # Сколько держится CO₂ в чате, если его не нейтрализовать
+
+# Исходящие сообщения (лимиты Telegram: ~30 в секунду на бота,
+# 1 в секунду в личный чат, 20 в минуту в группу)
+OUTBOUND_GLOBAL_RATE = 25  # Сообщений в секунду на бота
+OUTBOUND_CHAT_RATE = 1.0  # Сообщений в секунду в личный чат
+OUTBOUND_GROUP_RATE = 20 / 60  # Сообщений в секунду в группу
+OUTBOUND_BURST = 3  # Сколько сообщений чат может получить подряд без паузы
+OUTBOUND_MAX_QUEUED = 1000  # Максимум сообщений в очереди
+OUTBOUND_MAX_RETRIES = 3  # Повторов при RetryAfter и сетевых ошибках
+OUTBOUND_CONCURRENCY = 8  # Одновременных запросов к Telegram
+
+# Обработка апдейтов: сколько выполняется одновременно (1 - строго по одному).
+# Команды, меняющие балансы, упорядочены блокировками пользователей (locks.py)
+UPDATE_CONCURRENCY = 64
+# Соединения HTTPX к Bot API: отправки очереди плюс запас для прочих вызовов
+# (get_me, ответы без очереди); getUpdates использует отдельный пул
+BOT_API_POOL_SIZE = OUTBOUND_CONCURRENCY + 8
+BOT_API_POOL_TIMEOUT = 10.0  # Ожидание свободного соединения, секунды
+
+# Несколько процессов-обработчиков (см. shards.py): апдейты чата всегда
+# попадают в один и тот же процесс. 1 - всё в одном процессе
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", 1))
+SHARD_MAX_PENDING = 512  # Апдейтов в обработке у процесса, дальше чтение ждёт
+SHARD_SYNC_INTERVAL = 5  # Как часто процесс подхватывает баны, выданные другими
+SHARD_LEADERBOARD_INTERVAL = 60  # Как часто перестраивать топ после чужих изменений
 
 # Шансы
 CHANCE_GOLD_VEIN = 0.15
@@ -30,6 +85,13 @@ COURT_COSTS = {
     "kishka": 10
 }
 
+# Длительность заседаний судов (секунды до вердикта)
+COURT_HEARING_SECONDS = {
+    "selezenka": 2,
+    "redodendron": 3,
+    "kishka": 4
+}
+
 # Штрафы судов
 COURT_FINES = {
     "selezenka": [20, 30, 50, 100],
@@ -120,10 +182,21 @@ JOB_SETTINGS = {
     "max_concurrent_jobs": 5
 }
 
-# URL для вебхуков (если будете использовать)
-WEBHOOK_URL = None  # "https://ваш-домен.ру/webhook"
-WEBHOOK_PORT = 8443
+# Вебхук (см. webhook.py). Если URL не задан - long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # "https://ваш-домен.ру/webhook"
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
 WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Без него - случайный при каждом запуске
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT")  # Самоподписанный сертификат, если TLS на боте
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY")
+WEBHOOK_MAX_PENDING = 256  # Необработанных апдейтов, после которых отвечаем 503
+WEBHOOK_MAX_BODY = 1048576  # Максимальный размер тела запроса, байты
+WEBHOOK_MAX_CONNECTIONS = 40  # Одновременных соединений от Telegram (до 100)
+
+# Метрики в формате Prometheus (см. metrics.py): GET /metrics на локальном
+# порту. Процессы shards.py слушают METRICS_PORT + номер. 0 - без сервера
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+METRICS_LISTEN = "127.0.0.1"
 
 # Логирование
 LOG_LEVEL = "INFO"
@@ -1,80 +1,597 @@
 import sqlite3
-import json
+import logging
+import queue
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import os
+import re
+import time
+import zlib
+
+from config import (
+    DB_PATH, DB_READERS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_BUSY_TIMEOUT,
+    DB_EXECUTOR_WORKERS, DB_MAX_PENDING, PASSIVE_INCOME_CHUNK, TRF_PER_HOUR,
+    MIGRATION_BATCH_SIZE, MIGRATION_BATCH_PAUSE, USER_CACHE_SIZE, DANGER_INTERVAL, DB_PROFILE
+)
+import metrics
+from cache import LRUCache
+from sqlprofile import QueryProfiler, ProfiledConnection
+from bans import BanRegistry
+from leaderboard import Leaderboard
+from turtles import TurtleInvasions, pack_ids
+
+logger = logging.getLogger(__name__)
+
+# Пассивный доход начисляется лениво: настоящий баланс - это trf плюс
+# TRF_PER_HOUR за каждый полный час с last_passive_income. Он записывается
+# в строку только когда пользователя читают или меняют его баланс,
+# а отметка времени сдвигается на целое число начисленных часов.
+# Параметры запросов: :now - текущее время, :rate - TRF в час.
+_PASSIVE_HOURS = "MAX(0, CAST((julianday(:now) - julianday(last_passive_income)) * 24 AS INTEGER))"
+_ACCRUED_TRF = f"(trf + :rate * {_PASSIVE_HOURS})"
+_ACCRUED_SINCE = (
+    f"CASE WHEN {_PASSIVE_HOURS} >= 1 "
+    f"THEN strftime('%Y-%m-%dT%H:%M:%f', julianday(last_passive_income) + {_PASSIVE_HOURS} / 24.0) "
+    f"ELSE last_passive_income END"
+)
+
+# Версионированные миграции схемы: (версия, описание, SQL-команды, заполнения).
+# Применённые версии записываются в таблицу schema_version, при запуске
+# выполняются только более новые. SQL-команды одной миграции идут одной
+# транзакцией, {score} - ключ сортировки топа. Заполнения - это
+# (таблица, SET-выражение, условие): они выполняются пакетами по rowid,
+# каждый пакет отдельным коммитом, и продолжаются после перезапуска.
+MIGRATIONS = [
+    (1, "Исходная схема", [
+        # Пользователи
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            trf INTEGER DEFAULT 100,
+            kkl INTEGER DEFAULT 5,
+            health INTEGER DEFAULT 100,
+            warnings INTEGER DEFAULT 0,
+            last_passive_income TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_cellulose TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_banned BOOLEAN DEFAULT FALSE,
+            banned_until TIMESTAMP,
+            perforation_count INTEGER DEFAULT 0,
+            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # Чаты
+        '''
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            ph_level REAL DEFAULT 5.0,
+            last_danger TIMESTAMP,
+            danger_type TEXT,
+            turtle_active BOOLEAN DEFAULT FALSE,
+            co2_active BOOLEAN DEFAULT FALSE
+        )''',
+        # Суды
+        '''
+        CREATE TABLE IF NOT EXISTS court_cases (
+            case_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            plaintiff_id INTEGER,
+            defendant_id INTEGER,
+            court_type TEXT,
+            verdict TEXT,
+            fine INTEGER,
+            result TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (plaintiff_id) REFERENCES users (user_id),
+            FOREIGN KEY (defendant_id) REFERENCES users (user_id)
+        )''',
+        # Добыча
+        '''
+        CREATE TABLE IF NOT EXISTS mining (
+            user_id INTEGER,
+            action TEXT,
+            amount INTEGER,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )''',
+    ], []),
+    (2, "Индексы для горячих запросов", [
+        # /moi_dela: WHERE plaintiff_id = ? OR defendant_id = ? ORDER BY timestamp
+        'CREATE INDEX IF NOT EXISTS idx_court_cases_plaintiff ON court_cases (plaintiff_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_court_cases_defendant ON court_cases (defendant_id, timestamp)',
+        # История добычи - покрывающий индекс, таблица не читается
+        'CREATE INDEX IF NOT EXISTS idx_mining_user ON mining (user_id, timestamp, action, amount)',
+        # /top - индекс по выражению накопленного баланса
+        'CREATE INDEX IF NOT EXISTS idx_users_score ON users {score}',
+        # Активные баны - частичный индекс только по забаненным
+        'CREATE INDEX IF NOT EXISTS idx_users_banned ON users (banned_until) WHERE is_banned = TRUE',
+    ], []),
+    (3, "Целочисленные отметки времени (unix, UTC) в истории", [
+        'ALTER TABLE mining ADD COLUMN ts INTEGER',
+        'ALTER TABLE court_cases ADD COLUMN ts INTEGER',
+    ], [
+        ('mining', "ts = CAST(strftime('%s', timestamp) AS INTEGER)", 'ts IS NULL'),
+        ('court_cases', "ts = CAST(strftime('%s', timestamp) AS INTEGER)", 'ts IS NULL'),
+    ]),
+    (4, "Индексы истории по целочисленному времени", [
+        'DROP INDEX IF EXISTS idx_mining_user',
+        'DROP INDEX IF EXISTS idx_court_cases_plaintiff',
+        'DROP INDEX IF EXISTS idx_court_cases_defendant',
+        'CREATE INDEX IF NOT EXISTS idx_mining_user_ts ON mining (user_id, ts, action, amount)',
+        'CREATE INDEX IF NOT EXISTS idx_court_cases_plaintiff_ts ON court_cases (plaintiff_id, ts)',
+        'CREATE INDEX IF NOT EXISTS idx_court_cases_defendant_ts ON court_cases (defendant_id, ts)',
+    ], []),
+    (5, "Участники чатов", [
+        # Опасности и урон затрагивают только участников своего чата
+        '''
+        CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            joined INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members (user_id)',
+    ], []),
+    (6, "Расписание опасностей по чатам", [
+        # Unix-время следующей опасности; NULL - чат ещё не в расписании
+        'ALTER TABLE chats ADD COLUMN next_danger_at INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_chats_next_danger ON chats (next_danger_at)',
+    ], []),
+    (7, "Фоновые задачи", [
+        # Время следующего запуска переживает перезапуск; аренда (lease)
+        # не даёт двум процессам выполнять одну задачу одновременно
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            name TEXT PRIMARY KEY,
+            interval INTEGER NOT NULL,
+            next_run INTEGER NOT NULL,
+            last_run INTEGER,
+            last_duration REAL,
+            runs INTEGER DEFAULT 0,
+            missed INTEGER DEFAULT 0,
+            lease_owner TEXT,
+            lease_until INTEGER
+        )''',
+    ], []),
+    (8, "Отложенные события", [
+        # Разовые таймеры игровых эффектов (см. timers.py): не больше
+        # одного таймера каждого вида на чат или пользователя
+        '''
+        CREATE TABLE IF NOT EXISTS timers (
+            kind TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            fire_at REAL NOT NULL,
+            payload TEXT,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID''',
+        # Действующие баны снимаются таймером вместо периодической проверки
+        # (strftime('%s') отбрасывает доли секунды, отсюда + 1)
+        '''
+        INSERT OR IGNORE INTO timers (kind, key, fire_at)
+        SELECT 'ban_expire', user_id, CAST(strftime('%s', banned_until, 'utc') AS REAL) + 1
+        FROM users WHERE is_banned = TRUE AND banned_until IS NOT NULL''',
+        # CO₂, объявленный до появления таймеров, не истекал никогда - снимаем сразу
+        '''
+        INSERT OR IGNORE INTO timers (kind, key, fire_at)
+        SELECT 'co2_expire', chat_id, CAST(strftime('%s', 'now') AS REAL)
+        FROM chats WHERE co2_active = TRUE''',
+        "DELETE FROM jobs WHERE name = 'ban_sweep'",
+    ], []),
+    (9, "Нашествия черепашек", [
+        # Состояние защиты общее для всех процессов и переживает перезапуск;
+        # participants - упакованный массив user_id (см. turtles.pack_ids)
+        '''
+        CREATE TABLE IF NOT EXISTS turtle_invasions (
+            chat_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL,
+            started INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            participants BLOB NOT NULL DEFAULT X''
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_turtle_invasions_expires ON turtle_invasions (expires_at)',
+        # Черепашки, объявленные до таблицы, жили только в памяти процесса
+        'UPDATE chats SET turtle_active = FALSE WHERE turtle_active = TRUE',
+    ], []),
+    (10, "Заседания судов", [
+        # Идущие заседания: KKL уже списаны, вердикт выносится по таймеру
+        # court_hearing, после чего строка переходит в court_cases
+        '''
+        CREATE TABLE IF NOT EXISTS court_hearings (
+            hearing_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            court_type TEXT NOT NULL,
+            plaintiff_id INTEGER NOT NULL,
+            defendant_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER,
+            cost INTEGER NOT NULL,
+            created INTEGER NOT NULL
+        )''',
+    ], []),
+]
+
+def next_danger_at(chat_id, now=None, interval=DANGER_INTERVAL):
+    """
+    Ближайший после now момент опасности для чата. У каждого чата своё
+    постоянное смещение внутри интервала (по crc32 от chat_id), поэтому
+    опасности разных чатов равномерно распределены по времени.
+    """
+    now = int(now if now is not None else time.time())
+    offset = zlib.crc32(str(chat_id).encode()) % interval
+    return now - (now - offset) % interval + interval
+
+# Запросы, выполняемые на каждую команду или апдейт. Методы Database
+# используют именно эти тексты, а audit_query_plans() проверяет, что ни
+# один из них не читает таблицу целиком.
+HOT_QUERIES = {
+    'get_user': f'SELECT *, {_PASSIVE_HOURS} AS pending_hours FROM users WHERE user_id = :uid',
+    'accrue_passive_income': f'''
+        UPDATE users SET trf = {_ACCRUED_TRF}, last_passive_income = {_ACCRUED_SINCE}
+        WHERE user_id = :uid AND {_PASSIVE_HOURS} >= 1
+        RETURNING *''',
+    'get_chat': 'SELECT * FROM chats WHERE chat_id = :chat_id',
+    'get_turtle_invasion': '''
+        SELECT * FROM turtle_invasions WHERE chat_id = :chat_id AND expires_at > :now''',
+    'get_top_users': f'''
+        SELECT user_id, username, first_name, {_ACCRUED_TRF}, kkl
+        FROM users
+        ORDER BY {{score}} DESC, user_id
+        LIMIT :limit''',
+    'get_user_court_cases': '''
+        SELECT court_type, verdict, result, timestamp
+        FROM court_cases
+        WHERE plaintiff_id = :uid OR defendant_id = :uid
+        ORDER BY ts DESC LIMIT :limit''',
+    'get_user_mining_history': '''
+        SELECT action, amount, timestamp
+        FROM mining
+        WHERE user_id = :uid
+        ORDER BY ts DESC LIMIT :limit''',
+    'get_chat_members': '''
+        SELECT m.user_id FROM chat_members m
+        JOIN users u ON u.user_id = m.user_id
+        WHERE m.chat_id = :chat_id AND u.is_banned = FALSE''',
+    'get_chat_member_balances': f'''
+        SELECT u.user_id, {_ACCRUED_TRF} FROM chat_members m
+        JOIN users u ON u.user_id = m.user_id
+        WHERE m.chat_id = :chat_id''',
+    'damage_chat_members': f'''
+        UPDATE users
+        SET trf = {_ACCRUED_TRF} - MIN({_ACCRUED_TRF}, :amount), last_passive_income = {_ACCRUED_SINCE}
+        WHERE user_id IN (SELECT user_id FROM chat_members WHERE chat_id = :chat_id)
+          AND {_ACCRUED_TRF} > 0
+        RETURNING *''',
+    'claim_due_chats': '''
+        UPDATE chats
+        SET next_danger_at = next_danger_at + :interval * ((:now - next_danger_at) / :interval + 1),
+            last_danger = :now_iso
+        WHERE chat_id IN (
+            SELECT chat_id FROM chats
+            WHERE next_danger_at <= :now
+              AND (chat_id % :shards + :shards) % :shards = :shard
+            ORDER BY next_danger_at LIMIT :limit
+        )
+        RETURNING chat_id''',
+    'get_active_bans': '''
+        SELECT user_id, banned_until FROM users
+        WHERE is_banned = TRUE AND banned_until > :now''',
+}
+
+# Шаг плана "SCAN <таблица>" без индекса - полный просмотр
+_FULL_SCAN = re.compile(r'^SCAN \w+( AS \w+)?$')
 
 class Database:
-    def __init__(self, db_path='data/torfobot.db'):
-        os.makedirs('data', exist_ok=True)
+    def __init__(self, db_path=DB_PATH, readers=DB_READERS,
+                 cache_size_kb=DB_CACHE_SIZE_KB, mmap_size=DB_MMAP_SIZE,
+                 trf_per_hour=TRF_PER_HOUR, user_cache_size=USER_CACHE_SIZE):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
         self.db_path = db_path
+        self.trf_per_hour = trf_per_hour
+        # Ключ сортировки по накопленному балансу без обращения к "now":
+        # trf + rate * часы = _score_sql + rate * 24 * julianday(now)
+        self._score_sql = f"(trf - {float(trf_per_hour) * 24} * julianday(last_passive_income))"
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        # Кэш записей пользователей: обновляется после коммита под блокировкой
+        # писателя, поэтому порядок записей в кэше совпадает с порядком в базе
+        self.user_cache = LRUCache(user_cache_size)
+        # Активные баны и таблица лидеров - так же по закоммиченным записям
+        self.bans = BanRegistry()
+        self.leaderboard = Leaderboard(trf_per_hour)
+        # Нашествия черепашек - кэш только по собственным записям процесса
+        self.turtles = TurtleInvasions()
+        # Последний PRAGMA data_version (см. changed_elsewhere)
+        self._data_version = None
+        
+        # Профилировщик запросов (sqlprofile.py); выключен - соединения обычные
+        self.profiler = QueryProfiler()
+        self.profiler.watch(Database)
+        self.profiler.enabled = DB_PROFILE
+        
+        # Одно соединение на запись (SQLite всё равно пишет последовательно)
+        # и несколько на чтение - в WAL читатели не ждут писателя
+        self._writer = self._connect(readonly=False)
+        self._writer_lock = threading.RLock()
+        # Признак открытой transaction() в текущем потоке
+        self._local = threading.local()
+        self._readers = None
+        
         self.init_db()
+        
+        # Читатели открываются после миграций, чтобы сразу видеть итоговую схему
+        self._reader_count = max(1, readers)
+        self._readers = self._open_readers()
+        
+        self.load_bans()
+        self.load_leaderboard()
+    
+    def _connect(self, readonly):
+        """Открытие долгоживущего соединения для пула"""
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                               factory=ProfiledConnection if self.profiler.enabled else sqlite3.Connection)
+        if self.profiler.enabled:
+            conn.profiler = self.profiler
+        if not readonly:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        if readonly:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+    
+    def _open_readers(self):
+        readers = queue.Queue()
+        for _ in range(self._reader_count):
+            readers.put(self._connect(readonly=True))
+        return readers
+    
+    def set_profiling(self, enabled):
+        """
+        Включение и выключение профилировщика на ходу: соединения пула
+        открываются заново с нужной фабрикой. Писатель меняется под его
+        блокировкой; свободные читатели старой очереди закрываются сразу,
+        занятые - когда их вернут (см. get_connection).
+        """
+        if enabled == self.profiler.enabled:
+            return
+        self.profiler.enabled = enabled
+        if enabled:
+            self.profiler.reset()
+        old_readers, self._readers = self._readers, self._open_readers()
+        with self._writer_lock:
+            old_writer, self._writer = self._writer, self._connect(readonly=False)
+            self._data_version = None
+        old_writer.close()
+        while not old_readers.empty():
+            conn = old_readers.get_nowait()
+            if conn is not None:
+                conn.close()
+        # Потоки, ждущие читателя в старой очереди, переходят к новой
+        old_readers.put(None)
+        logger.info("Профилирование запросов %s", "включено" if enabled else "выключено")
+    
+    @contextmanager
+    def get_connection(self, write=True):
+        """
+        Соединение из пула. На запись - единственный писатель под блокировкой,
+        коммит при выходе и откат при ошибке (как у sqlite3.Connection).
+        На чтение - свободный читатель из очереди (до конца миграций - писатель).
+        Внутри transaction() всегда отдаётся соединение транзакции без коммита.
+        """
+        if self._in_transaction():
+            yield self._writer
+        elif write or self._readers is None:
+            with self._writer_lock:
+                conn = self._writer
+                try:
+                    yield conn
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    self._flush_user_writes(committed=False)
+                    raise
+                self._flush_user_writes(committed=True)
+        else:
+            while True:
+                readers = self._readers
+                conn = readers.get()
+                if conn is not None:
+                    break
+                # Очередь заменена set_profiling: разбудить следующего ждущего
+                readers.put(None)
+            try:
+                yield conn
+            finally:
+                if readers is self._readers:
+                    readers.put(conn)
+                else:
+                    # Читатель заменённой очереди больше не нужен
+                    conn.close()
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Группировка нескольких изменений в один коммит.
+        
+        Все методы Database, вызванные внутри блока в этом же потоке, работают
+        на соединении транзакции. При исключении всё откатывается.
+        Вложенные transaction() присоединяются к внешней.
+        """
+        if self._in_transaction():
+            yield self._writer
+            return
+        
+        with self._writer_lock:
+            conn = self._writer
+            conn.execute('BEGIN IMMEDIATE')
+            self._local.in_transaction = True
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                self._flush_user_writes(committed=False)
+                raise
+            finally:
+                self._local.in_transaction = False
+            self._flush_user_writes(committed=True)
+    
+    def _in_transaction(self):
+        return getattr(self._local, 'in_transaction', False)
+    
+    def _cache_user(self, user_id, row=None):
+        """
+        Отметка изменения пользователя в текущей записи. После коммита
+        row попадёт в кэш, реестр банов и таблицу лидеров (None - запись
+        просто удаляется из кэша).
+        """
+        writes = getattr(self._local, 'user_writes', None)
+        if writes is None:
+            writes = self._local.user_writes = {}
+        writes[user_id] = row
+    
+    def _flush_user_writes(self, committed):
+        """Применение отмеченных изменений к кэшу (при откате - только удаление)"""
+        writes = getattr(self._local, 'user_writes', None)
+        if not writes:
+            return
+        self._local.user_writes = None
+        if not committed:
+            self.user_cache.invalidate(*writes)
+            return
+        self.user_cache.replace({user_id: self._user_cache_entry(row) if row else None
+                                 for user_id, row in writes.items()})
+        for row in writes.values():
+            if row:
+                self.bans.sync(row)
+                self.leaderboard.update(row)
     
-    def get_connection(self):
-        return sqlite3.connect(self.db_path)
+    @staticmethod
+    def _user_cache_entry(user):
+        """
+        (срок годности, строка) для кэша. Запись верна, пока не набежал
+        очередной час пассивного дохода; без отметки времени не кэшируется.
+        """
+        try:
+            last = datetime.fromisoformat(user['last_passive_income'])
+        except (TypeError, ValueError):
+            return None
+        return last + timedelta(hours=1), dict(user)
+    
+    @staticmethod
+    def _user_cache_fresh(entry):
+        return datetime.now() < entry[0]
+    
+    def changed_elsewhere(self):
+        """
+        Были ли с прошлого вызова коммиты из других процессов. data_version
+        соединения меняется только от чужих записей, а все записи этого
+        процесса идут через self._writer.
+        """
+        with self._writer_lock:
+            version = self._writer.execute('PRAGMA data_version').fetchone()[0]
+        changed = self._data_version is not None and version != self._data_version
+        self._data_version = version
+        return changed
+
+    def close(self):
+        """Закрытие всех соединений пула"""
+        with self._writer_lock:
+            self._writer.close()
+        while self._readers is not None and not self._readers.empty():
+            conn = self._readers.get_nowait()
+            if conn is not None:
+                conn.close()
     
     def init_db(self):
-        with self.get_connection() as conn:
+        self.migrate()
+    
+    def _applied_migrations(self):
+        """{версия: заполнение завершено} по таблице schema_version"""
+        with self.get_connection(write=False) as conn:
             cur = conn.cursor()
-            
-            # Пользователи
-            cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                trf INTEGER DEFAULT 100,
-                kkl INTEGER DEFAULT 5,
-                health INTEGER DEFAULT 100,
-                warnings INTEGER DEFAULT 0,
-                last_passive_income TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_cellulose TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_banned BOOLEAN DEFAULT FALSE,
-                banned_until TIMESTAMP,
-                perforation_count INTEGER DEFAULT 0,
-                created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
-            
-            # Чаты
-            cur.execute('''
-            CREATE TABLE IF NOT EXISTS chats (
-                chat_id INTEGER PRIMARY KEY,
-                ph_level REAL DEFAULT 5.0,
-                last_danger TIMESTAMP,
-                danger_type TEXT,
-                turtle_active BOOLEAN DEFAULT FALSE,
-                co2_active BOOLEAN DEFAULT FALSE
-            )
-            ''')
-            
-            # Суды
-            cur.execute('''
-            CREATE TABLE IF NOT EXISTS court_cases (
-                case_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                plaintiff_id INTEGER,
-                defendant_id INTEGER,
-                court_type TEXT,
-                verdict TEXT,
-                fine INTEGER,
-                result TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (plaintiff_id) REFERENCES users (user_id),
-                FOREIGN KEY (defendant_id) REFERENCES users (user_id)
-            )
-            ''')
-            
-            # Добыча
-            cur.execute('''
-            CREATE TABLE IF NOT EXISTS mining (
-                user_id INTEGER,
-                action TEXT,
-                amount INTEGER,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")
+            if not cur.fetchone():
+                return {}
+            cur.execute('SELECT version, backfilled FROM schema_version')
+            return {version: bool(backfilled) for version, backfilled in cur.fetchall()}
+    
+    def schema_version(self):
+        """Последняя полностью применённая миграция (0 - пустая база)"""
+        applied = self._applied_migrations()
+        return max((version for version, done in applied.items() if done), default=0)
+    
+    def migrate(self):
+        """
+        Применение недостающих миграций по порядку.
+        Если схема актуальна, никаких DDL не выполняется.
+        Возвращает число применённых миграций.
+        """
+        applied = self._applied_migrations()
+        if all(applied.get(version) for version, *_ in MIGRATIONS):
+            return 0
+        
+        with self.get_connection() as conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                backfilled BOOLEAN DEFAULT TRUE,
+                applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
             ''')
-            
-            conn.commit()
+            # Базы, размеченные через PRAGMA user_version = 1: исходная схема
+            # и индексы (миграции 1 и 2) уже есть
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= 1:
+                for version, description, *_ in MIGRATIONS[:2]:
+                    conn.execute('INSERT OR IGNORE INTO schema_version (version, description) VALUES (?, ?)',
+                                 (version, description))
+                    applied[version] = True
+                conn.execute('PRAGMA user_version = 0')
+        
+        count = 0
+        for version, description, statements, backfills in MIGRATIONS:
+            if applied.get(version):
+                continue
+            started = time.perf_counter()
+            # DDL и запись о версии - одним коммитом, чтобы не повторить ALTER
+            if version not in applied:
+                with self.transaction() as conn:
+                    for sql in statements:
+                        conn.execute(sql.format(score=self._score_sql))
+                    conn.execute('''
+                    INSERT INTO schema_version (version, description, backfilled) VALUES (?, ?, ?)
+                    ''', (version, description, not backfills))
+            # Заполнение продолжается с места остановки после перезапуска
+            if backfills:
+                for table, assignments, condition in backfills:
+                    self._backfill(table, assignments, condition)
+                with self.get_connection() as conn:
+                    conn.execute('UPDATE schema_version SET backfilled = TRUE WHERE version = ?', (version,))
+            count += 1
+            logger.info("Миграция %d (%s) применена за %.2f с",
+                        version, description, time.perf_counter() - started)
+        return count
+    
+    def _backfill(self, table, assignments, condition, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Заполнение колонок большой таблицы пакетами по диапазонам rowid.
+        Каждый пакет - отдельный короткий коммит, между ними блокировка
+        записи отпускается, так что работающий бот продолжает обслуживать запросы.
+        """
+        with self.get_connection(write=False) as conn:
+            max_rowid = conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+        
+        for low in range(0, max_rowid, batch_size):
+            with self.get_connection() as conn:
+                conn.execute(f'''
+                UPDATE {table} SET {assignments}
+                WHERE rowid > ? AND rowid <= ? AND {condition}
+                ''', (low, low + batch_size))
+            time.sleep(MIGRATION_BATCH_PAUSE)
     
     def create_user(self, user_id, username, first_name):
         with self.get_connection() as conn:
@@ -82,16 +599,57 @@ class Database:
             cur.execute('''
             INSERT OR IGNORE INTO users (user_id, username, first_name) 
             VALUES (?, ?, ?)
+            RETURNING *
             ''', (user_id, username, first_name))
-            conn.commit()
+            columns = [column[0] for column in cur.description]
+            row = cur.fetchone()
+            if row:
+                self._cache_user(user_id, dict(zip(columns, row)))
     
-    def get_user(self, user_id):
-        with self.get_connection() as conn:
+    def _accrual_params(self, **params):
+        """Параметры :now и :rate для запросов с ленивым начислением"""
+        params['now'] = datetime.now().isoformat()
+        params['rate'] = self.trf_per_hour
+        return params
+    
+    def get_user(self, user_id, accrue=True):
+        """
+        Пользователь с учётом пассивного дохода. Если с последнего
+        начисления прошёл полный час, доход записывается в базу.
+        accrue=False - строка как есть, без начисления.
+        
+        Сначала проверяется кэш (кроме вызовов внутри transaction(),
+        которые должны видеть свои же незакоммиченные изменения).
+        """
+        use_cache = not self._in_transaction()
+        if use_cache:
+            entry = self.user_cache.get(user_id, self._user_cache_fresh)
+            if entry is not None:
+                return dict(entry[1])
+            generation = self.user_cache.generation()
+        
+        with self.get_connection(write=False) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            cur.execute(HOT_QUERIES['get_user'], self._accrual_params(uid=user_id))
             columns = [column[0] for column in cur.description]
             user = cur.fetchone()
-            return dict(zip(columns, user)) if user else None
+        if not user:
+            return None
+        
+        user = dict(zip(columns, user))
+        pending_hours = user.pop('pending_hours')
+        if accrue and pending_hours >= 1:
+            return self.accrue_passive_income(user_id) or user
+        if use_cache and pending_hours < 1:
+            entry = self._user_cache_entry(user)
+            if entry:
+                self.user_cache.put(user_id, entry, generation)
+        return user
+    
+    def accrue_passive_income(self, user_id):
+        """Запись накопленного пассивного дохода одного пользователя"""
+        return self._update_user_returning(HOT_QUERIES['accrue_passive_income'],
+                                           self._accrual_params(uid=user_id))
     
     def update_user(self, user_id, **kwargs):
         if not kwargs:
@@ -101,45 +659,141 @@ class Database:
             cur = conn.cursor()
             set_clause = ', '.join([f"{key} = ?" for key in kwargs.keys()])
             values = list(kwargs.values()) + [user_id]
-            cur.execute(f'UPDATE users SET {set_clause} WHERE user_id = ?', values)
-            conn.commit()
+            cur.execute(f'UPDATE users SET {set_clause} WHERE user_id = ? RETURNING *', values)
+            columns = [column[0] for column in cur.description]
+            row = cur.fetchone()
+            self._cache_user(user_id, dict(zip(columns, row)) if row else None)
+    
+    def _update_user_returning(self, sql, params):
+        """
+        UPDATE ... RETURNING * по одному пользователю, строка как dict.
+        Обновлённая строка после коммита записывается в кэш.
+        """
+        with self.get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            columns = [column[0] for column in cur.description]
+            row = cur.fetchone()
+            if not row:
+                return None
+            user = dict(zip(columns, row))
+            self._cache_user(user['user_id'], user)
+            return user
+    
+    def _balance_sets(self, params, updates):
+        """SET-часть для изменения баланса с материализацией пассивного дохода"""
+        sets = [f'last_passive_income = {_ACCRUED_SINCE}'] if 'last_passive_income' not in updates else []
+        for key, value in updates.items():
+            sets.append(f"{key} = :set_{key}")
+            params[f'set_{key}'] = value
+        return sets
+    
+    def add_balance(self, user_id, trf=0, kkl=0, **updates):
+        """
+        Атомарное изменение балансов одним запросом (не ниже нуля).
+        Накопленный пассивный доход учитывается в том же UPDATE.
+        Дополнительные поля из updates записываются тем же UPDATE.
+        Возвращает обновлённого пользователя или None, если его нет.
+        """
+        params = self._accrual_params(uid=user_id, trf=trf, kkl=kkl)
+        sets = [f'trf = MAX(0, {_ACCRUED_TRF} + :trf)', 'kkl = MAX(0, kkl + :kkl)']
+        sets += self._balance_sets(params, updates)
+        return self._update_user_returning(
+            f'UPDATE users SET {", ".join(sets)} WHERE user_id = :uid RETURNING *', params
+        )
+    
+    def spend(self, user_id, trf=0, kkl=0, **updates):
+        """
+        Атомарное списание: проходит, только если хватает и TRF
+        (с учётом накопленного дохода), и KKL.
+        Возвращает обновлённого пользователя или None, если средств
+        недостаточно (или пользователя нет).
+        """
+        params = self._accrual_params(uid=user_id, trf=trf, kkl=kkl)
+        sets = [f'trf = {_ACCRUED_TRF} - :trf', 'kkl = kkl - :kkl']
+        sets += self._balance_sets(params, updates)
+        return self._update_user_returning(f'''
+        UPDATE users SET {", ".join(sets)}
+        WHERE user_id = :uid AND {_ACCRUED_TRF} >= :trf AND kkl >= :kkl
+        RETURNING *
+        ''', params)
+    
+    def increment_user(self, user_id, **deltas):
+        """Атомарное изменение счётчиков (здоровье, предупреждения, перфорации)"""
+        if not deltas:
+            return self.get_user(user_id)
+        parts = []
+        for key in deltas.keys():
+            if key == 'health':
+                parts.append('health = MIN(100, MAX(0, health + ?))')
+            else:
+                parts.append(f"{key} = MAX(0, {key} + ?)")
+        values = list(deltas.values()) + [user_id]
+        return self._update_user_returning(
+            f'UPDATE users SET {", ".join(parts)} WHERE user_id = ? RETURNING *', values
+        )
+    
+    def take_trf(self, user_id, amount):
+        """Списание до amount TRF (сколько есть). Возвращает списанное"""
+        params = self._accrual_params(uid=user_id)
+        with self.transaction() as conn:
+            row = conn.execute(f'SELECT {_ACCRUED_TRF} FROM users WHERE user_id = :uid', params).fetchone()
+            taken = min(row[0], amount) if row else 0
+            if taken > 0:
+                params['taken'] = taken
+                self._update_user_returning(f'''
+                UPDATE users SET trf = {_ACCRUED_TRF} - :taken, last_passive_income = {_ACCRUED_SINCE}
+                WHERE user_id = :uid
+                RETURNING *
+                ''', params)
+            return taken
+    
+    def transfer_trf(self, from_id, to_id, amount, partial=False):
+        """
+        Перевод TRF между пользователями одним коммитом.
+        partial=False - всё или ничего (None при нехватке средств),
+        partial=True - переводится сколько есть. Возвращает переведённую сумму.
+        """
+        with self.transaction():
+            if partial:
+                moved = self.take_trf(from_id, amount)
+            elif self.spend(from_id, trf=amount) is not None:
+                moved = amount
+            else:
+                return None
+            if moved:
+                self.add_balance(to_id, trf=moved)
+            return moved
     
     def add_trf(self, user_id, amount):
-        user = self.get_user(user_id)
-        if user:
-            new_trf = user['trf'] + amount
-            self.update_user(user_id, trf=new_trf)
-            return new_trf
-        return 0
+        user = self.add_balance(user_id, trf=amount)
+        return user['trf'] if user else 0
     
     def add_kkl(self, user_id, amount):
-        user = self.get_user(user_id)
-        if user:
-            new_kkl = user['kkl'] + amount
-            self.update_user(user_id, kkl=new_kkl)
-            return new_kkl
-        return 0
+        user = self.add_balance(user_id, kkl=amount)
+        return user['kkl'] if user else 0
     
     def get_chat(self, chat_id):
-        with self.get_connection() as conn:
+        with self.get_connection(write=False) as conn:
             cur = conn.cursor()
-            cur.execute('SELECT * FROM chats WHERE chat_id = ?', (chat_id,))
+            cur.execute(HOT_QUERIES['get_chat'], {'chat_id': chat_id})
             columns = [column[0] for column in cur.description]
             chat = cur.fetchone()
-            if chat:
-                return dict(zip(columns, chat))
-            else:
-                # Создаем запись чата если нет
-                cur.execute('INSERT INTO chats (chat_id) VALUES (?)', (chat_id,))
-                conn.commit()
-                return {
-                    'chat_id': chat_id, 
-                    'ph_level': 5.0, 
-                    'last_danger': None, 
-                    'danger_type': None, 
-                    'turtle_active': False, 
-                    'co2_active': False
-                }
+        if chat:
+            return dict(zip(columns, chat))
+        
+        # Создаем запись чата если нет (сразу со своим местом в расписании опасностей)
+        with self.get_connection() as conn:
+            conn.execute('INSERT OR IGNORE INTO chats (chat_id, next_danger_at) VALUES (?, ?)',
+                         (chat_id, next_danger_at(chat_id)))
+        return {
+            'chat_id': chat_id, 
+            'ph_level': 5.0, 
+            'last_danger': None, 
+            'danger_type': None, 
+            'turtle_active': False, 
+            'co2_active': False
+        }
     
     def update_chat(self, chat_id, **kwargs):
         with self.get_connection() as conn:
@@ -147,51 +801,157 @@ class Database:
             set_clause = ', '.join([f"{key} = ?" for key in kwargs.keys()])
             values = list(kwargs.values()) + [chat_id]
             cur.execute(f'UPDATE chats SET {set_clause} WHERE chat_id = ?', values)
-            conn.commit()
     
     def add_court_case(self, plaintiff_id, defendant_id, court_type, verdict, fine, result):
         with self.get_connection() as conn:
             cur = conn.cursor()
             cur.execute('''
-            INSERT INTO court_cases (plaintiff_id, defendant_id, court_type, verdict, fine, result)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''', (plaintiff_id, defendant_id, court_type, verdict, fine, result))
-            conn.commit()
+            INSERT INTO court_cases (plaintiff_id, defendant_id, court_type, verdict, fine, result, ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (plaintiff_id, defendant_id, court_type, verdict, fine, result, int(time.time())))
             return cur.lastrowid
     
-    def get_active_bans(self):
+    def add_court_hearing(self, court_type, plaintiff_id, defendant_id, chat_id, cost):
+        """Новое заседание; возвращает его запись"""
+        with self.get_connection() as conn:
+            cur = conn.execute('''
+            INSERT INTO court_hearings (court_type, plaintiff_id, defendant_id, chat_id, cost, created)
+            VALUES (?, ?, ?, ?, ?, ?)
+            RETURNING *
+            ''', (court_type, plaintiff_id, defendant_id, chat_id, cost, int(time.time())))
+            columns = [column[0] for column in cur.description]
+            return dict(zip(columns, cur.fetchone()))
+    
+    def set_court_hearing_message(self, hearing_id, message_id):
+        """Сообщение о начале заседания, которое заменится вердиктом"""
+        with self.get_connection() as conn:
+            conn.execute('UPDATE court_hearings SET message_id = ? WHERE hearing_id = ?',
+                         (message_id, hearing_id))
+    
+    def take_court_hearing(self, hearing_id):
+        """
+        Снятие заседания для вынесения вердикта. Возвращает его запись
+        или None, если вердикт уже вынесен - дважды дело не решается.
+        """
         with self.get_connection() as conn:
+            cur = conn.execute('DELETE FROM court_hearings WHERE hearing_id = ? RETURNING *', (hearing_id,))
+            columns = [column[0] for column in cur.description]
+            row = cur.fetchone()
+            return dict(zip(columns, row)) if row else None
+    
+    def get_active_bans(self):
+        # banned_until пишется как datetime.now().isoformat(), сравниваем в том же формате
+        with self.get_connection(write=False) as conn:
             cur = conn.cursor()
-            cur.execute('''
-            SELECT user_id, banned_until FROM users 
-            WHERE is_banned = TRUE AND banned_until > datetime('now')
-            ''')
+            cur.execute(HOT_QUERIES['get_active_bans'], {'now': datetime.now().isoformat()})
             return {row[0]: row[1] for row in cur.fetchall()}
     
-    def get_top_users(self, limit=10):
-        """Получение топ пользователей с first_name"""
+    def unban_expired(self, user_ids=None):
+        """
+        Снятие истёкших банов одним UPDATE (по умолчанию - у всех,
+        иначе только у user_ids). Повторный бан с новым сроком не трогается.
+        Возвращает число разбаненных.
+        """
+        params = {'now': datetime.now().isoformat()}
+        where = 'is_banned = TRUE AND banned_until <= :now'
+        if user_ids is not None:
+            if not user_ids:
+                return 0
+            user_ids = list(user_ids)
+            params.update((f'u{i}', user_id) for i, user_id in enumerate(user_ids))
+            where += f" AND user_id IN ({', '.join(f':u{i}' for i in range(len(user_ids)))})"
+        
         with self.get_connection() as conn:
             cur = conn.cursor()
-            cur.execute('''
-            SELECT user_id, username, first_name, trf, kkl FROM users 
-            ORDER BY trf DESC LIMIT ?
-            ''', (limit,))
+            cur.execute(f'UPDATE users SET is_banned = FALSE, banned_until = NULL WHERE {where} RETURNING *',
+                        params)
+            columns = [column[0] for column in cur.description]
+            rows = cur.fetchall()
+            for row in rows:
+                user = dict(zip(columns, row))
+                self._cache_user(user['user_id'], user)
+        return len(rows)
+    
+    def load_bans(self):
+        """Загрузка реестра банов из базы (истёкшие баны сразу снимаются)"""
+        self.unban_expired()
+        self.bans.load(self.get_active_bans())
+    
+    def sweep_bans(self):
+        """Снятие банов, истёкших в реестре, одним пакетом. Возвращает их число"""
+        return self.unban_expired(self.bans.pop_expired())
+    
+    def get_top_users(self, limit=10, now=None):
+        """
+        Получение топ пользователей с first_name (баланс с учётом пассивного дохода).
+        
+        Порядок - по непрерывному ключу _score_sql, как у таблицы лидеров:
+        обработчики берут топ из self.leaderboard, этот запрос - эталон
+        для verify_leaderboard.
+        """
+        params = self._accrual_params()
+        params['limit'] = limit
+        if now:
+            params['now'] = now.isoformat()
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute(HOT_QUERIES['get_top_users'].format(score=self._score_sql), params)
             return cur.fetchall()
     
+    def load_leaderboard(self):
+        """Построение таблицы лидеров по всем пользователям"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT user_id, username, first_name, trf, kkl, last_passive_income FROM users')
+            self.leaderboard.load(cur.fetchall())
+    
+    def get_user_rank(self, user_id):
+        """(место, всего) по накопленному TRF из таблицы лидеров или None"""
+        return self.leaderboard.rank(user_id)
+    
+    def verify_leaderboard(self, limit=10, samples=20):
+        """
+        Сверка таблицы лидеров с базой: число пользователей, топ
+        (get_top_users) и места нескольких случайных пользователей.
+        Возвращает список расхождений (пустой - всё сходится).
+        """
+        now = datetime.now()
+        problems = []
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT COUNT(*) FROM users')
+            count = cur.fetchone()[0]
+            cur.execute('SELECT user_id FROM users ORDER BY RANDOM() LIMIT ?', (samples,))
+            sample = [row[0] for row in cur.fetchall()]
+            ranks = {}
+            for user_id in sample:
+                cur.execute(f'''
+                SELECT COUNT(*) + 1 FROM users
+                WHERE {self._score_sql} > (SELECT {self._score_sql} FROM users WHERE user_id = :uid)
+                ''', {'uid': user_id})
+                ranks[user_id] = cur.fetchone()[0]
+        
+        if count != len(self.leaderboard):
+            problems.append(f'пользователей: в базе {count}, в таблице {len(self.leaderboard)}')
+        
+        expected = self.get_top_users(limit, now)
+        actual = self.leaderboard.top(limit, now)
+        if expected != actual:
+            problems.append(f'топ-{limit}: в базе {expected}, в таблице {actual}')
+        
+        for user_id, rank in ranks.items():
+            actual_rank = self.leaderboard.rank(user_id)
+            if not actual_rank or actual_rank[0] != rank:
+                problems.append(f'место {user_id}: в базе {rank}, в таблице {actual_rank}')
+        return problems
+    
     def get_user_full(self, user_id):
         """Получение полной информации о пользователе"""
-        with self.get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute('''
-            SELECT * FROM users WHERE user_id = ?
-            ''', (user_id,))
-            columns = [column[0] for column in cur.description]
-            user = cur.fetchone()
-            return dict(zip(columns, user)) if user else None
+        return self.get_user(user_id)
     
     def get_all_users(self):
         """Получение всех пользователей"""
-        with self.get_connection() as conn:
+        with self.get_connection(write=False) as conn:
             cur = conn.cursor()
             cur.execute('SELECT user_id FROM users WHERE is_banned = FALSE')
             return [row[0] for row in cur.fetchall()]
@@ -206,19 +966,473 @@ class Database:
         with self.get_connection() as conn:
             cur = conn.cursor()
             cur.execute('''
-            INSERT INTO mining (user_id, action, amount) 
-            VALUES (?, ?, ?)
-            ''', (user_id, action, amount))
-            conn.commit()
+            INSERT INTO mining (user_id, action, amount, ts) 
+            VALUES (?, ?, ?, ?)
+            ''', (user_id, action, amount, int(time.time())))
     
     def get_user_mining_history(self, user_id, limit=10):
         """История добычи пользователя"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute(HOT_QUERIES['get_user_mining_history'], {'uid': user_id, 'limit': limit})
+            return cur.fetchall()
+    
+    def get_user_court_cases(self, user_id, limit=10):
+        """Последние судебные дела пользователя (истец или ответчик)"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute(HOT_QUERIES['get_user_court_cases'], {'uid': user_id, 'limit': limit})
+            return cur.fetchall()
+    
+    def get_passive_income_users(self):
+        """Пользователи и время последнего пассивного дохода"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT user_id, last_passive_income FROM users')
+            return cur.fetchall()
+    
+    def pay_passive_income(self, chunk_size=PASSIVE_INCOME_CHUNK):
+        """
+        Запись накопленного пассивного дохода всем пользователям сразу.
+        
+        В обычной работе не нужна (доход начисляется лениво), но полезна
+        перед сменой TRF_PER_HOUR. Выполняется пакетными UPDATE по диапазонам
+        user_id, каждый пакет - отдельная короткая транзакция.
+        Возвращает (число получивших доход, затраченное время в секундах).
+        """
+        started = time.perf_counter()
+        params = self._accrual_params()
+        paid = 0
+        last_id = -2 ** 63
+        
+        while True:
+            with self.get_connection(write=False) as conn:
+                cur = conn.cursor()
+                cur.execute('''
+                SELECT MAX(user_id) FROM (
+                    SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?
+                )
+                ''', (last_id, chunk_size))
+                upper_id = cur.fetchone()[0]
+            if upper_id is None:
+                break
+            
+            with self.get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(f'''
+                UPDATE users
+                SET trf = {_ACCRUED_TRF}, last_passive_income = {_ACCRUED_SINCE}
+                WHERE user_id > :lo AND user_id <= :hi AND {_PASSIVE_HOURS} >= 1
+                ''', dict(params, lo=last_id, hi=upper_id))
+                paid += cur.rowcount
+            self.user_cache.clear()
+            last_id = upper_id
+        
+        return paid, time.perf_counter() - started
+    
+    def get_user_balances(self):
+        """Балансы TRF всех пользователей (с учётом пассивного дохода)"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute(f'SELECT user_id, {_ACCRUED_TRF} FROM users', self._accrual_params())
+            return cur.fetchall()
+    
+    def add_chat_members(self, chat_id, user_ids):
+        """Запись участников чата (уже известные пропускаются)"""
+        with self.get_connection() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO chat_members (chat_id, user_id, joined) VALUES (?, ?, ?)',
+                [(chat_id, user_id, int(time.time())) for user_id in user_ids]
+            )
+    
+    def remove_chat_member(self, chat_id, user_id):
+        """Удаление участника, покинувшего чат"""
         with self.get_connection() as conn:
+            conn.execute('DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
+    
+    def get_chat_members(self, chat_id):
+        """Незабаненные участники чата"""
+        with self.get_connection(write=False) as conn:
             cur = conn.cursor()
-            cur.execute('''
-            SELECT action, amount, timestamp 
-            FROM mining 
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC LIMIT ?
-            ''', (user_id, limit))
-            return cur.fetchall()
\ No newline at end of file
+            cur.execute(HOT_QUERIES['get_chat_members'], {'chat_id': chat_id})
+            return [row[0] for row in cur.fetchall()]
+    
+    def get_chat_member_balances(self, chat_id):
+        """Балансы TRF участников чата (с учётом пассивного дохода)"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute(HOT_QUERIES['get_chat_member_balances'], self._accrual_params(chat_id=chat_id))
+            return cur.fetchall()
+    
+    def damage_chat_members(self, chat_id, amount):
+        """
+        Списание до amount TRF у каждого участника чата (сколько есть)
+        одним UPDATE. Балансы до списания читаются в той же транзакции.
+        Возвращает [(user_id, username, first_name, списано)].
+        """
+        params = self._accrual_params(chat_id=chat_id, amount=amount)
+        with self.transaction() as conn:
+            before = dict(conn.execute(HOT_QUERIES['get_chat_member_balances'], params).fetchall())
+            cur = conn.execute(HOT_QUERIES['damage_chat_members'], params)
+            columns = [column[0] for column in cur.description]
+            damaged = []
+            for row in cur.fetchall():
+                user = dict(zip(columns, row))
+                self._cache_user(user['user_id'], user)
+                damaged.append((user['user_id'], user['username'], user['first_name'],
+                                min(before[user['user_id']], amount)))
+        return damaged
+    
+    def _fetch_turtle_invasion(self, conn, chat_id, now):
+        cur = conn.execute(HOT_QUERIES['get_turtle_invasion'], {'chat_id': chat_id, 'now': now})
+        columns = [column[0] for column in cur.description]
+        row = cur.fetchone()
+        return TurtleInvasions.from_row(zip(columns, row)) if row else None
+    
+    def get_turtle_invasion(self, chat_id, cached=True):
+        """
+        Активное нашествие в чате или None. cached=False - только из базы
+        (когда важны действия других процессов, например перед уроном).
+        """
+        now = int(time.time())
+        if cached:
+            invasion = self.turtles.get(chat_id, now)
+            if invasion is not None:
+                return invasion
+        # Промах в кэш не записывается: чтение могло бы затереть более новую запись
+        with self.get_connection(write=False) as conn:
+            return self._fetch_turtle_invasion(conn, chat_id, now)
+    
+    def start_turtle_invasion(self, chat_id, count, ttl):
+        """Новое нашествие в чате на ttl секунд (прежнее, если было, заменяется)"""
+        now = int(time.time())
+        # Блокировка писателя держится до обновления кэша, чтобы порядок
+        # записей в кэше совпадал с порядком коммитов
+        with self._writer_lock:
+            with self.transaction() as conn:
+                cur = conn.execute('''
+                INSERT INTO turtle_invasions (chat_id, count, started, expires_at, participants)
+                VALUES (?, ?, ?, ?, X'')
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    count = excluded.count, started = excluded.started,
+                    expires_at = excluded.expires_at, participants = excluded.participants
+                RETURNING *
+                ''', (chat_id, count, now, now + ttl))
+                columns = [column[0] for column in cur.description]
+                invasion = TurtleInvasions.from_row(zip(columns, cur.fetchone()))
+                conn.execute('UPDATE chats SET turtle_active = TRUE WHERE chat_id = ?', (chat_id,))
+            self.turtles.put(invasion)
+        return invasion
+    
+    def join_turtle_defense(self, chat_id, user_id):
+        """
+        Вступление в защиту от черепашек. Возвращает (нашествие, вступил
+        ли сейчас); (None, False) - нашествия нет.
+        """
+        now = int(time.time())
+        # Повторное нажатие - без обращения к базе
+        invasion = self.turtles.get(chat_id, now)
+        if invasion is not None and user_id in invasion['participants']:
+            return invasion, False
+        
+        joined = False
+        with self._writer_lock:
+            with self.transaction() as conn:
+                invasion = self._fetch_turtle_invasion(conn, chat_id, now)
+                if invasion is not None and user_id not in invasion['participants']:
+                    invasion['participants'].add(user_id)
+                    conn.execute('UPDATE turtle_invasions SET participants = ? WHERE chat_id = ?',
+                                 (pack_ids(invasion['participants']), chat_id))
+                    joined = True
+            if invasion is None:
+                self.turtles.remove(chat_id)
+            else:
+                self.turtles.put(invasion)
+        return invasion, joined
+    
+    def end_turtle_invasion(self, chat_id):
+        """
+        Завершение нашествия (защита удалась). Возвращает его состояние
+        или None, если его уже завершили - награда выдаётся один раз.
+        """
+        with self._writer_lock:
+            with self.transaction() as conn:
+                cur = conn.execute('DELETE FROM turtle_invasions WHERE chat_id = ? RETURNING *', (chat_id,))
+                columns = [column[0] for column in cur.description]
+                row = cur.fetchone()
+                conn.execute('UPDATE chats SET turtle_active = FALSE WHERE chat_id = ?', (chat_id,))
+            self.turtles.remove(chat_id)
+        return TurtleInvasions.from_row(zip(columns, row)) if row else None
+    
+    def expire_turtle_invasions(self):
+        """Удаление истёкших нашествий. Возвращает chat_id, где черепашки ушли"""
+        with self._writer_lock:
+            with self.transaction() as conn:
+                chat_ids = [row[0] for row in conn.execute(
+                    'DELETE FROM turtle_invasions WHERE expires_at <= ? RETURNING chat_id', (int(time.time()),)
+                )]
+                conn.executemany('UPDATE chats SET turtle_active = FALSE WHERE chat_id = ?',
+                                 [(chat_id,) for chat_id in chat_ids])
+            for chat_id in chat_ids:
+                self.turtles.remove(chat_id)
+        return chat_ids
+    
+    def claim_due_chats(self, limit, interval=DANGER_INTERVAL, shard=(0, 1)):
+        """
+        Чаты, которым пора получить опасность (не больше limit, самые
+        просроченные первыми). Их срок в том же UPDATE сдвигается на целое
+        число интервалов, так что смещение чата сохраняется, а после простоя
+        опасность не повторяется за каждый пропущенный интервал.
+        shard - (номер, всего): только чаты этого процесса-обработчика
+        (shards.shard_of; остаток берётся неотрицательным, как в Python).
+        """
+        now = int(time.time())
+        with self.transaction() as conn:
+            # Чаты без места в расписании (созданы до миграции 6)
+            unscheduled = [row[0] for row in conn.execute(
+                'SELECT chat_id FROM chats WHERE next_danger_at IS NULL LIMIT ?', (limit,)
+            )]
+            conn.executemany('UPDATE chats SET next_danger_at = ? WHERE chat_id = ?',
+                             [(next_danger_at(chat_id, now, interval), chat_id) for chat_id in unscheduled])
+            
+            cur = conn.execute(HOT_QUERIES['claim_due_chats'], {
+                'now': now, 'now_iso': datetime.now().isoformat(),
+                'interval': interval, 'limit': limit, 'shard': shard[0], 'shards': shard[1]
+            })
+            return [row[0] for row in cur.fetchall()]
+    
+    def register_job(self, name, interval, first=0):
+        """
+        Регистрация фоновой задачи. Для новой задачи первый запуск через
+        first секунд; у существующей сохраняется записанное время запуска.
+        """
+        with self.get_connection() as conn:
+            conn.execute('''
+            INSERT INTO jobs (name, interval, next_run) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET interval = excluded.interval
+            ''', (name, interval, int(time.time()) + first))
+    
+    def claim_due_jobs(self, names, owner, lease):
+        """
+        Захват аренды задач из names, которым пора выполняться
+        и которые никто не выполняет (или чья аренда истекла).
+        Возвращает [(name, next_run, interval)].
+        """
+        if not names:
+            return []
+        now = int(time.time())
+        params = {'owner': owner, 'now': now, 'until': now + lease}
+        params.update((f'n{i}', name) for i, name in enumerate(names))
+        with self.get_connection() as conn:
+            cur = conn.execute(f'''
+            UPDATE jobs SET lease_owner = :owner, lease_until = :until
+            WHERE name IN ({', '.join(f':n{i}' for i in range(len(names)))})
+              AND next_run <= :now
+              AND (lease_until IS NULL OR lease_until < :now)
+            RETURNING name, next_run, interval
+            ''', params)
+            return cur.fetchall()
+    
+    def finish_job(self, name, owner, started, duration):
+        """
+        Завершение запуска: следующее время - ближайшее по сетке interval
+        после текущего момента. Пропущенные за простой запуски не
+        повторяются по одному, а считаются в missed.
+        """
+        now = int(time.time())
+        with self.get_connection() as conn:
+            conn.execute('''
+            UPDATE jobs
+            SET missed = missed + MAX(0, (:now - next_run) / interval),
+                next_run = next_run + interval * ((:now - next_run) / interval + 1),
+                last_run = :started, last_duration = :duration, runs = runs + 1,
+                lease_owner = NULL, lease_until = NULL
+            WHERE name = :name AND lease_owner = :owner
+            ''', {'now': now, 'started': int(started), 'duration': duration,
+                  'name': name, 'owner': owner})
+    
+    def release_jobs(self, owner):
+        """Снятие всех аренд процесса без сдвига расписания"""
+        with self.get_connection() as conn:
+            conn.execute('UPDATE jobs SET lease_owner = NULL, lease_until = NULL WHERE lease_owner = ?',
+                         (owner,))
+    
+    def next_job_run(self, names):
+        """Ближайшее время запуска среди свободных задач names (unix) или None"""
+        if not names:
+            return None
+        with self.get_connection(write=False) as conn:
+            cur = conn.execute(
+                f"SELECT MIN(next_run) FROM jobs WHERE name IN ({', '.join('?' * len(names))}) "
+                f"AND (lease_until IS NULL OR lease_until < ?)",
+                list(names) + [int(time.time())]
+            )
+            return cur.fetchone()[0]
+    
+    def set_timer(self, kind, key, fire_at, payload=None):
+        """Таймер kind для key на unix-время fire_at (заменяет прежний)"""
+        with self.get_connection() as conn:
+            conn.execute('''
+            INSERT INTO timers (kind, key, fire_at, payload) VALUES (?, ?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET fire_at = excluded.fire_at, payload = excluded.payload
+            ''', (kind, key, fire_at, payload))
+    
+    def cancel_timer(self, kind, key):
+        with self.get_connection() as conn:
+            cur = conn.execute('DELETE FROM timers WHERE kind = ? AND key = ?', (kind, key))
+            return cur.rowcount > 0
+    
+    def get_timers(self):
+        """Все отложенные таймеры: [(kind, key, fire_at, payload)]"""
+        with self.get_connection(write=False) as conn:
+            return conn.execute('SELECT kind, key, fire_at, payload FROM timers').fetchall()
+    
+    def claim_timers(self, timers, lease_until):
+        """
+        Захват сработавших таймеров [(kind, key, fire_at)] одной транзакцией:
+        срок переносится на lease_until, запись остаётся до release_timers.
+        Возвращает только те, что захватил этот вызов: таймер, который успели
+        перенести или уже забрал другой процесс, не срабатывает дважды.
+        Если процесс не отчитается, таймер сработает снова после lease_until.
+        """
+        claimed = []
+        with self.transaction() as conn:
+            for kind, key, fire_at in timers:
+                if conn.execute('UPDATE timers SET fire_at = ? WHERE kind = ? AND key = ? AND fire_at = ?',
+                                (lease_until, kind, key, fire_at)).rowcount:
+                    claimed.append((kind, key))
+        return claimed
+    
+    def release_timers(self, timers, lease_until, retry_at=None):
+        """
+        Захваченные таймеры [(kind, key)]: выполненные удаляются, при
+        retry_at - переносятся на повтор. Таймер, заново назначенный
+        после захвата (срок уже не lease_until), не трогается.
+        """
+        with self.transaction() as conn:
+            for kind, key in timers:
+                if retry_at is None:
+                    conn.execute('DELETE FROM timers WHERE kind = ? AND key = ? AND fire_at = ?',
+                                 (kind, key, lease_until))
+                else:
+                    conn.execute('UPDATE timers SET fire_at = ? WHERE kind = ? AND key = ? AND fire_at = ?',
+                                 (retry_at, kind, key, lease_until))
+    
+    def clear_chat_flag(self, chat_ids, flag):
+        """Сброс флага опасности (co2_active, turtle_active) сразу у нескольких чатов"""
+        if flag not in ('co2_active', 'turtle_active'):
+            raise ValueError(f"Неизвестный флаг: {flag}")
+        if not chat_ids:
+            return
+        with self.get_connection() as conn:
+            conn.execute(f"UPDATE chats SET {flag} = FALSE WHERE chat_id IN ({', '.join('?' * len(chat_ids))})",
+                         list(chat_ids))
+    
+    def get_jobs(self):
+        """Состояние фоновых задач"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM jobs ORDER BY name')
+            columns = [column[0] for column in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+    
+    def get_all_chats(self):
+        """Идентификаторы всех чатов"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT chat_id FROM chats')
+            return [row[0] for row in cur.fetchall()]
+    
+    def get_stats(self):
+        """Сводная статистика для админа"""
+        with self.get_connection(write=False) as conn:
+            cur = conn.cursor()
+            
+            cur.execute('SELECT COUNT(*) FROM users')
+            user_count = cur.fetchone()[0]
+            
+            cur.execute('SELECT COUNT(*) FROM court_cases')
+            case_count = cur.fetchone()[0]
+            
+            cur.execute(f'SELECT SUM({_ACCRUED_TRF}), SUM(kkl) FROM users', self._accrual_params())
+            total_trf, total_kkl = cur.fetchone()
+        
+        return {
+            'user_count': user_count,
+            'case_count': case_count,
+            'total_trf': total_trf or 0,
+            'total_kkl': total_kkl or 0,
+            'user_cache': self.user_cache.stats()
+        }
+    
+    def explain_query_plans(self):
+        """План выполнения каждого горячего запроса: {имя: [шаги плана]}"""
+        plans = {}
+        with self.get_connection(write=False) as conn:
+            for name, sql in HOT_QUERIES.items():
+                sql = sql.format(score=self._score_sql)
+                params = {key: None for key in re.findall(r':(\w+)', sql)}
+                rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+                plans[name] = [row[3] for row in rows]
+        return plans
+    
+    def audit_query_plans(self):
+        """Горячие запросы, скатившиеся в полный просмотр таблицы: {имя: план}"""
+        return {name: plan for name, plan in self.explain_query_plans().items()
+                if any(_FULL_SCAN.match(step) for step in plan)}
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database для обработчиков.
+    
+    Каждый вызов метода выполняется в отдельном пуле потоков, поэтому fsync
+    или ожидание блокировки задерживают только ту команду, которая их вызвала,
+    а не весь event loop. Очередь ограничена: при переполнении новые запросы
+    ждут свободного места, а не копятся без предела.
+    """
+    def __init__(self, db, workers=DB_EXECUTOR_WORKERS, max_pending=DB_MAX_PENDING):
+        self.sync = db
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+        self._slots = asyncio.Semaphore(max_pending)
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполнение произвольной синхронной функции в потоке базы"""
+        started = time.perf_counter()
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._executor, functools.partial(func, *args, **kwargs)
+                )
+        finally:
+            # Вместе с ожиданием очереди - столько команда ждала базу
+            metrics.add_db_time(time.perf_counter() - started)
+    
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+        
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        # Кэшируем обёртку, чтобы не создавать её на каждый вызов
+        setattr(self, name, method)
+        return method
+    
+    async def run_in_transaction(self, func, *args, **kwargs):
+        """
+        Выполнение func(database, *args) внутри Database.transaction()
+        в потоке базы - для операций над несколькими пользователями сразу
+        """
+        def call():
+            with self.sync.transaction():
+                return func(self.sync, *args, **kwargs)
+        return await self.run(call)
+    
+    def close(self):
+        """Дожидаемся выполнения запросов и закрываем соединения"""
+        self._executor.shutdown(wait=True)
+        self.sync.close()
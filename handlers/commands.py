@@ -1,9 +1,9 @@
 import random
-from datetime import datetime
 from telegram import Update
 from telegram.ext import ContextTypes
-from database import Database
-from utils import generate_news, get_random_axiom, calculate_ph, format_time_remaining
+from database import AsyncDatabase
+from outbound import reply
+from utils import generate_news, get_random_axiom, calculate_ph
 
 # Вспомогательная функция для упоминаний
 def format_user_mention_simple(user_id: int, username: str = None, first_name: str = None) -> str:
@@ -17,12 +17,12 @@ def format_user_mention_simple(user_id: int, username: str = None, first_name: s
     else:
         return f'<a href="tg://user?id={user_id}">Пользователь</a>'
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     user_id = update.effective_user.id
     username = update.effective_user.username
     first_name = update.effective_user.first_name
     
-    db.create_user(user_id, username, first_name)
+    await db.create_user(user_id, username, first_name)
     
     welcome_text = """🧪 Добро пожаловать в Торфяную Сеть
 
@@ -50,14 +50,14 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db:
 
 Да хранит вас Торфяной Конгресс"""
     
-    await update.message.reply_text(welcome_text)
+    await reply(update, welcome_text)
 
-async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
-        await update.message.reply_text("Ошибка: пользователь не найден! Напишите /start")
+        await reply(update, "Ошибка: пользователь не найден! Напишите /start")
         return
     
     # Расчет риска перфорации
@@ -88,16 +88,16 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db:
 📅 В сети с: {user['created'][:10]}
 🚫 Бан: {"ДА" if user['is_banned'] else "НЕТ"}"""
     
-    await update.message.reply_text(status_text)
+    await reply(update, status_text)
 
-async def diagnostika_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def diagnostika_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     chat_id = update.effective_chat.id
-    chat_data = db.get_chat(chat_id)
+    chat_data = await db.get_chat(chat_id)
     
     ph = calculate_ph()
     
     # Обновляем pH в БД
-    db.update_chat(chat_id, ph_level=ph)
+    await db.update_chat(chat_id, ph_level=ph)
     
     # Генерация диагноза
     if ph < 4.0:
@@ -133,21 +133,22 @@ async def diagnostika_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 Последняя опасность: {chat_data.get('last_danger', 'не зафиксирована')}"""
     
-    await update.message.reply_text(report)
+    await reply(update, report)
 
-async def aksioma_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def aksioma_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     axiom = get_random_axiom()
-    await update.message.reply_text(f"📜 Аксиома Торфяного Конгресса\n\n«{axiom}»")
+    await reply(update, f"📜 Аксиома Торфяного Конгресса\n\n«{axiom}»")
 
-async def novosti_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def novosti_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     news = generate_news()
-    await update.message.reply_text(f"📰 НОВОСТИ ТОРФЯНОГО КОНГРЕССА\n\n{news}")
+    await reply(update, f"📰 НОВОСТИ ТОРФЯНОГО КОНГРЕССА\n\n{news}")
 
-async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
-    top_users = db.get_top_users(10)
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
+    # Таблица лидеров в памяти, без запроса к базе
+    top_users = db.leaderboard.top(10)
     
     if not top_users:
-        await update.message.reply_text("📊 Топ пуст. Начните добывать торф!")
+        await reply(update, "📊 Топ пуст. Начните добывать торф!")
         return
     
     text = "🏆 <b>ТОП ХРАНИТЕЛЕЙ ТОРФЯНОЙ СЕТИ</b>\n\n"
@@ -172,15 +173,33 @@ async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Da
     
     text += "\n👆 Имена кликабельны, но не упоминают пользователей"
     
-    await update.message.reply_text(text, parse_mode="HTML")
+    await reply(update, text, parse_mode="HTML")
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def rank_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
+    """Место пользователя в топе по TRF"""
+    rank = db.leaderboard.rank(update.effective_user.id)
+    
+    if not rank:
+        await reply(update, "❌ Вы ещё не в Сети. Начните с /start")
+        return
+    
+    place, total = rank
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    
+    text = f"""🏅 <b>ВАШЕ МЕСТО В ТОРФЯНОЙ СЕТИ</b>
+
+{medals.get(place, "📊")} Место: <code>{place}</code> из <code>{total}</code>"""
+    
+    await reply(update, text, parse_mode="HTML")
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     help_text = """🆘 ПОМОЩЬ ПО ТОРФОБОТУ
 
 <b>Основные команды:</b>
 /start — начало работы
 /status — ваш статус
 /top — топ пользователей
+/rank — ваше место в топе
 /help — эта справка
 
 <b>Диагностика и лечение:</b>
@@ -217,24 +236,15 @@ KKL (Клетчатка) — премиум валюта
 
 ⚠️ <b>Опасности появляются автоматически раз в 3 часа</b>"""
     
-    await update.message.reply_text(help_text, parse_mode="HTML")
+    await reply(update, help_text, parse_mode="HTML")
 
-async def moi_dela_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def moi_dela_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     user_id = update.effective_user.id
     
-    with db.get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute('''
-        SELECT court_type, verdict, result, timestamp 
-        FROM court_cases 
-        WHERE plaintiff_id = ? OR defendant_id = ?
-        ORDER BY timestamp DESC LIMIT 10
-        ''', (user_id, user_id))
-        
-        cases = cur.fetchall()
+    cases = await db.get_user_court_cases(user_id, 10)
     
     if not cases:
-        await update.message.reply_text("📂 У вас нет судебных дел.")
+        await reply(update, "📂 У вас нет судебных дел.")
         return
     
     text = "⚖️ <b>ВАШИ СУДЕБНЫЕ ДЕЛА</b>\n\n"
@@ -246,32 +256,31 @@ async def moi_dela_command(update: Update, context: ContextTypes.DEFAULT_TYPE, d
         text += f"   🏛️ Результат: {result}\n"
         text += f"   📅 {timestamp[:16]}\n\n"
     
-    await update.message.reply_text(text, parse_mode="HTML")
+    await reply(update, text, parse_mode="HTML")
 
-async def vnesti_izvest_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def vnesti_izvest_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     try:
         user_id = update.effective_user.id
-        user = db.get_user(user_id)
         
-        if not user:
-            await update.message.reply_text("❌ Пользователь не найден. Напишите /start")
-            return
+        # Снимаем KKL (атомарно, с проверкой баланса)
+        user = await db.spend(user_id, kkl=2)
         
-        if user['kkl'] < 2:
-            await update.message.reply_text("❌ Недостаточно клетчатки для известкования! Нужно 2 KKL.")
+        if not user:
+            if not await db.get_user(user_id):
+                await reply(update, "❌ Пользователь не найден. Напишите /start")
+            else:
+                await reply(update, "❌ Недостаточно клетчатки для известкования! Нужно 2 KKL.")
             return
         
-        # Снимаем KKL
-        new_kkl = user['kkl'] - 2
-        db.update_user(user_id, kkl=new_kkl)
+        new_kkl = user['kkl']
         
         # Улучшаем pH чата
         chat_id = update.effective_chat.id
-        chat_data = db.get_chat(chat_id)
+        chat_data = await db.get_chat(chat_id)
         
         old_ph = chat_data.get('ph_level', 5.0)
         new_ph = min(7.0, old_ph + random.uniform(0.3, 0.8))
-        db.update_chat(chat_id, ph_level=round(new_ph, 1))
+        await db.update_chat(chat_id, ph_level=round(new_ph, 1))
         
         # Формируем ответ
         username = update.effective_user.username
@@ -284,29 +293,29 @@ async def vnesti_izvest_command(update: Update, context: ContextTypes.DEFAULT_TY
 pH чата улучшен: {old_ph:.1f} → {new_ph:.1f}
 Списано: 2 KKL | Осталось: {new_kkl} KKL"""
         
-        await update.message.reply_text(response)
+        await reply(update, response)
         
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        await reply(update, f"❌ Ошибка: {str(e)}")
 
-async def podkormit_torfom_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def podkormit_torfom_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
     
-    if not user or user['trf'] < 20:
-        await update.message.reply_text("❌ Недостаточно торфа для подкормки! Нужно 20 TRF.")
+    # Снимаем торф
+    user = await db.spend(user_id, trf=20)
+    
+    if not user:
+        await reply(update, "❌ Недостаточно торфа для подкормки! Нужно 20 TRF.")
         return
     
-    # Снимаем торф
-    new_trf = user['trf'] - 20
-    db.update_user(user_id, trf=new_trf)
+    new_trf = user['trf']
     
     # Улучшаем pH чата
     chat_id = update.effective_chat.id
-    chat_data = db.get_chat(chat_id)
+    chat_data = await db.get_chat(chat_id)
     old_ph = chat_data.get('ph_level', 5.0)
     new_ph = min(6.5, old_ph + random.uniform(0.1, 0.4))
-    db.update_chat(chat_id, ph_level=round(new_ph, 1))
+    await db.update_chat(chat_id, ph_level=round(new_ph, 1))
     
     # Формируем ответ
     username = update.effective_user.username
@@ -320,28 +329,28 @@ pH чата улучшен: {old_ph:.1f} → {new_ph:.1f}
 Списано: 20 TRF | Осталось: {new_trf} TRF
 🌱 Микориза благодарна!"""
     
-    await update.message.reply_text(response)
+    await reply(update, response)
 
-async def podkislit_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def podkislit_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
     
-    if not user or user['kkl'] < 3:
-        await update.message.reply_text("❌ Недостаточно клетчатки для подкисления! Нужно 3 KKL.")
+    # Снимаем клетчатку
+    user = await db.spend(user_id, kkl=3)
+    
+    if not user:
+        await reply(update, "❌ Недостаточно клетчатки для подкисления! Нужно 3 KKL.")
         return
     
-    # Снимаем клетчатку
-    new_kkl = user['kkl'] - 3
-    db.update_user(user_id, kkl=new_kkl)
+    new_kkl = user['kkl']
     
     # Слегка подкисляем чат (если слишком щелочной)
     chat_id = update.effective_chat.id
-    chat_data = db.get_chat(chat_id)
+    chat_data = await db.get_chat(chat_id)
     current_ph = chat_data.get('ph_level', 5.0)
     
     if current_ph > 6.5:
         new_ph = max(5.5, current_ph - random.uniform(0.2, 0.5))
-        db.update_chat(chat_id, ph_level=round(new_ph, 1))
+        await db.update_chat(chat_id, ph_level=round(new_ph, 1))
         
         username = update.effective_user.username
         if username:
@@ -354,31 +363,31 @@ pH чата снижен: {current_ph:.1f} → {new_ph:.1f}
 Списано: 3 KKL | Осталось: {new_kkl} KKL
 💧 Баланс восстановлен!"""
         
-        await update.message.reply_text(response)
+        await reply(update, response)
     else:
-        await update.message.reply_text("ℹ️ Чату не требуется подкисление. pH в норме.")
+        await reply(update, "ℹ️ Чату не требуется подкисление. pH в норме.")
 
-async def ekstr_sredstvo_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def ekstr_sredstvo_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
     
-    if not user or user['kkl'] < 10:
-        await update.message.reply_text("❌ Недостаточно клетчатки для экстренных мер! Нужно 10 KKL.")
+    # Снимаем клетчатку
+    user = await db.spend(user_id, kkl=10)
+    
+    if not user:
+        await reply(update, "❌ Недостаточно клетчатки для экстренных мер! Нужно 10 KKL.")
         return
     
-    # Снимаем клетчатку
-    new_kkl = user['kkl'] - 10
-    db.update_user(user_id, kkl=new_kkl)
+    new_kkl = user['kkl']
     
     # Экстренное восстановление pH
     chat_id = update.effective_chat.id
-    chat_data = db.get_chat(chat_id)
+    chat_data = await db.get_chat(chat_id)
     current_ph = chat_data.get('ph_level', 5.0)
     
     if current_ph < 4.0 or current_ph > 8.0:
         # Критическое значение - сбрасываем к норме
         new_ph = random.uniform(5.5, 6.5)
-        db.update_chat(chat_id, ph_level=round(new_ph, 1))
+        await db.update_chat(chat_id, ph_level=round(new_ph, 1))
         
         username = update.effective_user.username
         if username:
@@ -391,39 +400,38 @@ pH чата нормализован: {current_ph:.1f} → {new_ph:.1f}
 Списано: 10 KKL | Осталось: {new_kkl} KKL
 ✅ Кризис миновал!"""
         
-        await update.message.reply_text(response)
+        await reply(update, response)
     else:
-        await update.message.reply_text("ℹ️ Экстренные меры не требуются. pH в допустимых пределах.")
+        await reply(update, "ℹ️ Экстренные меры не требуются. pH в допустимых пределах.")
 
-async def lechit_perforaciyu_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def lechit_perforaciyu_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
-        await update.message.reply_text("❌ Пользователь не найден!")
+        await reply(update, "❌ Пользователь не найден!")
         return
     
     if user['perforation_count'] == 0:
-        await update.message.reply_text("ℹ️ У вас нет перфораций для лечения.")
+        await reply(update, "ℹ️ У вас нет перфораций для лечения.")
         return
     
     if user['kkl'] < 15:
-        await update.message.reply_text("❌ Недостаточно клетчатки для лечения! Нужно 15 KKL.")
+        await reply(update, "❌ Недостаточно клетчатки для лечения! Нужно 15 KKL.")
         return
     
-    # Лечение
-    new_kkl = user['kkl'] - 15
-    new_health = min(100, user['health'] + 30)
-    db.update_user(user_id, 
-                  kkl=new_kkl,
-                  perforation_count=0,
-                  health=new_health)
+    # Лечение: списание и сброс перфораций одним запросом
+    treated = await db.spend(user_id, kkl=15, perforation_count=0)
+    if not treated:
+        await reply(update, "❌ Недостаточно клетчатки для лечения! Нужно 15 KKL.")
+        return
+    treated = await db.increment_user(user_id, health=30)
     
-    await update.message.reply_text(
+    await reply(update, 
         f"💊 Лечение перфорации завершено!\n"
         f"🩸 Перфораций: {user['perforation_count']} → 0\n"
-        f"🫀 Здоровье: {user['health']}% → {new_health}%\n"
-        f"Списано: 15 KKL | Осталось: {new_kkl} KKL\n"
+        f"🫀 Здоровье: {user['health']}% → {treated['health']}%\n"
+        f"Списано: 15 KKL | Осталось: {treated['kkl']} KKL\n"
         f"✅ Вы здоровы!"
     )
 
@@ -431,4 +439,4 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка обычных сообщений"""
     if update.message.text.startswith('/'):
         return
-    await update.message.reply_text(f"Получено: {update.message.text}")
\ No newline at end of file
+    await reply(update, f"Получено: {update.message.text}")
\ No newline at end of file
@@ -1,256 +1,323 @@
 import asyncio
+import json
+import logging
 import random
 from datetime import datetime, timedelta
 from telegram import Update
 from telegram.ext import ContextTypes
-from database import Database
+from database import Database, AsyncDatabase
+import outbound
+import timers
+from outbound import reply
 from utils import get_court_verdict, format_time_remaining
-from config import COURT_COSTS
+from config import COURT_COSTS, COURT_HEARING_SECONDS
 
-async def sud_selezenki_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
-    # Проверка формата - нужен ответ на сообщение
-    if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Используйте команду ответом на сообщение пользователя!")
-        return
-    
-    plaintiff_id = update.effective_user.id
-    plaintiff = db.get_user(plaintiff_id)
-    
-    if not plaintiff or plaintiff['kkl'] < COURT_COSTS["selezenka"]:
-        await update.message.reply_text(f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['selezenka']} KKL.")
-        return
-    
-    # Определяем ответчика из ответа на сообщение
-    defendant_id = update.message.reply_to_message.from_user.id
-    defendant = db.get_user(defendant_id)
-    
-    if not defendant:
-        await update.message.reply_text("❌ Ответчик не зарегистрирован в системе!")
-        return
-    
-    # Нельзя судить себя
-    if plaintiff_id == defendant_id:
-        await update.message.reply_text("❌ Нельзя подать в суд на самого себя!")
-        return
-    
-    # Проверяем бан ответчика
-    if defendant and defendant.get('is_banned'):
-        await update.message.reply_text("❌ Этот пользователь уже изгнан в болото!")
-        return
-    
-    # Снимаем KKL с истца
-    new_kkl = plaintiff['kkl'] - COURT_COSTS["selezenka"]
-    db.update_user(plaintiff_id, kkl=new_kkl)
-    
-    await update.message.reply_text("⚖️ Идёт заседание Суда Двенадцатиперстной Селезёнки...")
-    
-    # Имитация заседания
-    await asyncio.sleep(2)
-    
-    # Вердикт
+logger = logging.getLogger(__name__)
+
+# Ожидающие отправки объявления заседаний (ссылки, чтобы задачи не собрал GC)
+_announcements = set()
+
+# Операции над несколькими пользователями выполняются в потоке базы
+# внутри Database.transaction() (см. AsyncDatabase.run_in_transaction)
+
+def _add_warning(database: Database, user_id):
+    """Предупреждение; третье подряд превращается в перфорацию"""
+    user = database.increment_user(user_id, warnings=1)
+    warnings = user['warnings']
+    if warnings >= 3:
+        database.update_user(user_id, warnings=0)
+        database.increment_user(user_id, perforation_count=1, health=-30)
+    return warnings
+
+def _fine_for_photosynthesis(database: Database, defendant_id, plaintiff_id, fine):
+    """Штраф ответчика и +2 KKL истцу, либо ничего при нехватке TRF"""
+    if database.spend(defendant_id, trf=fine) is None:
+        return False
+    database.add_balance(plaintiff_id, kkl=2)
+    return True
+
+def _exile(database: Database, defendant_id, plaintiff_id, ban_until):
+    """Изгнание ответчика и конфискация до 100 TRF в пользу истца"""
+    database.update_user(defendant_id,
+                         is_banned=True,
+                         banned_until=ban_until,
+                         warnings=0,
+                         health=50)
+    return database.transfer_trf(defendant_id, plaintiff_id, 100, partial=True)
+
+# Заседание не держит обработчик: списание KKL и запись дела - одним коммитом,
+# вердикт выносит таймер court_hearing (см. complete_hearings), даже после
+# перезапуска бота
+
+def _open_hearing(database: Database, court_type, plaintiff_id, defendant_id, chat_id):
+    """Списание KKL с истца и новое заседание; None при нехватке клетчатки"""
+    if database.spend(plaintiff_id, kkl=COURT_COSTS[court_type]) is None:
+        return None
+    hearing = database.add_court_hearing(court_type, plaintiff_id, defendant_id,
+                                         chat_id, COURT_COSTS[court_type])
+    # Таймер в той же транзакции: заседание не потеряется, даже если
+    # процесс остановится до объявления
+    hearing['fire_at'] = datetime.now().timestamp() + COURT_HEARING_SECONDS[court_type]
+    database.set_timer("court_hearing", hearing['hearing_id'], hearing['fire_at'],
+                       json.dumps({'chat_id': chat_id}))
+    return hearing
+
+async def _remember_announcement(db: AsyncDatabase, hearing_id, sent):
+    """message_id объявления - для замены вердиктом, когда оно дойдёт"""
+    try:
+        message = await sent
+        if message:
+            await db.set_court_hearing_message(hearing_id, message.message_id)
+    except Exception:
+        # Без message_id вердикт придёт новым сообщением
+        logger.exception("Не удалось запомнить объявление заседания %s", hearing_id)
+
+async def start_hearing(update: Update, db: AsyncDatabase, court_type, defendant_id, announcement):
+    """Открытие заседания и объявление о нём; False при нехватке клетчатки"""
+    hearing = await db.run_in_transaction(_open_hearing, court_type, update.effective_user.id,
+                                          defendant_id, update.effective_chat.id)
+    if hearing is None:
+        return False
+    
+    # Таймер уже в базе (_open_hearing) - только в кучу службы
+    timers.track("court_hearing", hearing['hearing_id'], hearing['fire_at'],
+                 payload={'chat_id': hearing['chat_id']})
+    
+    # Объявление не ждёт отправки: обработчик держит блокировки сторон,
+    # а группа с лимитом может ждать минутами. message_id запишется,
+    # когда сообщение дойдёт
+    sent = await reply(update, announcement)
+    if asyncio.isfuture(sent):
+        task = asyncio.create_task(_remember_announcement(db, hearing['hearing_id'], sent))
+        _announcements.add(task)
+        task.add_done_callback(_announcements.discard)
+    elif sent:
+        await db.set_court_hearing_message(hearing['hearing_id'], sent.message_id)
+    return True
+
+def _judge_selezenka(database: Database, hearing):
     verdict_text, fine = get_court_verdict("selezenka")
     
     # Случайный результат
     result = random.choice(["guilty", "not_guilty", "warning"])
     
     if "виновен" in verdict_text.lower() or result == "guilty":
-        # Обвинительный приговор
-        if defendant['trf'] >= fine:
-            # Штраф
-            new_def_trf = defendant['trf'] - fine
-            db.update_user(defendant_id, trf=new_def_trf)
+        # Обвинительный приговор: штраф переходит от ответчика истцу
+        if database.transfer_trf(hearing['defendant_id'], hearing['plaintiff_id'], fine) is not None:
             result_msg = f"Штраф {fine} TRF"
-            
-            # Добавляем TRF в общий фонд (или истцу)
-            new_pla_trf = plaintiff['trf'] + fine
-            db.update_user(plaintiff_id, trf=new_pla_trf)
         else:
             # Предупреждение
-            warnings = defendant.get('warnings', 0) + 1
-            db.update_user(defendant_id, warnings=warnings)
+            warnings = _add_warning(database, hearing['defendant_id'])
             result_msg = f"Предупреждение {warnings}/3"
             
             if warnings >= 3:
                 # Перфорация!
-                perforation_count = defendant.get('perforation_count', 0) + 1
-                db.update_user(defendant_id, 
-                              perforation_count=perforation_count,
-                              warnings=0,
-                              health=max(0, defendant.get('health', 100) - 30))
                 result_msg = "АНАЛЬНАЯ ПЕРФОРАЦИЯ! Отправлен в суглинки на лечение!"
     else:
         result_msg = "Оправдан"
     
-    # Запись дела
-    db.add_court_case(plaintiff_id, defendant_id, "selezenka", verdict_text, fine, result_msg)
+    return {'verdict': verdict_text, 'fine': fine, 'result': result_msg}
+
+def _judge_redodendron(database: Database, hearing):
+    verdict_text, fine = get_court_verdict("redodendron")
+    
+    # Шанс 70% на обвинение
+    if random.random() < 0.7:
+        # Обвинение
+        # Клетчатка в фонд чата (упрощенная реализация - просто начисляем истцу +2 KKL)
+        if _fine_for_photosynthesis(database, hearing['defendant_id'], hearing['plaintiff_id'], fine):
+            result_msg = f"Штраф {fine} TRF, истец получает 2 KKL"
+        else:
+            # Альтернативное наказание
+            health_loss = random.randint(10, 30)
+            database.increment_user(hearing['defendant_id'], health=-health_loss)
+            result_msg = f"Потеря здоровья: -{health_loss}%"
+    else:
+        result_msg = "Оправдан. Иск отклонён"
+    
+    return {'verdict': verdict_text, 'fine': fine, 'result': result_msg}
+
+def _judge_kishka(database: Database, hearing):
+    verdict_text, fine = get_court_verdict("kishka")
+    ban_until = None
     
-    # Формируем ответ
-    plaintiff_name = f"@{plaintiff['username']}" if plaintiff.get('username') else plaintiff.get('first_name', 'Пользователь')
-    defendant_name = f"@{defendant['username']}" if defendant.get('username') else defendant.get('first_name', 'Пользователь')
+    # 50% шанс на изгнание
+    if random.random() < 0.5 and "изгнан" in verdict_text.lower():
+        # Изгнание на 24 часа и штраф в пользу истца
+        ban_until = datetime.now() + timedelta(hours=24)
+        penalty = _exile(database, hearing['defendant_id'], hearing['plaintiff_id'], ban_until.isoformat())
+        # В базе бан снимется по таймеру; проверка бана смотрит на срок и без него
+        database.set_timer("ban_expire", hearing['defendant_id'], ban_until.timestamp())
+        
+        result_msg = "ИЗГНАН В БОЛОТО НА 24 ЧАСА!"
+        
+        if penalty:
+            result_msg += f"\nКонфисковано {penalty} TRF в пользу истца"
+    else:
+        result_msg = "Дело отклонено. Недостаточно доказательств."
     
-    response = f"""⚖️ <b>ВЕРДИКТ СУДА СЕЛЕЗЁНКИ</b>
+    return {'verdict': verdict_text, 'fine': fine, 'result': result_msg, 'ban_until': ban_until}
+
+# Суд: (заголовок вердикта, решение)
+COURTS = {
+    "selezenka": ("⚖️ <b>ВЕРДИКТ СУДА СЕЛЕЗЁНКИ</b>", _judge_selezenka),
+    "redodendron": ("🌿 <b>ВЕРДИКТ СУДА РЕДОДЕНДРОНА</b>", _judge_redodendron),
+    "kishka": ("🩸 <b>ВЕРДИКТ СУДА ПРЯМОЙ КИШКИ</b>", _judge_kishka),
+}
+
+def _close_hearing(database: Database, hearing_id):
+    """Вердикт, наказание и запись дела - одной транзакцией; None, если дело уже решено"""
+    hearing = database.take_court_hearing(hearing_id)
+    if hearing is None:
+        return None
+    _, judge = COURTS[hearing['court_type']]
+    outcome = judge(database, hearing)
+    database.add_court_case(hearing['plaintiff_id'], hearing['defendant_id'], hearing['court_type'],
+                            outcome['verdict'], outcome['fine'], outcome['result'])
+    outcome['hearing'] = hearing
+    outcome['plaintiff'] = database.get_user(hearing['plaintiff_id'])
+    outcome['defendant'] = database.get_user(hearing['defendant_id'])
+    return outcome
+
+def _user_name(user):
+    if not user:
+        return 'Пользователь'
+    return f"@{user['username']}" if user.get('username') else user.get('first_name', 'Пользователь')
+
+def _verdict_message(outcome):
+    hearing = outcome['hearing']
+    title, _ = COURTS[hearing['court_type']]
+    response = f"""{title}
 
-👤 <b>Истец:</b> {plaintiff_name}
-👤 <b>Ответчик:</b> {defendant_name}
+👤 <b>Истец:</b> {_user_name(outcome['plaintiff'])}
+👤 <b>Ответчик:</b> {_user_name(outcome['defendant'])}
 
-📜 <b>Приговор:</b> {verdict_text}
+📜 <b>Приговор:</b> {outcome['verdict']}
 
-🏛️ <b>Результат:</b> {result_msg}
+🏛️ <b>Результат:</b> {outcome['result']}
 
-💰 <b>С истца списано:</b> {COURT_COSTS['selezenka']} KKL
-💎 <b>Баланс истца:</b> {new_kkl} KKL"""
+💰 <b>С истца списано:</b> {hearing['cost']} KKL"""
     
-    await update.message.reply_text(response, parse_mode="HTML")
+    if hearing['court_type'] == "selezenka" and outcome['plaintiff']:
+        response += f"\n💎 <b>Баланс истца:</b> {outcome['plaintiff']['kkl']} KKL"
+    elif hearing['court_type'] == "kishka":
+        response += "\n⚠️ <b>Высшая мера применена!</b>"
+    return response
 
-async def sud_redodendrona_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def complete_hearings(due, db: AsyncDatabase):
+    """Вердикты заседаний, чьё время вышло: таймеры court_hearing"""
+    for hearing_id, _ in due:
+        outcome = await db.run_in_transaction(_close_hearing, hearing_id)
+        if outcome is None:
+            continue
+        
+        hearing = outcome['hearing']
+        if outcome.get('ban_until'):
+            # Таймер записан вместе с вердиктом (_judge_kishka) - только в кучу
+            timers.track("ban_expire", hearing['defendant_id'], outcome['ban_until'].timestamp())
+        
+        # Объявление о заседании заменяется вердиктом
+        text = _verdict_message(outcome)
+        if hearing['message_id']:
+            await outbound.enqueue(hearing['chat_id'], text, method='edit_message_text',
+                                   message_id=hearing['message_id'], parse_mode="HTML")
+        else:
+            await outbound.enqueue(hearing['chat_id'], text, parse_mode="HTML")
+
+async def sud_selezenki_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
+    # Проверка формата - нужен ответ на сообщение
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Используйте команду ответом на сообщение!")
+        await reply(update, "❌ Используйте команду ответом на сообщение пользователя!")
         return
     
     plaintiff_id = update.effective_user.id
-    defendant_id = update.message.reply_to_message.from_user.id
+    plaintiff = await db.get_user(plaintiff_id)
     
-    plaintiff = db.get_user(plaintiff_id)
-    defendant = db.get_user(defendant_id)
-    
-    if not plaintiff or plaintiff['kkl'] < COURT_COSTS["redodendron"]:
-        await update.message.reply_text(f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['redodendron']} KKL.")
+    if not plaintiff or plaintiff['kkl'] < COURT_COSTS["selezenka"]:
+        await reply(update, f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['selezenka']} KKL.")
         return
     
+    # Определяем ответчика из ответа на сообщение
+    defendant_id = update.message.reply_to_message.from_user.id
+    defendant = await db.get_user(defendant_id)
+    
     if not defendant:
-        await update.message.reply_text("❌ Ответчик не найден!")
+        await reply(update, "❌ Ответчик не зарегистрирован в системе!")
         return
     
     # Нельзя судить себя
     if plaintiff_id == defendant_id:
-        await update.message.reply_text("❌ Нельзя подать в суд на самого себя!")
+        await reply(update, "❌ Нельзя подать в суд на самого себя!")
         return
     
-    # Снимаем KKL
-    new_kkl = plaintiff['kkl'] - COURT_COSTS["redodendron"]
-    db.update_user(plaintiff_id, kkl=new_kkl)
+    # Проверяем бан ответчика
+    if defendant and defendant.get('is_banned'):
+        await reply(update, "❌ Этот пользователь уже изгнан в болото!")
+        return
     
-    await update.message.reply_text("🌿 Суд Редодендрона рассматривает дело о нарушении фотосинтеза...")
-    await asyncio.sleep(3)
+    # Снимаем KKL с истца, вердикт - по окончании заседания
+    if not await start_hearing(update, db, "selezenka", defendant_id,
+                               "⚖️ Идёт заседание Суда Двенадцатиперстной Селезёнки..."):
+        await reply(update, f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['selezenka']} KKL.")
+
+async def sud_redodendrona_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
+    if not update.message.reply_to_message:
+        await reply(update, "❌ Используйте команду ответом на сообщение!")
+        return
     
-    # Вердикт
-    verdict_text, fine = get_court_verdict("redodendron")
+    plaintiff_id = update.effective_user.id
+    defendant_id = update.message.reply_to_message.from_user.id
     
-    # Шанс 70% на обвинение
-    if random.random() < 0.7:
-        # Обвинение
-        if defendant['trf'] >= fine:
-            new_def_trf = defendant['trf'] - fine
-            db.update_user(defendant_id, trf=new_def_trf)
-            
-            # Клетчатка в фонд чата (упрощенная реализация - просто начисляем истцу)
-            new_pla_kkl = plaintiff['kkl'] + 2  # +2 KKL за победу
-            db.update_user(plaintiff_id, kkl=new_pla_kkl)
-            
-            result_msg = f"Штраф {fine} TRF, истец получает 2 KKL"
-        else:
-            # Альтернативное наказание
-            health_loss = random.randint(10, 30)
-            new_health = max(0, defendant.get('health', 100) - health_loss)
-            db.update_user(defendant_id, health=new_health)
-            result_msg = f"Потеря здоровья: -{health_loss}%"
-    else:
-        result_msg = "Оправдан. Иск отклонён"
+    plaintiff = await db.get_user(plaintiff_id)
+    defendant = await db.get_user(defendant_id)
     
-    db.add_court_case(plaintiff_id, defendant_id, "redodendron", verdict_text, fine, result_msg)
+    if not plaintiff or plaintiff['kkl'] < COURT_COSTS["redodendron"]:
+        await reply(update, f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['redodendron']} KKL.")
+        return
     
-    plaintiff_name = f"@{plaintiff['username']}" if plaintiff.get('username') else plaintiff.get('first_name', 'Пользователь')
-    defendant_name = f"@{defendant['username']}" if defendant.get('username') else defendant.get('first_name', 'Пользователь')
+    if not defendant:
+        await reply(update, "❌ Ответчик не найден!")
+        return
     
-    response = f"""🌿 <b>ВЕРДИКТ СУДА РЕДОДЕНДРОНА</b>
-
-👤 <b>Истец:</b> {plaintiff_name}
-👤 <b>Ответчик:</b> {defendant_name}
-
-📜 <b>Приговор:</b> {verdict_text}
-
-🏛️ <b>Результат:</b> {result_msg}
-
-💰 <b>С истца списано:</b> {COURT_COSTS['redodendron']} KKL"""
+    # Нельзя судить себя
+    if plaintiff_id == defendant_id:
+        await reply(update, "❌ Нельзя подать в суд на самого себя!")
+        return
     
-    await update.message.reply_text(response, parse_mode="HTML")
+    # Снимаем KKL, вердикт - по окончании заседания
+    if not await start_hearing(update, db, "redodendron", defendant_id,
+                               "🌿 Суд Редодендрона рассматривает дело о нарушении фотосинтеза..."):
+        await reply(update, f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['redodendron']} KKL.")
 
-async def sud_kishki_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: Database):
+async def sud_kishki_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Используйте команду ответом на сообщение!")
+        await reply(update, "❌ Используйте команду ответом на сообщение!")
         return
     
     plaintiff_id = update.effective_user.id
     defendant_id = update.message.reply_to_message.from_user.id
     
     if plaintiff_id == defendant_id:
-        await update.message.reply_text("❌ Нельзя изгнать самого себя!")
+        await reply(update, "❌ Нельзя изгнать самого себя!")
         return
     
-    plaintiff = db.get_user(plaintiff_id)
-    defendant = db.get_user(defendant_id)
+    plaintiff = await db.get_user(plaintiff_id)
+    defendant = await db.get_user(defendant_id)
     
     if not plaintiff or plaintiff['kkl'] < COURT_COSTS["kishka"]:
-        await update.message.reply_text(f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['kishka']} KKL.")
+        await reply(update, f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['kishka']} KKL.")
         return
     
     if not defendant:
-        await update.message.reply_text("❌ Ответчик не найден!")
+        await reply(update, "❌ Ответчик не найден!")
         return
     
     # Проверка на бан ответчика
     if defendant.get('is_banned'):
-        await update.message.reply_text("❌ Этот пользователь уже изгнан в болото!")
+        await reply(update, "❌ Этот пользователь уже изгнан в болото!")
         return
     
-    # Снимаем KKL
-    new_kkl = plaintiff['kkl'] - COURT_COSTS["kishka"]
-    db.update_user(plaintiff_id, kkl=new_kkl)
-    
-    await update.message.reply_text("🩸 Суд Прямой Кишки начинает высшее слушание...")
-    await asyncio.sleep(4)
-    
-    # Вердикт
-    verdict_text, fine = get_court_verdict("kishka")
-    
-    # 50% шанс на изгнание
-    if random.random() < 0.5 and "изгнан" in verdict_text.lower():
-        # Изгнание на 24 часа
-        ban_until = (datetime.now() + timedelta(hours=24)).isoformat()
-        db.update_user(defendant_id, 
-                      is_banned=True,
-                      banned_until=ban_until,
-                      warnings=0,
-                      health=50)
-        
-        result_msg = "ИЗГНАН В БОЛОТО НА 24 ЧАСА!"
-        
-        # Штраф в пользу истца
-        if defendant.get('trf', 0) > 0:
-            penalty = min(defendant['trf'], 100)
-            new_def_trf = defendant['trf'] - penalty
-            new_pla_trf = plaintiff['trf'] + penalty
-            db.update_user(defendant_id, trf=new_def_trf)
-            db.update_user(plaintiff_id, trf=new_pla_trf)
-            result_msg += f"\nКонфисковано {penalty} TRF в пользу истца"
-    else:
-        result_msg = "Дело отклонено. Недостаточно доказательств."
-    
-    db.add_court_case(plaintiff_id, defendant_id, "kishka", verdict_text, fine, result_msg)
-    
-    plaintiff_name = f"@{plaintiff['username']}" if plaintiff.get('username') else plaintiff.get('first_name', 'Пользователь')
-    defendant_name = f"@{defendant['username']}" if defendant.get('username') else defendant.get('first_name', 'Пользователь')
-    
-    response = f"""🩸 <b>ВЕРДИКТ СУДА ПРЯМОЙ КИШКИ</b>
-
-👤 <b>Истец:</b> {plaintiff_name}
-👤 <b>Ответчик:</b> {defendant_name}
-
-📜 <b>Приговор:</b> {verdict_text}
-
-🏛️ <b>Результат:</b> {result_msg}
-
-💰 <b>С истца списано:</b> {COURT_COSTS['kishka']} KKL
-⚠️ <b>Высшая мера применена!</b>"""
-    
-    await update.message.reply_text(response, parse_mode="HTML")
\ No newline at end of file
+    # Снимаем KKL, вердикт - по окончании заседания
+    if not await start_hearing(update, db, "kishka", defendant_id,
+                               "🩸 Суд Прямой Кишки начинает высшее слушание..."):
+        await reply(update, f"❌ Недостаточно клетчатки! Нужно {COURT_COSTS['kishka']} KKL.")
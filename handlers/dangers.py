@@ -1,46 +1,41 @@
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.ext import ContextTypes
 import random
-import asyncio
-from datetime import datetime
-from database import Database
-from config import DANGER_INTERVAL
+from database import AsyncDatabase
+import outbound
+import timers
+from outbound import reply
+from config import (
+    DANGER_MAX_CHATS_PER_TICK, TURTLE_DAMAGE_DELAY, TURTLE_INVASION_TTL, CO2_DURATION,
+    COST_KKL_FOR_PROTECTION
+)
 from telegram import Update
+from telegram.helpers import escape_markdown
+from utils import split_message
 
-# Глобальный словарь для активных черепашек
-active_turtles = {}
-
-async def danger_scheduler(context: ContextTypes.DEFAULT_TYPE):
-    """Фоновая задача опасностей"""
-    db = context.bot_data.get('db')
-    if not db:
-        return
+async def danger_tick(db: AsyncDatabase, shard=(0, 1)):
+    """
+    Опасности для чатов, чей срок подошёл. Планировщик вызывает её каждые
+    DANGER_TICK секунд; у каждого чата своё время внутри DANGER_INTERVAL, поэтому
+    за одну проверку срабатывает лишь небольшая часть чатов. При нескольких
+    процессах каждый берёт только свои чаты (shard - номер и число процессов).
+    """
+    chats = await db.claim_due_chats(DANGER_MAX_CHATS_PER_TICK, shard=shard)
     
-    while True:
-        await asyncio.sleep(DANGER_INTERVAL)
+    for chat_id in chats:
+        # Случайная опасность
+        danger_type = random.choice(["co2", "turtles", "perforation"])
         
-        # Получаем все чаты
-        with db.get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT chat_id FROM chats')
-            chats = cur.fetchall()
-        
-        for (chat_id,) in chats:
-            # Случайная опасность
-            danger_type = random.choice(["co2", "turtles", "perforation"])
-            
-            if danger_type == "co2":
-                await send_co2_danger(context.bot, chat_id, db)
-            elif danger_type == "turtles":
-                await send_turtle_danger(context.bot, chat_id, db)
-            elif danger_type == "perforation":
-                await send_perforation_danger(context.bot, chat_id, db)
-            
-            # Обновляем время последней опасности
-            db.update_chat(chat_id, last_danger=datetime.now().isoformat())
+        if danger_type == "co2":
+            await send_co2_danger(chat_id, db)
+        elif danger_type == "turtles":
+            await send_turtle_danger(chat_id, db)
+        elif danger_type == "perforation":
+            await send_perforation_danger(chat_id, db)
 
-async def send_co2_danger(bot, chat_id, db):
+async def send_co2_danger(chat_id, db):
     """Опасность CO2"""
-    db.update_chat(chat_id, co2_active=True)
+    await db.update_chat(chat_id, co2_active=True)
+    await timers.schedule("co2_expire", chat_id, delay=CO2_DURATION)
     
     text = """
 ⚠️ *ВНИМАНИЕ: ПОВЫШЕНИЕ CO₂!*
@@ -56,18 +51,13 @@ async def send_co2_danger(bot, chat_id, db):
 • Риск перфорации повышен
 
 🛡️ *Защита:* 
-Используйте /zashita_co2 (3 KKL) для нейтрализации!
-    """.format(random.randint(800, 1500), random.randint(2, 8))
+Используйте /zashita\\_co2 ({} KKL) для нейтрализации!
+    """.format(random.randint(800, 1500), random.randint(2, 8), COST_KKL_FOR_PROTECTION)
     
-    try:
-        await bot.send_message(chat_id, text, parse_mode="Markdown")
-    except:
-        pass  # Игнорируем ошибки отправки
+    await outbound.enqueue(chat_id, text, parse_mode="Markdown")
 
-async def send_turtle_danger(bot, chat_id, db):
+async def send_turtle_danger(chat_id, db):
     """Опасность черепашек"""
-    db.update_chat(chat_id, turtle_active=True)
-    
     # Генерируем случайное количество черепашек
     turtle_count = random.randint(3, 8)
     turtles = "🐢" * turtle_count
@@ -82,53 +72,40 @@ async def send_turtle_danger(bot, chat_id, db):
 • Активность микоризы -30%
 
 🛡️ *Защита:*
-СРОЧНО: /Kiparis_zashita
+СРОЧНО: /Kiparis\\_zashita
 Нужно минимум 5 участников для отражения!
 
 ⏰ *Время на реакцию:* 10 минут
     """
     
-    # Сохраняем черепашек
-    active_turtles[chat_id] = {
-        'count': turtle_count,
-        'start_time': datetime.now(),
-        'participants': set()
-    }
+    # Состояние защиты - в базе, общее для всех процессов бота
+    await db.start_turtle_invasion(chat_id, turtle_count, TURTLE_INVASION_TTL)
     
-    try:
-        await bot.send_message(chat_id, text, parse_mode="Markdown")
-    except:
-        pass
+    await outbound.enqueue(chat_id, text, parse_mode="Markdown")
     
-    # Таймер для ущерба
-    asyncio.create_task(turtle_damage_timer(bot, chat_id, db))
+    # Урон, если чат не отобьётся вовремя (см. turtle_damage), и уход черепашек
+    await timers.schedule("turtle_damage", chat_id, delay=TURTLE_DAMAGE_DELAY)
+    await timers.schedule("turtle_expire", chat_id, delay=TURTLE_INVASION_TTL)
 
-async def send_perforation_danger(bot, chat_id, db):
+async def send_perforation_danger(chat_id, db):
     """Случайная перфорация"""
-    # Получаем всех пользователей чата
-    with db.get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute('SELECT user_id FROM users WHERE is_banned = FALSE')
-        users = cur.fetchall()
+    # Жертва выбирается только среди участников этого чата
+    users = await db.get_chat_members(chat_id)
     
     if not users:
         return
     
     # Выбираем случайную жертву
-    victim_id = random.choice(users)[0]
-    victim = db.get_user(victim_id)
+    victim_id = random.choice(users)
+    victim = await db.get_user(victim_id)
     
     if not victim:
         return
     
     # Наносим урон
     health_loss = random.randint(20, 50)
-    new_health = max(0, victim['health'] - health_loss)
-    perforation_count = victim['perforation_count'] + 1
-    
-    db.update_user(victim_id, 
-                  health=new_health,
-                  perforation_count=perforation_count)
+    victim = await db.increment_user(victim_id, health=-health_loss, perforation_count=1)
+    perforation_count = victim['perforation_count']
     
     victim_name = f"@{victim['username']}" if victim['username'] else victim['first_name']
     
@@ -146,79 +123,74 @@ async def send_perforation_danger(bot, chat_id, db):
 
 💊 *Лечение:* 
 Автоматическое через 24 часа
-Или /lechit_perforaciyu (15 KKL)
+Или /lechit\\_perforaciyu (15 KKL)
     """
     
-    try:
-        await bot.send_message(chat_id, text, parse_mode="Markdown")
-    except:
-        pass
+    await outbound.enqueue(chat_id, text, parse_mode="Markdown")
 
-async def turtle_damage_timer(bot, chat_id, db):
-    """Таймер ущерба от черепашек"""
-    await asyncio.sleep(300)  # 5 минут
-    
-    if chat_id not in active_turtles:
-        return
-    
-    # Наносим ущерб всем пользователям
-    with db.get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute('SELECT user_id, trf FROM users')
-        users = cur.fetchall()
-    
-    damage_report = "🐢 *Черепашки наносят урон!*\n\n"
-    
-    for user_id, trf in users:
-        damage = min(10, trf)  # Не больше 10 TRF
-        if damage > 0:
-            new_trf = max(0, trf - damage)
-            db.update_user(user_id, trf=new_trf)
-            
-            user = db.get_user(user_id)
-            name = f"@{user['username']}" if user['username'] else user['first_name']
-            damage_report += f"{name}: -{damage} TRF\n"
-    
-    damage_report += f"\n🛡️ Защищайтесь: /Kiparis_zashita"
+async def turtle_damage(due, db):
+    """Ущерб от черепашек: таймеры turtle_damage [(chat_id, payload)]"""
+    for chat_id, _ in due:
+        # Мимо кэша: защиту могли завершить в другом процессе
+        if await db.get_turtle_invasion(chat_id, cached=False):
+            await send_turtle_damage(chat_id, db)
+
+async def turtle_expired(due, db):
+    """Черепашки уходят сами: таймеры turtle_expire"""
+    await db.expire_turtle_invasions()
+
+async def send_turtle_damage(chat_id, db):
+    """Урон всем участникам атакованного чата - одним запросом"""
+    damaged = await db.damage_chat_members(chat_id, 10)  # Не больше 10 TRF
+    
+    lines = []
+    for user_id, username, first_name, damage in damaged:
+        name = f"@{username}" if username else first_name
+        lines.append(f"{escape_markdown(name or str(user_id))}: -{damage} TRF")
+    
+    # Большой чат - несколько сообщений в пределах лимита Telegram
+    messages = split_message(
+        lines,
+        header="🐢 *Черепашки наносят урон!*\n\n",
+        footer="\n🛡️ Защищайтесь: /Kiparis\\_zashita"
+    )
     
-    try:
-        await bot.send_message(chat_id, damage_report, parse_mode="Markdown")
-    except:
-        pass
+    for text in messages:
+        await outbound.enqueue(chat_id, text, parse_mode="Markdown")
 
-async def cmd_kiparis_zashita(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def kiparis_zashita_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     """Обработчик команды /Kiparis_zashita"""
-    db = context.bot_data.get('db')
-    if not db:
-        await update.message.reply_text("❌ Ошибка базы данных")
-        return
-    
     chat_id = update.effective_chat.id
-    
-    if chat_id not in active_turtles:
-        await update.message.reply_text("🐢 Черепашек нет. Можно расслабиться.")
-        return
-    
     user_id = update.effective_user.id
-    turtles = active_turtles[chat_id]
     
     # Добавляем участника защиты
-    turtles['participants'].add(user_id)
+    turtles, _ = await db.join_turtle_defense(chat_id, user_id)
+    
+    if turtles is None:
+        await reply(update, "🐢 Черепашек нет. Можно расслабиться.")
+        return
     
     participant_count = len(turtles['participants'])
     needed = 5
     
     if participant_count >= needed:
+        # Завершает защиту только один из вступивших (и один процесс)
+        finished = await db.end_turtle_invasion(chat_id)
+        if finished is None:
+            await reply(update, "🐢 Черепашек нет. Можно расслабиться.")
+            return
+        
         # Успешная защита
-        del active_turtles[chat_id]
-        db.update_chat(chat_id, turtle_active=False)
+        await timers.cancel("turtle_damage", chat_id)
+        await timers.cancel("turtle_expire", chat_id)
+        participant_count = len(finished['participants'])
         
         # Награда участникам
         reward = random.randint(5, 15)
-        for pid in turtles['participants']:
-            db.add_trf(pid, reward)
+        for pid in finished['participants']:
+            await db.add_trf(pid, reward)
         
-        await update.message.reply_text(
+        await reply(update, 
             f"🛡️ *КИПАРИСОВАЯ ЗАЩИТА АКТИВИРОВАНА!*\n\n"
             f"🐢 Черепашки Татунхамона отброшены!\n"
             f"👥 Участников защиты: {participant_count}\n"
@@ -228,70 +200,58 @@ async def cmd_kiparis_zashita(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
     else:
         # Нужно больше участников
-        await update.message.reply_text(
+        await reply(update, 
             f"🛡️ *Защита формируется...*\n\n"
             f"👥 Участников: {participant_count}/{needed}\n"
             f"🐢 Черепашек осталось: {turtles['count']}\n"
-            f"⏰ Призывайте других: /Kiparis_zashita",
+            f"⏰ Призывайте других: /Kiparis\\_zashita",
             parse_mode="Markdown"
         )
 
-async def cmd_zashita_co2(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def zashita_co2_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     """Обработчик команды /zashita_co2"""
-    db = context.bot_data.get('db')
-    if not db:
-        await update.message.reply_text("❌ Ошибка базы данных")
-        return
-    
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
-    if not user or user['kkl'] < 3:
-        await update.message.reply_text("❌ Недостаточно клетчатки! Нужно 3 KKL.")
+    if not user or user['kkl'] < COST_KKL_FOR_PROTECTION:
+        await reply(update, f"❌ Недостаточно клетчатки! Нужно {COST_KKL_FOR_PROTECTION} KKL.")
         return
     
     chat_id = update.effective_chat.id
-    chat_data = db.get_chat(chat_id)
+    chat_data = await db.get_chat(chat_id)
     
     if not chat_data.get('co2_active'):
-        await update.message.reply_text("⚠️ Угрозы CO₂ нет в данный момент.")
+        await reply(update, "⚠️ Угрозы CO₂ нет в данный момент.")
         return
     
     # Снимаем KKL
-    new_kkl = user['kkl'] - 3
-    db.update_user(user_id, kkl=new_kkl)
+    charged = await db.spend(user_id, kkl=COST_KKL_FOR_PROTECTION)
+    if not charged:
+        await reply(update, f"❌ Недостаточно клетчатки! Нужно {COST_KKL_FOR_PROTECTION} KKL.")
+        return
+    new_kkl = charged['kkl']
     
     # Деактивируем опасность
-    db.update_chat(chat_id, co2_active=False)
+    await db.update_chat(chat_id, co2_active=False)
+    await timers.cancel("co2_expire", chat_id)
     
     # Награда за защиту
     reward = random.randint(20, 50)
-    new_trf = db.add_trf(user_id, reward)
+    new_trf = await db.add_trf(user_id, reward)
     
     username = update.effective_user.username
     name_mention = f"@{username}" if username else update.effective_user.first_name
     
-    await update.message.reply_text(
+    await reply(update, 
         f"🛡️ *ЗАЩИТА ОТ CO₂ АКТИВИРОВАНА!*\n\n"
         f"👤 Защитник: {name_mention}\n"
-        f"🥬 Потрачено: 3 KKL\n"
+        f"🥬 Потрачено: {COST_KKL_FOR_PROTECTION} KKL\n"
         f"💰 Награда: {reward} TRF\n"
         f"💎 Новый баланс: {new_trf} TRF | {new_kkl} KKL\n"
         f"🌿 Опасность нейтрализована!",
         parse_mode="Markdown"
     )
 
-def setup_handlers(application: Application, db: Database):
-    """Настройка обработчиков"""
-    # Сохраняем базу данных в bot_data для доступа из контекста
-    application.bot_data['db'] = db
-    
-    # Добавляем обработчики команд
-    application.add_handler(CommandHandler(["Kiparis_zashita", "кипарис_защита"], cmd_kiparis_zashita))
-    application.add_handler(CommandHandler(["zashita_co2", "защита_co2"], cmd_zashita_co2))
-    
-    # Запускаем планировщик опасностей
-    application.job_queue.run_once(
-        lambda context: asyncio.create_task(danger_scheduler(context)),
-        when=0
-    )
\ No newline at end of file
+async def co2_expired(due, db):
+    """CO₂ рассеялся сам: таймеры co2_expire [(chat_id, payload)]"""
+    await db.clear_chat_flag([chat_id for chat_id, _ in due], 'co2_active')
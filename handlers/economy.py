@@ -1,29 +1,26 @@
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.ext import ContextTypes
 from telegram import Update
-from datetime import datetime, timedelta
+from datetime import datetime
 import random
-import asyncio
-from database import Database
+from database import AsyncDatabase
+import timers
+from outbound import reply
 from config import *
 
-async def cmd_kopat_torf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def kopat_torf_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     """Обработчик команды /kopat_torf"""
-    db = context.bot_data.get('db')
-    if not db:
-        await update.message.reply_text("❌ Ошибка базы данных")
-        return
-    
     user_id = update.effective_user.id
     username = update.effective_user.username
     first_name = update.effective_user.first_name
     
     # Создаем пользователя если не существует
-    db.create_user(user_id, username, first_name)
-    user = db.get_user(user_id)
+    await db.create_user(user_id, username, first_name)
+    # Без начисления: время последнего дохода - это и таймер добычи
+    user = await db.get_user(user_id, accrue=False)
     
     # Проверка на перфорацию
     if user['perforation_count'] > 0:
-        await update.message.reply_text("🩸 Вы на лечении в суглинках! Добыча невозможна.")
+        await reply(update, "🩸 Вы на лечении в суглинках! Добыча невозможна.")
         return
     
     # Пассивный доход
@@ -33,12 +30,12 @@ async def cmd_kopat_torf(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if (now - last_income).total_seconds() < 3600:
         wait_time = 3600 - (now - last_income).total_seconds()
         minutes = int((wait_time % 3600) // 60)
-        await update.message.reply_text(f"⏳ Торф ещё копится! Ждите {minutes} минут.")
+        await reply(update, f"⏳ Торф ещё копится! Ждите {minutes} минут.")
         return
     
     # Расчет дохода
     base_income = TRF_PER_HOUR
-    chat_data = db.get_chat(update.effective_chat.id)
+    chat_data = await db.get_chat(update.effective_chat.id)
     
     # Модификатор от pH
     ph_modifier = 1.0
@@ -49,36 +46,27 @@ async def cmd_kopat_torf(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     income = int(base_income * ph_modifier)
     
-    # Добавляем доход
-    new_trf = db.add_trf(user_id, income)
-    db.update_user(user_id, last_passive_income=now.isoformat())
+    # Добавляем доход (вместе с накопленным пассивным) и отмечаем время добычи одним запросом
+    user = await db.add_balance(user_id, trf=income, last_passive_income=now.isoformat())
+    new_trf = user['trf']
     
     # Запись в историю
-    with db.get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute('INSERT INTO mining (user_id, action, amount) VALUES (?, ?, ?)',
-                   (user_id, 'passive_income', income))
-        conn.commit()
+    await db.log_mining(user_id, 'passive_income', income)
     
-    await update.message.reply_text(
+    await reply(update, 
         f"⛏️ Добыто: {income} TRF\n"
         f"📊 pH модификатор: x{ph_modifier:.1f}\n"
         f"💰 Новый баланс: {new_trf} TRF\n"
         f"⏳ Следующая добыча через час"
     )
 
-async def cmd_torforazvedka(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def torforazvedka_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     """Обработчик команды /torforazvedka"""
-    db = context.bot_data.get('db')
-    if not db:
-        await update.message.reply_text("❌ Ошибка базы данных")
-        return
-    
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user or user['trf'] < 10:
-        await update.message.reply_text("❌ Нужно минимум 10 TRF для разведки!")
+        await reply(update, "❌ Нужно минимум 10 TRF для разведки!")
         return
     
     # Случайный исход
@@ -89,14 +77,14 @@ async def cmd_torforazvedka(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if rand < CHANCE_CO2:
         # Выброс CO₂
         loss = random.randint(10, 50)
-        new_trf = max(0, user['trf'] - loss)
-        db.update_user(user_id, trf=new_trf)
+        new_trf = await db.add_trf(user_id, -loss)
         
         # Активируем опасность CO2 в чате
         chat_id = update.effective_chat.id
-        db.update_chat(chat_id, co2_active=True, last_danger=datetime.now().isoformat())
+        await db.update_chat(chat_id, co2_active=True, last_danger=datetime.now().isoformat())
+        await timers.schedule("co2_expire", chat_id, delay=CO2_DURATION)
         
-        await update.message.reply_text(
+        await reply(update, 
             f"💨 ВЫБРОС CO₂!\n"
             f"Потеряно: {loss} TRF\n"
             f"⚠️ В чате активирована опасность CO₂!\n"
@@ -107,10 +95,10 @@ async def cmd_torforazvedka(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif rand < CHANCE_CO2 + CHANCE_GOLD_VEIN:
         # Золотая жила
         bonus = random.randint(50, 200)
-        new_trf = db.add_trf(user_id, bonus)
+        new_trf = await db.add_trf(user_id, bonus)
         found = bonus
         
-        await update.message.reply_text(
+        await reply(update, 
             f"🎉 ЗОЛОТАЯ ЖИЛА!\n"
             f"Найдено: {bonus} TRF\n"
             f"💰 Новый баланс: {new_trf} TRF\n"
@@ -121,9 +109,9 @@ async def cmd_torforazvedka(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         # Обычная находка
         found = random.randint(5, 25)
-        new_trf = db.add_trf(user_id, found)
+        new_trf = await db.add_trf(user_id, found)
         
-        await update.message.reply_text(
+        await reply(update, 
             f"⛏️ Найдено торфа: {found} TRF\n"
             f"💰 Баланс: {new_trf} TRF\n"
             f"📈 Продолжайте разведку!"
@@ -131,25 +119,16 @@ async def cmd_torforazvedka(update: Update, context: ContextTypes.DEFAULT_TYPE):
         outcome = "normal"
     
     # Запись в историю
-    with db.get_connection() as conn:
-        cur = conn.cursor()
-        amount = found if outcome != 'co2' else -loss
-        cur.execute('INSERT INTO mining (user_id, action, amount) VALUES (?, ?, ?)',
-                   (user_id, f'torforazvedka_{outcome}', amount))
-        conn.commit()
+    amount = found if outcome != 'co2' else -loss
+    await db.log_mining(user_id, f'torforazvedka_{outcome}', amount)
 
-async def cmd_sobrat_kletchatku(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def sobrat_kletchatku_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     """Обработчик команды /sobrat_kletchatku"""
-    db = context.bot_data.get('db')
-    if not db:
-        await update.message.reply_text("❌ Ошибка базы данных")
-        return
-    
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
-        await update.message.reply_text("❌ Пользователь не найден!")
+        await reply(update, "❌ Пользователь не найден!")
         return
     
     now = datetime.now()
@@ -159,58 +138,54 @@ async def cmd_sobrat_kletchatku(update: Update, context: ContextTypes.DEFAULT_TY
         wait_seconds = CELLULOSE_COOLDOWN - (now - last_cellulose).total_seconds()
         hours = int(wait_seconds // 3600)
         minutes = int((wait_seconds % 3600) // 60)
-        await update.message.reply_text(f"🥬 Клетчатка ещё растёт! Ждите {hours}ч {minutes}мин.")
+        await reply(update, f"🥬 Клетчатка ещё растёт! Ждите {hours}ч {minutes}мин.")
         return
     
     # Сбор клетчатки
     amount = KKL_PER_DAY + random.randint(-1, 2)  # 2-7 KKL
-    new_kkl = db.add_kkl(user_id, amount)
-    db.update_user(user_id, last_cellulose=now.isoformat())
+    user = await db.add_balance(user_id, kkl=amount, last_cellulose=now.isoformat())
+    new_kkl = user['kkl']
     
-    await update.message.reply_text(
+    await reply(update, 
         f"🥬 Собрано клетчатки: {amount} KKL\n"
         f"📦 Новый баланс: {new_kkl} KKL\n"
         f"⏳ Следующий сбор через 24 часа"
     )
 
-async def cmd_kupit_kletchatku(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def kupit_kletchatku_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     """Обработчик команды /kupit_kletchatku"""
-    db = context.bot_data.get('db')
-    if not db:
-        await update.message.reply_text("❌ Ошибка базы данных")
-        return
-    
     try:
         if not context.args or len(context.args) != 1:
-            await update.message.reply_text("❌ Используйте: /kupit_kletchatku [количество]")
+            await reply(update, "❌ Используйте: /kupit_kletchatku [количество]")
             return
         
         amount = int(context.args[0])
         if amount <= 0:
-            await update.message.reply_text("❌ Количество должно быть положительным!")
+            await reply(update, "❌ Количество должно быть положительным!")
             return
         
         user_id = update.effective_user.id
-        user = db.get_user(user_id)
+        user = await db.get_user(user_id)
         
         if not user:
-            await update.message.reply_text("❌ Пользователь не найден!")
+            await reply(update, "❌ Пользователь не найден!")
             return
         
         # Курс: 1 KKL = 20 TRF
         cost = amount * 20
         
-        if user['trf'] < cost:
-            await update.message.reply_text(f"❌ Недостаточно TRF! Нужно {cost} TRF, у вас {user['trf']} TRF.")
-            return
+        # Покупка: списание TRF и начисление KKL одним запросом
+        # (отрицательная стоимость KKL - это начисление)
+        bought = await db.spend(user_id, trf=cost, kkl=-amount)
         
-        # Покупка
-        new_trf = user['trf'] - cost
-        new_kkl = user['kkl'] + amount
+        if not bought:
+            await reply(update, f"❌ Недостаточно TRF! Нужно {cost} TRF, у вас {user['trf']} TRF.")
+            return
         
-        db.update_user(user_id, trf=new_trf, kkl=new_kkl)
+        new_trf = bought['trf']
+        new_kkl = bought['kkl']
         
-        await update.message.reply_text(
+        await reply(update, 
             f"🛒 Покупка успешна!\n"
             f"📦 Куплено: {amount} KKL\n"
             f"💰 Потрачено: {cost} TRF\n"
@@ -219,54 +194,6 @@ async def cmd_kupit_kletchatku(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         
     except ValueError:
-        await update.message.reply_text("❌ Укажите число! Например: /kupit_kletchatku 5")
+        await reply(update, "❌ Укажите число! Например: /kupit_kletchatku 5")
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
-
-async def passive_income_scheduler(context: ContextTypes.DEFAULT_TYPE):
-    """Фоновая задача пассивного дохода"""
-    db = context.bot_data.get('db')
-    if not db:
-        return
-    
-    while True:
-        await asyncio.sleep(PASSIVE_INCOME_INTERVAL)
-        # В python-telegram-bot можно использовать JobQueue для периодических задач
-        # В данном случае оставляем как есть, но лучше переделать на JobQueue
-        
-        # Получаем всех пользователей
-        with db.get_connection() as conn:
-            cur = conn.cursor()
-            cur.execute('SELECT user_id, last_passive_income FROM users')
-            users = cur.fetchall()
-        
-        for user_id, last_income_str in users:
-            last_income = datetime.fromisoformat(last_income_str)
-            now = datetime.now()
-            
-            # Если прошло больше часа - начисляем доход
-            if (now - last_income).total_seconds() >= 3600:
-                hours_passed = int((now - last_income).total_seconds() // 3600)
-                income = TRF_PER_HOUR * hours_passed
-                
-                if income > 0:
-                    db.add_trf(user_id, income)
-                    db.update_user(user_id, last_passive_income=now.isoformat())
-
-def setup_economy_handlers(application: Application, db: Database):
-    """Настройка обработчиков экономики"""
-    # Сохраняем базу данных в bot_data
-    application.bot_data['db'] = db
-    
-    # Добавляем обработчики команд
-    application.add_handler(CommandHandler(["kopat_torf", "добыть_торф"], cmd_kopat_torf))
-    application.add_handler(CommandHandler(["torforazvedka", "торфоразведка"], cmd_torforazvedka))
-    application.add_handler(CommandHandler(["sobrat_kletchatku", "собрать_клетчатку"], cmd_sobrat_kletchatku))
-    application.add_handler(CommandHandler(["kupit_kletchatku", "купить_клетчатку"], cmd_kupit_kletchatku))
-    
-    # Запускаем планировщик пассивного дохода
-    # В python-telegram-bot лучше использовать JobQueue
-    application.job_queue.run_once(
-        lambda context: asyncio.create_task(passive_income_scheduler(context)),
-        when=0
-    )
\ No newline at end of file
+        await reply(update, f"❌ Ошибка: {str(e)}")
@@ -0,0 +1,271 @@
+"""
+Таблица лидеров в памяти процесса: топ и место пользователя за O(log n).
+"""
+import itertools
+import math
+import random
+import threading
+from datetime import datetime, timedelta
+
+# julianday() в SQLite - целые миллисекунды от начала юлианского периода,
+# делённые на 86400000.0; считаем так же, чтобы часы дохода совпадали с базой
+_UNIX_EPOCH = datetime(1970, 1, 1)
+_UNIX_EPOCH_JD_MS = 210866760000000
+
+def julianday(value):
+    """julianday() как в SQLite для datetime или ISO-строки (None - если не разобрать)"""
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+    return (_UNIX_EPOCH_JD_MS + (value - _UNIX_EPOCH) // timedelta(milliseconds=1)) / 86400000.0
+
+class _Last:
+    """Хвост списка: больше любого ключа"""
+    def __lt__(self, other):
+        return False
+    __le__ = __eq__ = __lt__
+
+    def __gt__(self, other):
+        return True
+    __ge__ = __gt__
+
+    __hash__ = object.__hash__
+
+_LAST = _Last()
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        # width[level] - сколько позиций перепрыгивает ссылка next[level]
+        self.width = [0] * levels
+
+class IndexableSkipList:
+    """
+    Упорядоченное множество ключей со списком пропусков, в котором
+    у каждой ссылки хранится её длина. Вставка, удаление, место ключа
+    и ключ по номеру - за O(log n).
+    """
+    def __init__(self, expected_size=1_000_000):
+        self.max_levels = max(1, int(math.log2(max(2, expected_size))) + 1)
+        self._tail = _Node(_LAST, 0)
+        self._clear()
+
+    def _clear(self):
+        self._head = _Node(None, self.max_levels)
+        self._head.next = [self._tail] * self.max_levels
+        self._head.width = [1] * self.max_levels
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _random_levels(self):
+        levels = 1
+        while levels < self.max_levels and random.random() < 0.5:
+            levels += 1
+        return levels
+
+    def build(self, keys):
+        """Построение из отсортированных уникальных ключей за O(n)"""
+        self._clear()
+        last = [self._head] * self.max_levels
+        last_pos = [0] * self.max_levels
+        pos = 0
+        for pos, key in enumerate(keys, 1):
+            node = _Node(key, self._random_levels())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = pos - last_pos[level]
+                last[level] = node
+                last_pos[level] = pos
+        for level in range(self.max_levels):
+            last[level].next[level] = self._tail
+            last[level].width[level] = pos + 1 - last_pos[level]
+        self.size = pos
+
+    def insert(self, key):
+        chain = [None] * self.max_levels
+        steps_at_level = [0] * self.max_levels
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        new = _Node(key, self._random_levels())
+        steps = 0
+        for level in range(len(new.next)):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            new.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(len(new.next), self.max_levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.max_levels
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+
+        target = chain[0].next[0]
+        if target is self._tail or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.max_levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        """Сколько ключей строго меньше key"""
+        pos = 0
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key < key:
+                pos += node.width[level]
+                node = node.next[level]
+        return pos
+
+    def iter_from(self, index=0):
+        """Ключи по возрастанию, начиная с номера index"""
+        if index >= self.size:
+            # Иначе спуск ниже упрётся в хвост, у которого нет уровней
+            return
+        node = self._head
+        index += 1
+        for level in reversed(range(self.max_levels)):
+            while node.width[level] <= index:
+                index -= node.width[level]
+                node = node.next[level]
+        # Остановились на ключе с номером index
+        while node is not self._tail:
+            yield node.key
+            node = node.next[0]
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        return next(self.iter_from(index))
+
+class Leaderboard:
+    """
+    Пользователи, упорядоченные по накопленному TRF.
+
+    Ключ - тот же непрерывный счёт, что и у индекса idx_users_score:
+    trf - rate * 24 * julianday(last_passive_income). Он не меняется
+    со временем и при начислении пассивного дохода, поэтому запись
+    пересчитывается только при изменении пользователя. Топ и место
+    считаются по этому счёту, то есть по накопленному балансу вместе
+    с долей текущего часа: точный пересчёт баланса по часам пришлось бы
+    делать для всех с балансом в пределах rate, а при стартовых 100 TRF
+    это почти все пользователи. Показывается накопленный баланс.
+    """
+    def __init__(self, trf_per_hour):
+        self.rate = trf_per_hour
+        self._rate_per_day = float(trf_per_hour) * 24
+        self._keys = IndexableSkipList()
+        # user_id -> (ключ, trf, julianday последнего дохода, username, first_name, kkl)
+        self._users = {}
+        self._lock = threading.Lock()
+        # Изменения, пришедшие во время load: (user_id, запись или None)
+        self._changes = None
+
+    def __len__(self):
+        return len(self._users)
+
+    def _entry(self, user_id, username, first_name, trf, kkl, last_passive_income):
+        last = julianday(last_passive_income)
+        score = trf - self._rate_per_day * last if last is not None else -math.inf
+        return (-score, user_id), trf, last, username, first_name, kkl
+
+    def _accrued(self, entry, now_jd):
+        _, trf, last, *_ = entry
+        if last is None:
+            return trf
+        return trf + self.rate * max(0, int((now_jd - last) * 24))
+
+    def load(self, users):
+        """
+        Заполнение из строк (user_id, username, first_name, trf, kkl, last_passive_income).
+        Новая таблица строится без блокировки - топ и места в это время
+        отвечают по старой, - а изменения, пришедшие за время построения,
+        применяются к ней перед подменой.
+        """
+        with self._lock:
+            self._changes = []
+        try:
+            entries = {row[0]: self._entry(*row) for row in users}
+            keys = IndexableSkipList()
+            keys.build(sorted(entry[0] for entry in entries.values()))
+            with self._lock:
+                for user_id, entry in self._changes:
+                    self._apply(keys, entries, user_id, entry)
+                self._users, self._keys = entries, keys
+        finally:
+            with self._lock:
+                self._changes = None
+
+    @staticmethod
+    def _apply(keys, users, user_id, entry):
+        old = users.pop(user_id, None)
+        if old is not None and (entry is None or old[0] != entry[0]):
+            keys.remove(old[0])
+        if entry is not None:
+            if old is None or old[0] != entry[0]:
+                keys.insert(entry[0])
+            users[user_id] = entry
+
+    def update(self, user):
+        """Обновление по записи пользователя из базы (dict)"""
+        entry = self._entry(user['user_id'], user['username'], user['first_name'],
+                            user['trf'], user['kkl'], user['last_passive_income'])
+        with self._lock:
+            self._apply(self._keys, self._users, user['user_id'], entry)
+            if self._changes is not None:
+                self._changes.append((user['user_id'], entry))
+
+    def remove(self, user_id):
+        with self._lock:
+            self._apply(self._keys, self._users, user_id, None)
+            if self._changes is not None:
+                self._changes.append((user_id, None))
+
+    def top(self, limit=10, now=None):
+        """
+        Топ по счёту: [(user_id, username, first_name, trf, kkl)], в том же
+        виде и порядке, что и Database.get_top_users. O(log n + limit)
+        """
+        now_jd = julianday(now or datetime.now())
+        top = []
+        with self._lock:
+            for key in itertools.islice(self._keys.iter_from(0), limit):
+                entry = self._users[key[1]]
+                top.append((key[1], entry[3], entry[4], self._accrued(entry, now_jd), entry[5]))
+        return top
+
+    def rank(self, user_id):
+        """
+        (место, всего пользователей) или None. Место - 1 + число
+        пользователей со строго большим счётом, O(log n)
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            # Перед (-счёт, -inf) стоят только ключи с большим счётом
+            above = self._keys.rank((entry[0][0], -math.inf))
+            return above + 1, len(self._users)
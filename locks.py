@@ -0,0 +1,55 @@
+"""
+Блокировки по ключу (user_id) для команд, меняющих балансы.
+
+Каждая отдельная запись в базе и так атомарна, но команда - это чтение,
+проверки, иногда пауза (заседание суда) и запись. Пока команда
+пользователя выполняется, другие его команды ждут своей очереди.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+from config import USER_LOCK_STRIPES
+
+class KeyedLocks:
+    """
+    Фиксированный набор asyncio.Lock (полос), ключ попадает в полосу
+    по хэшу: память не растёт с числом пользователей, а разные ключи
+    изредка делят одну полосу, что лишь добавляет ожидания.
+
+    hold() для нескольких ключей берёт их полосы по возрастанию номера,
+    поэтому две команды с общими участниками не ждут друг друга по кругу.
+    """
+    def __init__(self, stripes=USER_LOCK_STRIPES):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+        self.acquired = 0
+        self.contended = 0
+
+    def _stripes(self, keys):
+        return sorted({hash(key) % len(self._locks) for key in keys})
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        held = []
+        try:
+            for stripe in self._stripes(keys):
+                lock = self._locks[stripe]
+                if lock.locked():
+                    self.contended += 1
+                await lock.acquire()
+                held.append(lock)
+            self.acquired += 1
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+    def stats(self):
+        return {
+            'stripes': len(self._locks),
+            'busy': sum(lock.locked() for lock in self._locks),
+            'acquired': self.acquired,
+            'contended': self.contended
+        }
+
+# Общие для процесса блокировки пользователей
+user_locks = KeyedLocks()
@@ -1,12 +1,29 @@
 import logging
 from telegram import Update
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, 
+    Application, MessageHandler, 
     CallbackQueryHandler, filters, ContextTypes,
-    ApplicationBuilder, JobQueue
+    ApplicationBuilder, TypeHandler
 )
-from config import BOT_TOKEN
-from database import Database
+from config import (
+    BOT_TOKEN, DANGER_TICK, UPDATE_CONCURRENCY, BOT_API_POOL_SIZE, BOT_API_POOL_TIMEOUT, WEBHOOK_URL,
+    OUTBOUND_GLOBAL_RATE, SHARD_WORKERS, METRICS_PORT, ADMIN_IDS, KNOWN_MEMBERS_CACHE_SIZE,
+    is_admin
+)
+from database import Database, AsyncDatabase
+from cache import LRUCache
+import asyncio
+import functools
+import html
+import metrics
+import outbound
+import shards
+import timers
+import webhook
+from locks import user_locks
+from router import CommandRouter
+from outbound import reply
+from scheduler import Scheduler
 import handlers.commands as commands
 import handlers.economy as economy
 import handlers.court as court
@@ -20,8 +37,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Инициализация базы данных
-db = Database()
+# Инициализация базы данных (запросы выполняются вне event loop)
+db = AsyncDatabase(Database())
 
 # Middleware для проверки бана
 async def check_ban_middleware(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -29,140 +46,241 @@ async def check_ban_middleware(update: Update, context: ContextTypes.DEFAULT_TYP
     if not update.effective_user:
         return True
     
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
-    
-    if user and user['is_banned'] and user['banned_until']:
-        banned_until = datetime.fromisoformat(user['banned_until'])
-        if banned_until > datetime.now():
-            remaining = (banned_until - datetime.now()).total_seconds()
-            from utils import format_time_remaining
-            await update.message.reply_text(
-                f"🚫 Вы изгнаны в болото! "
-                f"Возвращение через: {format_time_remaining(remaining)}\n"
-                f"Причина: нарушение Устава Торфяного Конгресса"
-            )
-            return False
-        else:
-            # Разбан если время вышло
-            db.update_user(user_id, is_banned=False, banned_until=None)
+    # Баны хранятся в памяти (Database.bans), база здесь не нужна
+    banned_until = db.bans.banned_until(update.effective_user.id)
+    
+    if banned_until:
+        remaining = (banned_until - datetime.now()).total_seconds()
+        from utils import format_time_remaining
+        await reply(update, 
+            f"🚫 Вы изгнаны в болото! "
+            f"Возвращение через: {format_time_remaining(remaining)}\n"
+            f"Причина: нарушение Устава Торфяного Конгресса"
+        )
+        return False
     
     return True
 
-# Обёртки для команд с проверкой бана
-async def wrapped_command(handler, update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обертка для команд с проверкой бана"""
-    if not await check_ban_middleware(update, context):
+# Участники чатов: (chat_id, user_id), уже записанные в базу этим процессом.
+# Только для экономии запросов: вытесненная пара просто запишется ещё раз
+# (add_chat_members идемпотентна)
+known_members = LRUCache(KNOWN_MEMBERS_CACHE_SIZE)
+
+async def track_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запись участников чата по входящим апдейтам (база - только для новых)"""
+    chat = update.effective_chat
+    if not chat:
+        return
+    
+    message = update.message
+    if message and message.left_chat_member:
+        member_id = message.left_chat_member.id
+        known_members.invalidate((chat.id, member_id))
+        await db.remove_chat_member(chat.id, member_id)
+        return
+    
+    users = list(message.new_chat_members) if message and message.new_chat_members else []
+    if update.effective_user:
+        users.append(update.effective_user)
+    new_ids = [user.id for user in users
+               if not user.is_bot and known_members.get((chat.id, user.id)) is None]
+    if new_ids:
+        await db.add_chat_members(chat.id, new_ids)
+        for user_id in new_ids:
+            known_members.put((chat.id, user_id), True)
+
+def command_parties(update: Update):
+    """Пользователи, чьи балансы может менять команда: автор и тот, кому он ответил"""
+    parties = [update.effective_user.id]
+    reply_to = update.message.reply_to_message if update.message else None
+    if reply_to and reply_to.from_user:
+        parties.append(reply_to.from_user.id)
+    return parties
+
+# Выполнение команд, найденных CommandRouter
+async def run_command(command, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проверка бана и частоты вызовов, затем сама команда"""
+    if command.ban_check and not await check_ban_middleware(update, context):
+        return
+    
+    wait = command.cooldown_left(update.effective_user.id)
+    if wait:
+        from utils import format_time_remaining
+        await reply(update, f"⏳ /{command.name} будет доступна через {format_time_remaining(wait)}")
         return
     
     # Добавляем db в context для использования в обработчиках
     context.user_data['db'] = db
-    await handler(update, context, db)
+    # Время команды - вместе с ожиданием блокировок, как его видит пользователь
+    with metrics.track(command.name):
+        if not command.serialized:
+            await command.callback(update, context, db)
+            return
+        
+        # Команды, меняющие балансы, выполняются по очереди для каждого участника
+        async with user_locks.hold(*command_parties(update)):
+            await command.callback(update, context, db)
+
+# Команды приложения (создаются в setup_handlers)
+command_router = None
 
-# Фабрики команд
-def create_command_handler(handler_func):
-    """Создает обработчик команды с оберткой"""
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await wrapped_command(handler_func, update, context)
-    return wrapper
+# Фоновые задачи (расписание в базе, см. scheduler.py)
+scheduler = Scheduler(db)
 
-# Фоновые задачи
-async def danger_scheduler_wrapper(context: ContextTypes.DEFAULT_TYPE):
-    """Обертка для планировщика опасностей"""
-    await dangers.danger_scheduler(context.application, db)
+async def danger_job(shard=(0, 1)):
+    """Опасности для чатов этого процесса, чей срок подошёл"""
+    await dangers.danger_tick(db, shard)
 
-async def passive_income_scheduler_wrapper(context: ContextTypes.DEFAULT_TYPE):
-    """Обертка для пассивного дохода"""
-    await economy.passive_income_scheduler(context.application, db)
+async def ban_expired(due):
+    """Снятие истёкших банов одним пакетом: таймеры ban_expire"""
+    unbanned = await db.sweep_bans()
+    if unbanned:
+        logger.info("Вернулись из болота: %d", unbanned)
 
-async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
     """Статистика для админа"""
-    # Замените 123456789 на ваш ID
-    if update.effective_user.id != 123456789:
+    if not is_admin(update.effective_user.id):
         return
     
-    with db.get_connection() as conn:
-        cur = conn.cursor()
-        
-        cur.execute('SELECT COUNT(*) FROM users')
-        user_count = cur.fetchone()[0]
-        
-        cur.execute('SELECT COUNT(*) FROM court_cases')
-        case_count = cur.fetchone()[0]
-        
-        cur.execute('SELECT SUM(trf) FROM users')
-        total_trf = cur.fetchone()[0] or 0
-        
-        cur.execute('SELECT SUM(kkl) FROM users')
-        total_kkl = cur.fetchone()[0] or 0
+    data = await db.get_stats()
     
     stats = f"""
 📊 <b>АДМИН СТАТИСТИКА</b>
 
-👥 Пользователей: {user_count}
-⚖️ Судебных дел: {case_count}
-💰 Всего TRF в системе: {total_trf}
-🥬 Всего KKL в системе: {total_kkl}
+👥 Пользователей: {data['user_count']}
+⚖️ Судебных дел: {data['case_count']}
+💰 Всего TRF в системе: {data['total_trf']}
+🥬 Всего KKL в системе: {data['total_kkl']}
+
+🗂 Кэш пользователей: {data['user_cache']['size']}/{data['user_cache']['max_size']}
+🎯 Попаданий: {data['user_cache']['hits']}, промахов: {data['user_cache']['misses']} ({data['user_cache']['hit_rate']:.0%})
+"""
+    
+    if outbound.dispatcher:
+        queue = outbound.dispatcher.stats()
+        stats += f"""
+📤 Очередь отправки: {queue['queued']} (максимум {queue['max_depth']}), чатов: {queue['chats']}
+✉️ Отправлено: {queue['sent']}, повторов: {queue['retried']}, ошибок: {queue['failed']}
 """
     
-    await update.message.reply_text(stats, parse_mode="HTML")
+    if command_router:
+        routed = command_router.stats()
+        popular = sorted(routed['calls'].items(), key=lambda item: item[1], reverse=True)[:5]
+        stats += f"🧭 Команд: {routed['commands']} ({routed['aliases']} имён), неизвестных: {routed['unknown']}\n"
+        if popular:
+            stats += "   " + ", ".join(f"/{name} {calls}" for name, calls in popular) + "\n"
+    
+    slowest = metrics.summary()
+    if slowest:
+        stats += "🐢 Медленные команды (p95 / среднее, доля базы и Telegram):\n"
+        for name, calls, p95, mean, errors, db_share, telegram_share in slowest:
+            stats += (f"   /{name}: {calls} раз, ≤{p95 * 1000:.0f} / {mean * 1000:.0f} ms, "
+                      f"база {db_share:.0%}, Telegram {telegram_share:.0%}, ошибок {errors}\n")
+    
+    members = known_members.stats()
+    stats += f"👤 Известных участников: {members['size']}/{members['max_size']}, попаданий {members['hit_rate']:.0%}\n"
+    
+    locks = user_locks.stats()
+    stats += f"🔒 Блокировки: занято {locks['busy']}/{locks['stripes']}, ожиданий {locks['contended']} из {locks['acquired']}\n"
+    
+    if timers.service:
+        pending = timers.service.stats()
+        stats += f"⏳ Таймеров: {pending['pending']}, сработало: {pending['fired']}, ошибок: {pending['failed']}\n"
+    
+    if webhook.server:
+        hook = webhook.server.stats()
+        stats += f"🪝 Вебхук: принято {hook['received']}, в обработке {hook['pending']}, отклонено {hook['rejected']}, неверных {hook['invalid']}\n"
+    
+    for job in await db.get_jobs():
+        stats += f"⏱ {job['name']}: запусков {job['runs']}, пропущено {job['missed']}, последний {job['last_duration'] or 0:.2f} с\n"
+    
+    await reply(update, stats, parse_mode="HTML")
+
+async def admin_sql_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncDatabase):
+    """Профилировщик запросов: /admin_sql [on|off|reset]"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    action = context.args[0].lower() if context.args else None
+    if action in ('on', 'off'):
+        await db.set_profiling(action == 'on')
+    elif action == 'reset':
+        db.profiler.reset()
+    
+    profiler = db.profiler
+    text = f"🔬 <b>Профилирование запросов: {'включено' if profiler.enabled else 'выключено'}</b>\n"
+    methods = list(profiler.by_method().items())[:8]
+    if methods:
+        since = datetime.fromtimestamp(profiler.started).strftime('%d.%m %H:%M')
+        text += f"\nПо методам с {since}:\n"
+        for method, (count, seconds, rows) in methods:
+            text += f"   {html.escape(method)}: {count} запросов, {seconds * 1000:.0f} ms, строк {rows}\n"
+    
+    top = profiler.top(5)
+    if top:
+        text += "\nДольше всего в сумме:\n"
+        for method, query, stats in top:
+            text += (f"   {stats.count} × {stats.seconds / stats.count * 1000:.2f} ms "
+                     f"(макс. {stats.max_seconds * 1000:.1f}) {html.escape(method)}\n"
+                     f"   <code>{html.escape(query[:120])}</code>\n")
+    
+    if profiler.slow:
+        text += f"\nМедленные (от {profiler.slow_seconds * 1000:.0f} ms), последние:\n"
+        for moment, seconds, method, query, shape in list(profiler.slow)[-5:]:
+            text += (f"   {datetime.fromtimestamp(moment).strftime('%H:%M:%S')} {seconds * 1000:.0f} ms "
+                     f"{html.escape(method)} <code>{html.escape(query[:80])}</code> {html.escape(shape)}\n")
+    
+    await reply(update, text, parse_mode="HTML")
 
 def setup_handlers(application: Application):
     """Настройка всех обработчиков команд"""
     
+    # Участники чатов - до всех команд, для любых апдейтов
+    application.add_handler(TypeHandler(Update, track_chat_members), group=-1)
+    
+    # Все команды - один обработчик со словарём имён (router.py).
+    # Первое имя - основное, остальные - псевдонимы
+    global command_router
+    command_router = router = CommandRouter(run_command)
+    
     # Основные команды
-    application.add_handler(CommandHandler("start", create_command_handler(commands.start_command)))
-    application.add_handler(CommandHandler("status", create_command_handler(commands.status_command)))
-    application.add_handler(CommandHandler("diagnostika", create_command_handler(commands.diagnostika_command)))
-    application.add_handler(CommandHandler("диагностика", create_command_handler(commands.diagnostika_command)))
-    application.add_handler(CommandHandler("aksioma", create_command_handler(commands.aksioma_command)))
-    application.add_handler(CommandHandler("аксиома", create_command_handler(commands.aksioma_command)))
-    application.add_handler(CommandHandler("novosti", create_command_handler(commands.novosti_command)))
-    application.add_handler(CommandHandler("новости", create_command_handler(commands.novosti_command)))
-    application.add_handler(CommandHandler("top", create_command_handler(commands.top_command)))
-    application.add_handler(CommandHandler("help", create_command_handler(commands.help_command)))
-    application.add_handler(CommandHandler("помощь", create_command_handler(commands.help_command)))
-    application.add_handler(CommandHandler("moi_dela", create_command_handler(commands.moi_dela_command)))
-    application.add_handler(CommandHandler("мои_дела", create_command_handler(commands.moi_dela_command)))
+    router.add(commands.start_command, "start", serialized=True)
+    router.add(commands.status_command, "status")
+    router.add(commands.diagnostika_command, "diagnostika", "диагностика")
+    router.add(commands.aksioma_command, "aksioma", "аксиома")
+    router.add(commands.novosti_command, "novosti", "новости")
+    router.add(commands.top_command, "top")
+    router.add(commands.rank_command, "rank", "mesto", "место")
+    router.add(commands.help_command, "help", "помощь")
+    router.add(commands.moi_dela_command, "moi_dela", "мои_дела")
     
     # Команды лечения
-    application.add_handler(CommandHandler("vnesti_izvest", create_command_handler(commands.vnesti_izvest_command)))
-    application.add_handler(CommandHandler("внести_известь", create_command_handler(commands.vnesti_izvest_command)))
-    application.add_handler(CommandHandler("podkormit_torfom", create_command_handler(commands.podkormit_torfom_command)))
-    application.add_handler(CommandHandler("подкормить_торфом", create_command_handler(commands.podkormit_torfom_command)))
-    application.add_handler(CommandHandler("podkislit", create_command_handler(commands.podkislit_command)))
-    application.add_handler(CommandHandler("подкислить", create_command_handler(commands.podkislit_command)))
-    application.add_handler(CommandHandler("ekstr_sredstvo", create_command_handler(commands.ekstr_sredstvo_command)))
-    application.add_handler(CommandHandler("экстренное_средство", create_command_handler(commands.ekstr_sredstvo_command)))
-    application.add_handler(CommandHandler("lechit_perforaciyu", create_command_handler(commands.lechit_perforaciyu_command)))
-    application.add_handler(CommandHandler("лечить_перфорацию", create_command_handler(commands.lechit_perforaciyu_command)))
+    router.add(commands.vnesti_izvest_command, "vnesti_izvest", "внести_известь", serialized=True)
+    router.add(commands.podkormit_torfom_command, "podkormit_torfom", "подкормить_торфом", serialized=True)
+    router.add(commands.podkislit_command, "podkislit", "подкислить", serialized=True)
+    router.add(commands.ekstr_sredstvo_command, "ekstr_sredstvo", "экстренное_средство", serialized=True)
+    router.add(commands.lechit_perforaciyu_command, "lechit_perforaciyu", "лечить_перфорацию", serialized=True)
     
     # Экономика
-    application.add_handler(CommandHandler("kopat_torf", create_command_handler(economy.kopat_torf_command)))
-    application.add_handler(CommandHandler("добыть_торф", create_command_handler(economy.kopat_torf_command)))
-    application.add_handler(CommandHandler("sobrat_kletchatku", create_command_handler(economy.sobrat_kletchatku_command)))
-    application.add_handler(CommandHandler("собрать_клетчатку", create_command_handler(economy.sobrat_kletchatku_command)))
-    application.add_handler(CommandHandler("torforazvedka", create_command_handler(economy.torforazvedka_command)))
-    application.add_handler(CommandHandler("торфоразведка", create_command_handler(economy.torforazvedka_command)))
-    application.add_handler(CommandHandler("kupit_kletchatku", create_command_handler(economy.kupit_kletchatku_command)))
-    application.add_handler(CommandHandler("купить_клетчатку", create_command_handler(economy.kupit_kletchatku_command)))
+    router.add(economy.kopat_torf_command, "kopat_torf", "добыть_торф", serialized=True)
+    router.add(economy.sobrat_kletchatku_command, "sobrat_kletchatku", "собрать_клетчатку", serialized=True)
+    router.add(economy.torforazvedka_command, "torforazvedka", "торфоразведка", serialized=True)
+    router.add(economy.kupit_kletchatku_command, "kupit_kletchatku", "купить_клетчатку", serialized=True)
     
     # Суды
-    application.add_handler(CommandHandler("sud_selezenki", create_command_handler(court.sud_selezenki_command)))
-    application.add_handler(CommandHandler("суд_селезёнки", create_command_handler(court.sud_selezenki_command)))
-    application.add_handler(CommandHandler("sud_redodendrona", create_command_handler(court.sud_redodendrona_command)))
-    application.add_handler(CommandHandler("суд_редодендрона", create_command_handler(court.sud_redodendrona_command)))
-    application.add_handler(CommandHandler("sud_kishki", create_command_handler(court.sud_kishki_command)))
-    application.add_handler(CommandHandler("суд_кишки", create_command_handler(court.sud_kishki_command)))
+    router.add(court.sud_selezenki_command, "sud_selezenki", "суд_селезёнки", serialized=True)
+    router.add(court.sud_redodendrona_command, "sud_redodendrona", "суд_редодендрона", serialized=True)
+    router.add(court.sud_kishki_command, "sud_kishki", "суд_кишки", serialized=True)
     
     # Защита
-    application.add_handler(CommandHandler("zashita_co2", create_command_handler(dangers.zashita_co2_command)))
-    application.add_handler(CommandHandler("защита_co2", create_command_handler(dangers.zashita_co2_command)))
-    application.add_handler(CommandHandler("Kiparis_zashita", create_command_handler(dangers.kiparis_zashita_command)))
-    application.add_handler(CommandHandler("кипарис_защита", create_command_handler(dangers.kiparis_zashita_command)))
+    router.add(dangers.zashita_co2_command, "zashita_co2", "защита_co2", serialized=True)
+    router.add(dangers.kiparis_zashita_command, "kiparis_zashita", "кипарис_защита", serialized=True)
     
     # Админ команды
-    application.add_handler(CommandHandler("admin_stats", admin_stats_command))
+    router.add(admin_stats_command, "admin_stats", ban_check=False)
+    router.add(admin_sql_command, "admin_sql", ban_check=False)
+    
+    application.add_handler(router)
     
     # Обработка обычных сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, commands.echo))
@@ -171,54 +289,104 @@ async def on_startup(application: Application):
     """Действия при запуске бота"""
     logger.info("Торфобот запущен! Служу Торфяному Конгрессу! 🥬")
     
-    # Уведомление админу
-    try:
-        await application.bot.send_message(
-            chat_id=123456789,  # Замените на ваш ID
-            text="✅ Торфобот запущен и готов служить Сети!"
-        )
-    except:
-        pass
+    # В режиме нескольких процессов (shards.py): номер процесса и их число.
+    # Всё, что бот отправляет в чат сам (опасности, таймеры), отправляет
+    # процесс этого чата - тот же, что отвечает на его команды, поэтому
+    # лимит чата считает одна очередь. Общий лимит бота делится поровну
+    index, count = application.bot_data.get('shard', (0, 1))
+    
+    # Все исходящие сообщения - через очередь с лимитами Telegram
+    outbound.start(application.bot, global_rate=OUTBOUND_GLOBAL_RATE / count)
+    
+    # /metrics для Prometheus: у каждого процесса свой порт
+    await metrics.start(METRICS_PORT + index if METRICS_PORT else 0)
+    
+    # Отложенные события игры (таймеры хранятся в базе), только свои чаты
+    await timers.start(db, {
+        "turtle_damage": functools.partial(dangers.turtle_damage, db=db),
+        "turtle_expire": functools.partial(dangers.turtle_expired, db=db),
+        "co2_expire": functools.partial(dangers.co2_expired, db=db),
+        "court_hearing": functools.partial(court.complete_hearings, db=db),
+        "ban_expire": ban_expired,
+    }, shard=(index, count))
+    
+    # Фоновые задачи. Время запуска хранится в базе и переживает перезапуск.
+    # Опасности: каждый чат раз в DANGER_INTERVAL, в своё время -
+    # проверка идёт часто, но срабатывает лишь малая часть чатов.
+    # У каждого процесса своя задача для своих чатов
+    job = "dangers" if count == 1 else f"dangers_{index}"
+    await scheduler.add_job(job, functools.partial(danger_job, (index, count)),
+                            interval=DANGER_TICK, first=10)
+    # Пассивный доход отдельной задачи не требует: он начисляется
+    # при обращении к пользователю (см. Database.get_user)
+    scheduler.start()
+    
+    # Уведомление админам (ADMIN_IDS) - из процесса их личного чата
+    for admin_id in ADMIN_IDS:
+        if admin_id % count == index:
+            await outbound.enqueue(admin_id, "✅ Торфобот запущен и готов служить Сети!")
+    
+    # Общие проверки - только в одном процессе
+    if index != 0:
+        return
+    
+    # Горячие запросы должны идти по индексам
+    for name, plan in (await db.audit_query_plans()).items():
+        logger.warning("Запрос %s выполняется полным просмотром: %s", name, " | ".join(plan))
 
 async def on_shutdown(application: Application):
     """Действия при остановке бота"""
     logger.info("Торфобот остановлен. Храните торф.")
-    await application.bot.close()
+    await scheduler.stop()
+    await timers.stop()
+    await outbound.stop()
+    await metrics.stop()
+    db.close()
 
-def main():
-    """Запуск бота"""
-    # Создание приложения
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+def build_application(token=BOT_TOKEN, concurrency=UPDATE_CONCURRENCY, polling=True, bot=None):
+    """
+    Приложение с параллельной обработкой апдейтов: долгая команда
+    (заседание суда) не задерживает остальные чаты. Без polling апдейты
+    приходят через вебхук (webhook.py), и Updater не создаётся.
+    bot - готовый бот вместо token (бенчмарки)
+    """
+    builder = (
+        ApplicationBuilder()
+        .concurrent_updates(concurrency)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if bot is None:
+        builder = builder.token(token).connection_pool_size(BOT_API_POOL_SIZE).pool_timeout(BOT_API_POOL_TIMEOUT)
+    else:
+        builder = builder.bot(bot)
+    if not polling:
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Настройка обработчиков
     setup_handlers(application)
+    return application
+
+def main():
+    """Запуск бота"""
+    if SHARD_WORKERS > 1:
+        # Миграции уже применены при открытии базы; апдейты обрабатывают
+        # процессы shards.py, у каждого своё соединение с базой
+        db.close()
+        shards.run(SHARD_WORKERS, polling=not WEBHOOK_URL)
+        return
     
-    # Настройка событий запуска/остановки
-    application.add_handler(CommandHandler("start", create_command_handler(commands.start_command)))
-    
-    # Запуск фоновых задач
-    job_queue = application.job_queue
-    
-    # Опасности каждые 3 часа
-    job_queue.run_repeating(
-        danger_scheduler_wrapper,
-        interval=10800,  # 3 часа в секундах
-        first=10  # Первый запуск через 10 секунд
-    )
+    # Создание приложения
+    application = build_application(polling=not WEBHOOK_URL)
     
-    # Пассивный доход каждый час
-    job_queue.run_repeating(
-        passive_income_scheduler_wrapper,
-        interval=3600,  # 1 час
-        first=30  # Первый запуск через 30 секунд
-    )
+    # Фоновые задачи запускаются в on_startup
     
     # Запуск бота
-    application.run_polling(
-        on_startup=on_startup,
-        on_shutdown=on_shutdown,
-        allowed_updates=Update.ALL_TYPES
-    )
+    if WEBHOOK_URL:
+        asyncio.run(webhook.run(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""
+Метрики процесса: время команд, запросов к базе и к Telegram.
+
+Команда выполняется внутри track(имя): её длительность попадает в
+гистограмму, а время запросов к базе (AsyncDatabase.run) и ожидания
+очереди отправок (outbound.send) складывается в её счётчики - текущая команда
+передаётся через contextvars, поэтому учитываются и вложенные корутины.
+Отдельно считается длительность самих вызовов Bot API по методам.
+
+Всё хранится в памяти процесса и отдаётся в текстовом формате
+Prometheus по GET /metrics на локальном порту (METRICS_PORT).
+"""
+import asyncio
+import bisect
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from config import METRICS_LISTEN, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (последняя - больше BUCKETS[-1])"""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля сверху - граница корзины, в которую он попал"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class CommandStats:
+    __slots__ = ('latency', 'errors', 'db_seconds', 'db_calls', 'telegram_seconds', 'telegram_calls')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.db_seconds = 0.0
+        self.db_calls = 0
+        self.telegram_seconds = 0.0
+        self.telegram_calls = 0
+
+# Команда, которая сейчас выполняется в этой корутине (None - вне команд)
+_current = contextvars.ContextVar('command_stats', default=None)
+
+commands = {}
+telegram_api = {}
+# Запросы к базе вне команд (таймеры, фоновые задачи)
+background = CommandStats()
+
+@contextmanager
+def track(name):
+    """Учёт выполнения команды name: длительность, ошибки, база и Telegram"""
+    stats = commands.get(name)
+    if stats is None:
+        stats = commands[name] = CommandStats()
+    token = _current.set(stats)
+    started = time.perf_counter()
+    try:
+        yield stats
+    except Exception:
+        stats.errors += 1
+        raise
+    finally:
+        stats.latency.observe(time.perf_counter() - started)
+        _current.reset(token)
+
+def add_db_time(seconds):
+    stats = _current.get() or background
+    stats.db_seconds += seconds
+    stats.db_calls += 1
+
+def add_telegram_wait(seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.telegram_seconds += seconds
+        stats.telegram_calls += 1
+
+def observe_api(method, seconds):
+    """Длительность одного вызова Bot API"""
+    histogram = telegram_api.get(method)
+    if histogram is None:
+        histogram = telegram_api[method] = Histogram()
+    histogram.observe(seconds)
+
+def summary(limit=5):
+    """Самые медленные команды по p95: [(имя, вызовов, p95, среднее, ошибок, доля базы, доля Telegram)]"""
+    rows = []
+    for name, stats in commands.items():
+        latency = stats.latency
+        if not latency.count:
+            continue
+        rows.append((name, latency.count, latency.quantile(0.95), latency.sum / latency.count,
+                     stats.errors, stats.db_seconds / latency.sum if latency.sum else 0.0,
+                     stats.telegram_seconds / latency.sum if latency.sum else 0.0))
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows[:limit]
+
+def _histogram_lines(name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+    yield f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}'
+    yield f'{name}_sum{{{labels}}} {histogram.sum:.6f}'
+    yield f'{name}_count{{{labels}}} {histogram.count}'
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = [
+        '# HELP torfobot_command_duration_seconds Длительность выполнения команды',
+        '# TYPE torfobot_command_duration_seconds histogram',
+    ]
+    for name, stats in sorted(commands.items()):
+        lines.extend(_histogram_lines('torfobot_command_duration_seconds', f'command="{name}"', stats.latency))
+
+    counters = (
+        ('torfobot_command_errors_total', 'Команды, завершившиеся исключением', 'errors'),
+        ('torfobot_command_db_seconds_total', 'Время запросов к базе во время команды', 'db_seconds'),
+        ('torfobot_command_db_calls_total', 'Запросов к базе во время команды', 'db_calls'),
+        ('torfobot_command_telegram_seconds_total', 'Ожидание отправок в Telegram во время команды', 'telegram_seconds'),
+        ('torfobot_command_telegram_calls_total', 'Отправок в Telegram с ожиданием во время команды', 'telegram_calls'),
+    )
+    for metric, help_text, attr in counters:
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for name, stats in sorted(commands.items()):
+            lines.append(f'{metric}{{command="{name}"}} {getattr(stats, attr)}')
+    lines.append('# HELP torfobot_background_db_seconds_total Время запросов к базе вне команд')
+    lines.append('# TYPE torfobot_background_db_seconds_total counter')
+    lines.append(f'torfobot_background_db_seconds_total {background.db_seconds:.6f}')
+
+    lines.append('# HELP torfobot_telegram_request_duration_seconds Длительность вызова Bot API')
+    lines.append('# TYPE torfobot_telegram_request_duration_seconds histogram')
+    for method, histogram in sorted(telegram_api.items()):
+        lines.extend(_histogram_lines('torfobot_telegram_request_duration_seconds', f'method="{method}"', histogram))
+    return '\n'.join(lines) + '\n'
+
+async def _serve(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            body = render().encode()
+            head = 'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+        else:
+            body = b''
+            head = 'HTTP/1.1 404 Not Found\r\n'
+        writer.write(f'{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# Сервер /metrics процесса (None - не запущен)
+server = None
+
+async def start(port=METRICS_PORT, host=METRICS_LISTEN):
+    """Запуск /metrics; порт 0 или None - без сервера"""
+    global server
+    if port:
+        server = await asyncio.start_server(_serve, host, port)
+        logger.info("Метрики: http://%s:%s/metrics", host, port)
+    return server
+
+async def stop():
+    global server
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+        server = None
@@ -0,0 +1,307 @@
+"""
+Очередь исходящих сообщений с ограничением скорости.
+
+Все отправки в Telegram идут через один Dispatcher: общий ограничитель
+на бота и отдельный на каждый чат (token bucket), повтор при RetryAfter
+и сетевых ошибках, ограниченная очередь и счётчики для статистики.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from config import (
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_BURST,
+    OUTBOUND_MAX_QUEUED, OUTBOUND_MAX_RETRIES, OUTBOUND_CONCURRENCY
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity накопленных"""
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """Взять токен: 0, если получилось, иначе сколько секунд ждать"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class _Outgoing:
+    __slots__ = ('method', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, method, kwargs, future):
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+class Dispatcher:
+    """
+    Отправка через bot с соблюдением лимитов Telegram.
+
+    Сообщения одного чата уходят строго по порядку (следующее - только
+    после ответа на предыдущее), разные чаты отправляются параллельно.
+    Чаты ждут своей очереди в куче по времени готовности, поэтому
+    чат, упёршийся в лимит, не задерживает остальные.
+    """
+    def __init__(self, bot, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 group_rate=OUTBOUND_GROUP_RATE, burst=OUTBOUND_BURST,
+                 max_queued=OUTBOUND_MAX_QUEUED, max_retries=OUTBOUND_MAX_RETRIES,
+                 concurrency=OUTBOUND_CONCURRENCY, retry_base=1.0, clock=time.monotonic):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self._clock = clock
+        self._global = TokenBucket(global_rate, burst, clock())
+        self._buckets = {}
+        self._queues = {}
+        # (время готовности, порядковый номер, chat_id) - по записи на чат
+        # с непустой очередью, у которого нет сообщения в пути
+        self._ready = []
+        self._seq = 0
+        self._slots = asyncio.Semaphore(max_queued)
+        self._sending = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._in_flight = set()
+
+        self.queued = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        return self
+
+    async def close(self, timeout=10.0):
+        """Остановка: ждём отправки очереди до timeout, остальное отменяется"""
+        deadline = self._clock() + timeout
+        while self.queued and self._clock() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._in_flight):
+            task.cancel()
+        for queue in self._queues.values():
+            for item in queue:
+                if not item.future.done():
+                    item.future.set_result(None)
+        self._queues.clear()
+        self._ready.clear()
+
+    def stats(self):
+        """Глубина очереди и счётчики"""
+        return {
+            'queued': self.queued,
+            'max_depth': self.max_depth,
+            'chats': len(self._queues),
+            'in_flight': len(self._in_flight),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed
+        }
+
+    async def enqueue(self, chat_id, text, method='send_message', **kwargs):
+        """
+        Постановка в очередь (ждёт свободного места, если очередь полна).
+        Возвращает future с результатом метода бота или None при неудаче.
+        """
+        await self._slots.acquire()
+        future = asyncio.get_running_loop().create_future()
+        kwargs['chat_id'] = chat_id
+        kwargs['text'] = text
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._schedule(chat_id, self._clock())
+        queue.append(_Outgoing(method, kwargs, future))
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self.queued)
+        return future
+
+    def _schedule(self, chat_id, when):
+        self._seq += 1
+        heapq.heappush(self._ready, (when, self._seq, chat_id))
+        self._wakeup.set()
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный chat_id - группа или канал, там лимит строже
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.burst, now)
+        return bucket
+
+    async def _wait(self, delay):
+        """Сон до delay секунд, прерываемый новым сообщением"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                await self._wait(None)
+                continue
+
+            now = self._clock()
+            when, _, chat_id = self._ready[0]
+            if when > now:
+                await self._wait(when - now)
+                continue
+
+            delay = self._global.take(now)
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+
+            heapq.heappop(self._ready)
+            delay = self._bucket(chat_id, now).take(now)
+            if delay:
+                # Общий токен не использован - возвращаем
+                self._global.tokens += 1
+                self._schedule(chat_id, now + delay)
+                continue
+
+            await self._sending.acquire()
+            item = self._queues[chat_id].popleft()
+            task = asyncio.create_task(self._deliver(chat_id, item))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _deliver(self, chat_id, item):
+        retry_in = last_error = None
+        started = time.perf_counter()
+        try:
+            result = await getattr(self.bot, item.method)(**item.kwargs)
+        except RetryAfter as error:
+            retry_in = error.retry_after
+            if isinstance(retry_in, timedelta):
+                retry_in = retry_in.total_seconds()
+            last_error = error
+        except BadRequest as error:
+            # Ошибка в самом запросе - повтор не поможет
+            self._finish(chat_id, item, None, error)
+        except NetworkError as error:
+            retry_in = self.retry_base * 2 ** item.attempts
+            last_error = error
+        except TelegramError as error:
+            self._finish(chat_id, item, None, error)
+        except asyncio.CancelledError:
+            if not item.future.done():
+                item.future.set_result(None)
+            raise
+        except Exception as error:
+            logger.exception("Сбой отправки в чат %s", chat_id)
+            self._finish(chat_id, item, None, error)
+        else:
+            self.sent += 1
+            self._finish(chat_id, item, result)
+        finally:
+            self._sending.release()
+            metrics.observe_api(item.method, time.perf_counter() - started)
+
+        if retry_in is not None and item.attempts >= self.max_retries:
+            self._finish(chat_id, item, None, last_error)
+        elif retry_in is not None:
+            item.attempts += 1
+            self.retried += 1
+            self._queues[chat_id].appendleft(item)
+            self._schedule(chat_id, self._clock() + float(retry_in))
+
+    def _finish(self, chat_id, item, result, error=None):
+        if error is not None:
+            self.failed += 1
+            logger.warning("Сообщение в чат %s не отправлено (%s): %s",
+                           chat_id, item.method, error)
+        if not item.future.done():
+            item.future.set_result(result)
+        self.queued -= 1
+        self._slots.release()
+
+        now = self._clock()
+        if self._queues[chat_id]:
+            self._schedule(chat_id, now)
+            return
+        del self._queues[chat_id]
+        # Ограничители простаивающих чатов не копятся без предела
+        if len(self._buckets) > 2 * len(self._queues) + 1000:
+            for idle in [cid for cid, bucket in self._buckets.items()
+                         if cid not in self._queues and bucket.full(now)]:
+                del self._buckets[idle]
+
+# Общий диспетчер процесса - создаётся при запуске бота
+dispatcher = None
+
+def start(bot, **kwargs):
+    global dispatcher
+    dispatcher = Dispatcher(bot, **kwargs).start()
+    return dispatcher
+
+async def stop(timeout=10.0):
+    global dispatcher
+    if dispatcher is not None:
+        await dispatcher.close(timeout)
+        dispatcher = None
+
+async def enqueue(chat_id, text, **kwargs):
+    """Сообщение в очередь без ожидания отправки (future с результатом)"""
+    if dispatcher is None:
+        raise RuntimeError("Очередь исходящих сообщений не запущена")
+    return await dispatcher.enqueue(chat_id, text, **kwargs)
+
+async def send(chat_id, text, **kwargs):
+    """
+    Отправка через очередь. Обработчик не ждёт самой отправки: он держит
+    блокировки пользователей и место в concurrent_updates, а группа
+    с лимитом 20 сообщений в минуту ждала бы секундами. Возвращает future
+    с результатом (Message или None); кому нужно отправленное сообщение,
+    ждут его отдельной задачей (см. court.start_hearing).
+    """
+    started = time.perf_counter()
+    try:
+        return await enqueue(chat_id, text, **kwargs)
+    finally:
+        # Ожидание места в полной очереди
+        metrics.add_telegram_wait(time.perf_counter() - started)
+
+async def reply(update, text, **kwargs):
+    """Замена update.message.reply_text через общую очередь (см. send)"""
+    message = update.effective_message
+    if dispatcher is None:
+        return await message.reply_text(text, **kwargs)
+    # Как reply_text: в группах - ответом на сообщение
+    if update.effective_chat.type != 'private':
+        kwargs.setdefault('reply_to_message_id', message.message_id)
+        kwargs.setdefault('allow_sending_without_reply', True)
+    return await send(update.effective_chat.id, text, **kwargs)
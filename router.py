@@ -0,0 +1,117 @@
+"""
+Разбор команд одним обработчиком.
+
+Вместо отдельного CommandHandler на каждое имя команды (PTB проверяет
+их по очереди для каждого апдейта) - один обработчик со словарём
+имя -> команда. Имя берётся из текста сообщения, а не из сущности
+bot_command: Telegram размечает только латинские команды, кириллические
+псевдонимы (/диагностика) иначе не распознавались бы. Регистр не важен,
+ё и е не различаются, суффикс @имя_бота отбрасывается (команда другому
+боту в группе - не наша).
+"""
+import time
+
+from telegram import Update
+from telegram.ext import BaseHandler
+
+from cache import LRUCache
+
+def normalize(name):
+    return name.casefold().replace('ё', 'е')
+
+class Command:
+    """
+    Команда и её свойства:
+    serialized - меняет балансы, выполняется под блокировками участников (locks.py);
+    ban_check - не выполняется для забаненных;
+    cooldown - секунд между вызовами одним пользователем, 0 - без ограничения.
+    """
+    __slots__ = ('name', 'callback', 'serialized', 'ban_check', 'cooldown', 'calls', '_last_call')
+
+    def __init__(self, name, callback, serialized=False, ban_check=True, cooldown=0,
+                 cooldown_users=10000):
+        self.name = name
+        self.callback = callback
+        self.serialized = serialized
+        self.ban_check = ban_check
+        self.cooldown = cooldown
+        self.calls = 0
+        # user_id -> время последнего вызова
+        self._last_call = LRUCache(cooldown_users) if cooldown else None
+
+    def cooldown_left(self, user_id, now=None):
+        """Секунд до следующего разрешённого вызова; 0 - можно (и вызов засчитан)"""
+        if not self.cooldown:
+            return 0
+        now = now or time.monotonic()
+        last = self._last_call.get(user_id)
+        if last is not None and now - last < self.cooldown:
+            return self.cooldown - (now - last)
+        self._last_call.put(user_id, now)
+        return 0
+
+class CommandRouter(BaseHandler):
+    """
+    Обработчик PTB для всех команд бота. Найденная команда передаётся
+    в run(command, update, context) - там проверки бана, блокировки
+    и вызов. context.args - слова после команды, как у CommandHandler.
+    """
+    def __init__(self, run):
+        super().__init__(run, block=True)
+        self._aliases = {}
+        self.commands = []
+        self.unknown = 0
+
+    def add(self, callback, *aliases, **options):
+        """Регистрация команды под несколькими именами; первое - основное"""
+        command = Command(aliases[0], callback, **options)
+        for alias in aliases:
+            key = normalize(alias)
+            if key in self._aliases:
+                raise ValueError(f"Команда /{alias} уже зарегистрирована")
+            self._aliases[key] = command
+        self.commands.append(command)
+        return command
+
+    def names(self):
+        """Все зарегистрированные имена (в нормализованном виде)"""
+        return list(self._aliases)
+
+    def parse(self, message):
+        """(команда, аргументы) для сообщения с командой этого бота, иначе None"""
+        text = message.text
+        if not text or text[0] != '/':
+            return None
+        words = text.split()
+        name, _, bot_name = words[0][1:].partition('@')
+        if bot_name:
+            bot = message.get_bot()
+            if bot.username is None or bot_name.casefold() != bot.username.casefold():
+                return None
+        command = self._aliases.get(normalize(name))
+        if command is None:
+            self.unknown += 1
+            return None
+        return command, words[1:]
+
+    def check_update(self, update):
+        if not isinstance(update, Update):
+            return None
+        # Как у CommandHandler: новые и отредактированные сообщения
+        message = update.message or update.edited_message
+        if message is None:
+            return None
+        return self.parse(message)
+
+    async def handle_update(self, update, application, check_result, context):
+        command, context.args = check_result
+        command.calls += 1
+        return await self.callback(command, update, context)
+
+    def stats(self):
+        return {
+            'commands': len(self.commands),
+            'aliases': len(self._aliases),
+            'unknown': self.unknown,
+            'calls': {command.name: command.calls for command in self.commands if command.calls}
+        }
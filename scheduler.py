@@ -0,0 +1,103 @@
+"""
+Планировщик фоновых задач с расписанием в базе.
+
+Время следующего запуска каждой задачи хранится в таблице jobs, поэтому
+после перезапуска расписание продолжается с того же места. Пропущенные
+за простой запуски сливаются в один. Перед запуском задача берётся
+в аренду (lease) одним UPDATE, так что даже при нескольких процессах
+одну задачу одновременно выполняет только один из них.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+from config import JOB_POLL_INTERVAL, JOB_LEASE
+
+logger = logging.getLogger(__name__)
+
+class Scheduler:
+    def __init__(self, db, poll_interval=JOB_POLL_INTERVAL, lease=JOB_LEASE):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.lease = lease
+        # Уникален для процесса: по нему видно, кто держит аренду
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._jobs = {}
+        self._running = {}
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    async def add_job(self, name, callback, interval, first=0):
+        """
+        Регистрация задачи: callback() - корутина без аргументов,
+        interval - период в секундах, first - задержка первого запуска
+        (только если задачи ещё нет в базе).
+        """
+        self._jobs[name] = callback
+        await self.db.register_job(name, interval, first)
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        """Остановка: новые запуски прекращаются, текущие отменяются"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Прерванные задачи сразу доступны другим процессам
+        await self.db.release_jobs(self.owner)
+
+    async def _run(self):
+        while True:
+            # Спим до ближайшего запуска, но не дольше poll_interval:
+            # расписание могли сдвинуть другие процессы. Ошибка базы
+            # (например, "database is locked") не останавливает цикл -
+            # следующая попытка через poll_interval
+            delay = self.poll_interval
+            try:
+                await self._tick()
+                idle = [name for name in self._jobs if name not in self._running]
+                next_run = await self.db.next_job_run(idle)
+                if next_run is not None:
+                    delay = min(delay, max(0.0, next_run - time.time()))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка планировщика задач")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _tick(self):
+        # Задачи, которые этот процесс ещё выполняет, не захватываются повторно
+        names = [name for name in self._jobs if name not in self._running]
+        for name, next_run, interval in await self.db.claim_due_jobs(names, self.owner, self.lease):
+            late = time.time() - next_run
+            if late > interval:
+                logger.info("Задача %s опоздала на %.0f с, пропущенные запуски объединены", name, late)
+            self._running[name] = asyncio.create_task(self._execute(name))
+
+    async def _execute(self, name):
+        started = time.time()
+        try:
+            await self._jobs[name]()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Задача %s завершилась с ошибкой", name)
+        finally:
+            self._running.pop(name, None)
+        await self.db.finish_job(name, self.owner, started, time.time() - started)
+        self._wakeup.set()
@@ -0,0 +1,215 @@
+"""
+Обработка апдейтов в нескольких процессах.
+
+Один процесс упирается в одно ядро: event loop, запросы к SQLite и
+логика команд делят его между собой. В этом режиме основной процесс
+только получает апдейты (long polling или вебхук) и раздаёт их
+процессам-обработчикам по chat_id: апдейты одного чата всегда идут в
+один процесс и обрабатываются там по порядку. Каждый обработчик - это
+`python shards.py <номер> <всего>`: полный набор обработчиков из
+main.setup_handlers, своё соединение с базой, свои очередь отправки и
+таймеры. Опасности и таймеры каждый процесс ведёт только для своих
+чатов, поэтому всё, что уходит в чат, уходит из одного процесса и
+укладывается в лимит чата. Проверку планов запросов выполняет процесс 0.
+
+Апдейты передаются построчно в JSON через stdin обработчика. Если
+обработчик не успевает, канал заполняется и основной процесс ждёт -
+при вебхуке это превращается в ответы 503.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+from config import (
+    BOT_TOKEN, SHARD_MAX_PENDING, SHARD_SYNC_INTERVAL, SHARD_LEADERBOARD_INTERVAL,
+    WEBHOOK_MAX_BODY
+)
+
+logger = logging.getLogger(__name__)
+
+def route_key(update):
+    """Ключ упорядочивания апдейта: чат, без чата - пользователь"""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+def shard_of(update, count):
+    return route_key(update) % count
+
+class ShardRouter:
+    """Процессы-обработчики основного процесса: запуск, раздача апдейтов, остановка"""
+    def __init__(self, count, worker=os.path.abspath(__file__)):
+        self.count = count
+        self.worker = worker
+        self._processes = [None] * count
+        self.routed = [0] * count
+        self.restarts = 0
+
+    async def start(self):
+        for index in range(self.count):
+            await self._spawn(index)
+        return self
+
+    async def _spawn(self, index):
+        self._processes[index] = await asyncio.create_subprocess_exec(
+            sys.executable, self.worker, str(index), str(self.count),
+            stdin=asyncio.subprocess.PIPE
+        )
+        logger.info("Обработчик %d/%d запущен, pid %d", index, self.count, self._processes[index].pid)
+
+    async def route(self, update):
+        index = shard_of(update, self.count)
+        line = json.dumps(update.to_dict(), ensure_ascii=False).encode() + b'\n'
+        process = self._processes[index]
+        if process.returncode is not None:
+            # Упавший обработчик перезапускается, его чаты ждут только этот апдейт
+            logger.error("Обработчик %d завершился (код %s), перезапуск", index, process.returncode)
+            self.restarts += 1
+            await self._spawn(index)
+            process = self._processes[index]
+        try:
+            process.stdin.write(line)
+            await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.error("Апдейт %s не передан обработчику %d", update.update_id, index)
+            return
+        self.routed[index] += 1
+
+    async def stop(self, timeout=30.0):
+        """Конец ввода: обработчики дорабатывают принятые апдейты и выходят"""
+        for process in self._processes:
+            if process and process.returncode is None:
+                process.stdin.close()
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Обработчик %d не остановился за %s с", index, timeout)
+                process.kill()
+                await process.wait()
+
+def run(count, polling=True, token=BOT_TOKEN):
+    """Основной процесс: получение апдейтов и раздача их count обработчикам"""
+    import webhook
+    router = ShardRouter(count)
+
+    async def start_workers(application):
+        await router.start()
+
+    async def stop_workers(application):
+        await router.stop()
+
+    async def route(update, context):
+        await router.route(update)
+
+    # Апдейты раздаются строго по одному - так сохраняется их порядок в чате
+    builder = ApplicationBuilder().token(token).post_init(start_workers).post_shutdown(stop_workers)
+    if not polling:
+        builder = builder.updater(None)
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, route))
+
+    if polling:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        asyncio.run(webhook.run(application))
+
+async def follow_other_workers(db, interval=SHARD_SYNC_INTERVAL,
+                               leaderboard_interval=SHARD_LEADERBOARD_INTERVAL):
+    """
+    Реестр банов и таблица лидеров обновляются записями своего процесса,
+    а записи других процессов подхватываются отсюда: баны - за interval,
+    топ (полный просмотр users) - не чаще раза в leaderboard_interval
+    """
+    stale = False
+    rebuilt = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await db.changed_elsewhere():
+                await db.load_bans()
+                stale = True
+            if stale and time.monotonic() - rebuilt >= leaderboard_interval:
+                await db.load_leaderboard()
+                stale = False
+                rebuilt = time.monotonic()
+        except Exception:
+            logger.exception("Ошибка обновления данных других обработчиков")
+
+async def _process(application, update, previous):
+    # Апдейт чата начинается только после предыдущего апдейта этого чата
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await application.update_processor.process_update(update, application.process_update(update))
+    except Exception:
+        logger.exception("Ошибка обработки апдейта %s", update.update_id)
+
+async def work(index, count, max_pending=SHARD_MAX_PENDING):
+    """Процесс-обработчик: апдейты из stdin до его закрытия"""
+    import main
+    from cache import LRUCache
+
+    # Строки пользователей меняют все процессы - кэш одного процесса
+    # устаревал бы незаметно для него
+    main.db.sync.user_cache = LRUCache(0)
+
+    application = main.build_application(polling=False)
+    application.bot_data['shard'] = (index, count)
+
+    # Остановка - по закрытию stdin основным процессом, не по Ctrl+C в терминале
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: None)
+
+    reader = asyncio.StreamReader(limit=2 * WEBHOOK_MAX_BODY)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    follower = asyncio.create_task(follow_other_workers(main.db))
+
+    # Последний апдейт каждого чата: следующий ждёт его завершения
+    tails = {}
+    slots = asyncio.Semaphore(max_pending)
+
+    def finished(key, task):
+        slots.release()
+        if tails.get(key) is task:
+            del tails[key]
+
+    try:
+        while line := await reader.readline():
+            update = Update.de_json(json.loads(line), application.bot)
+            await slots.acquire()
+            key = route_key(update)
+            task = asyncio.create_task(_process(application, update, tails.get(key)))
+            tails[key] = task
+            task.add_done_callback(functools.partial(finished, key))
+        if tails:
+            await asyncio.wait(list(tails.values()))
+    finally:
+        follower.cancel()
+        await asyncio.gather(follower, return_exceptions=True)
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+if __name__ == '__main__':
+    asyncio.run(work(int(sys.argv[1]), int(sys.argv[2])))
@@ -0,0 +1,253 @@
+"""
+Профилировщик SQL-запросов Database.
+
+Пока профилирование включено, соединения пула открываются с фабрикой
+ProfiledConnection: её курсоры замеряют выполнение и выборку строк и
+записывают их в QueryProfiler под ключом (метод Database, нормализованный
+текст). Нормализация убирает литералы и схлопывает списки IN (?, ?, ...),
+так что запросы с разными значениями считаются одним. Запросы дольше
+порога попадают в журнал медленных вместе с формой параметров (типы,
+без значений). Выключенный профилировщик ничего не стоит: соединения
+обычные, sqlite3.Connection.
+"""
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+
+from config import DB_SLOW_QUERY_MS, DB_SLOW_LOG_SIZE
+
+logger = logging.getLogger(__name__)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.:])-?\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+def normalize(sql):
+    """Текст запроса без литералов и лишних пробелов"""
+    sql = ' '.join(sql.split())
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    return _LIST.sub('(?, ...)', sql)
+
+def param_shape(parameters, many=False):
+    """Форма параметров: типы по позициям или именам, без самих значений"""
+    if many:
+        rows = parameters if isinstance(parameters, (list, tuple)) else list(parameters)
+        return f"{len(rows)} × {param_shape(rows[0])}" if rows else "0 строк"
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{name}: {type(value).__name__}'
+                               for name, value in sorted(parameters.items())) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+
+class QueryStats:
+    __slots__ = ('count', 'seconds', 'rows', 'max_seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.max_seconds = 0.0
+
+class QueryProfiler:
+    """
+    Счётчики по (метод, запрос): число выполнений, суммарное время
+    (выполнение и выборка строк), строки. Метод - внешний из вызовов
+    методов Database в стеке, то есть тот, что вызвали обработчики.
+    """
+    def __init__(self, slow_ms=DB_SLOW_QUERY_MS, slow_log_size=DB_SLOW_LOG_SIZE):
+        self.enabled = False
+        self.slow_seconds = slow_ms / 1000
+        self.slow = deque(maxlen=slow_log_size)
+        self.started = time.time()
+        self._stats = {}
+        self._normalized = {}
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def watch(self, cls):
+        """Методы класса, по которым группируются запросы"""
+        for name, attr in vars(cls).items():
+            code = getattr(attr, '__code__', None)
+            if code is not None:
+                self._methods[code] = name
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.slow.clear()
+            self.started = time.time()
+
+    def _caller(self):
+        # Внешний из методов Database в стеке (get_user, а не его помощник);
+        # без них - функция, выполнившая запрос
+        method = fallback = None
+        frame = sys._getframe(2)
+        while frame is not None:
+            name = self._methods.get(frame.f_code)
+            if name is not None:
+                method = name
+            elif fallback is None and frame.f_code.co_filename != __file__:
+                fallback = frame.f_code.co_name
+            frame = frame.f_back
+        return method or fallback
+
+    def begin(self, sql):
+        """Ключ статистики для нового выполнения запроса"""
+        text = self._normalized.get(sql)
+        if text is None:
+            if len(self._normalized) > 10000:
+                self._normalized.clear()
+            text = self._normalized[sql] = normalize(sql)
+        return self._caller(), text
+
+    def add(self, key, seconds, rows=0, executed=False):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = QueryStats()
+            if executed:
+                stats.count += 1
+            stats.seconds += seconds
+            stats.rows += rows
+
+    def finish(self, key, seconds, parameters=(), many=False):
+        """Запрос выполнен целиком: максимум и журнал медленных"""
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is not None and seconds > stats.max_seconds:
+                stats.max_seconds = seconds
+        if seconds >= self.slow_seconds:
+            method, text = key
+            # Форма параметров нужна только медленным - строится здесь, а не на каждом execute
+            shape = param_shape(parameters, many)
+            self.slow.append((time.time(), seconds, method, text, shape))
+            logger.warning("Медленный запрос %.1f ms в %s: %s %s", seconds * 1000, method, text, shape)
+
+    def top(self, limit=10):
+        """Запросы по суммарному времени: [(метод, запрос, QueryStats)]"""
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: item[1].seconds, reverse=True)
+        return [(method, text, stats) for (method, text), stats in items[:limit]]
+
+    def by_method(self):
+        """{метод: (выполнений, секунд, строк)} по убыванию времени"""
+        totals = {}
+        with self._lock:
+            for (method, _), stats in self._stats.items():
+                count, seconds, rows = totals.get(method, (0, 0.0, 0))
+                totals[method] = (count + stats.count, seconds + stats.seconds, rows + stats.rows)
+        return dict(sorted(totals.items(), key=lambda item: item[1][1], reverse=True))
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Курсор, который засчитывает время execute и выборки строк текущему
+    запросу. Запрос считается законченным, когда строки выбраны до конца,
+    курсор выполняет следующий запрос, закрывается или удаляется.
+    """
+    _key = None
+    _elapsed = 0.0
+    _parameters = ()
+    _many = False
+
+    def _run(self, method, sql, parameters, many=False):
+        self._done()
+        profiler = self.connection.profiler
+        key = profiler.begin(sql)
+        started = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._key, self._elapsed = key, elapsed
+            self._parameters, self._many = parameters, many
+            # Без строк результата (INSERT, UPDATE, DDL) запрос уже закончен
+            finished = self.description is None
+            profiler.add(key, elapsed, max(self.rowcount, 0) if finished else 0, executed=True)
+            if finished:
+                self._done()
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        return self._run(super().executemany, sql, seq_of_parameters, many=True)
+
+    def _fetched(self, started, rows, exhausted):
+        if self._key is None:
+            return
+        elapsed = time.perf_counter() - started
+        self._elapsed += elapsed
+        self.connection.profiler.add(self._key, elapsed, rows)
+        if exhausted:
+            self._done()
+
+    def _done(self):
+        if self._key is not None:
+            self.connection.profiler.finish(self._key, self._elapsed, self._parameters, self._many)
+            self._key = None
+            self._parameters = ()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0, True)
+            raise
+        self._fetched(started, 1, False)
+        return row
+
+    def close(self):
+        self._done()
+        super().close()
+
+    def __del__(self):
+        # Курсор, из которого взяли одну строку и бросили (fetchone в get_user)
+        self._done()
+
+class ProfiledConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого - ProfiledCursor; profiler задаётся после открытия"""
+    profiler = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        # Коммит (сброс WAL на диск) - отдельной строкой метода, который его вызвал
+        key = self.profiler.begin('COMMIT')
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            elapsed = time.perf_counter() - started
+            self.profiler.add(key, elapsed, executed=True)
+            self.profiler.finish(key, elapsed)
@@ -0,0 +1,63 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from database import Database
+
+def test_verify_leaderboard_on_empty_database(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        assert db.verify_leaderboard() == []
+        assert db.leaderboard.top(10) == []
+    finally:
+        db.close()
+
+def test_verify_leaderboard(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        for user_id in range(1, 30):
+            db.create_user(user_id, f'user{user_id}', f'User {user_id}')
+        db.update_user(5, trf=1000)
+        db.update_user(7, trf=50)
+        assert db.verify_leaderboard(samples=29) == []
+        assert db.leaderboard.rank(5) == (1, 29)
+        assert db.leaderboard.rank(7) == (29, 29)
+    finally:
+        db.close()
+
+def test_claim_due_chats_by_shard(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        chats = [-100, -7, -3, 4, 9, 1001]
+        with db.transaction() as conn:
+            conn.executemany('INSERT INTO chats (chat_id, next_danger_at) VALUES (?, 0)',
+                             [(chat_id,) for chat_id in chats])
+        claimed = [db.claim_due_chats(100, shard=(index, 3)) for index in range(3)]
+        for index, shard_chats in enumerate(claimed):
+            # Тот же остаток, что у shards.shard_of (неотрицательный)
+            assert sorted(shard_chats) == sorted(c for c in chats if c % 3 == index)
+    finally:
+        db.close()
+
+def test_set_profiling_closes_busy_readers(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'), readers=1)
+    try:
+        with db.get_connection(write=False) as busy:
+            # Единственный читатель занят: второй поток ждёт старую очередь
+            result = []
+            waiter = threading.Thread(target=lambda: result.append(db.get_chat_members(-1)))
+            waiter.start()
+            time.sleep(0.1)
+            db.set_profiling(True)
+            waiter.join(5)
+            assert not waiter.is_alive() and result == [[]]
+        # Возвращённый в заменённую очередь читатель закрыт, а не потерян
+        with pytest.raises(sqlite3.ProgrammingError):
+            busy.execute('SELECT 1')
+        assert db._readers.qsize() == 1
+        db.set_profiling(False)
+        assert db._readers.qsize() == 1
+    finally:
+        db.close()
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+from leaderboard import IndexableSkipList, Leaderboard
+
+NOW = datetime(2024, 5, 1, 12, 30)
+
+def user(user_id, trf, hours_ago=0.0):
+    last = (NOW - timedelta(hours=hours_ago)).isoformat()
+    return (user_id, f'user{user_id}', f'User {user_id}', trf, 5, last)
+
+def test_empty_skip_list():
+    keys = IndexableSkipList(16)
+    assert list(keys.iter_from(0)) == []
+    assert list(keys.iter_from(3)) == []
+    keys.insert(1)
+    keys.remove(1)
+    assert list(keys.iter_from(0)) == []
+
+def test_iter_from_past_the_end():
+    keys = IndexableSkipList(16)
+    keys.build(range(10))
+    assert list(keys.iter_from(7)) == [7, 8, 9]
+    assert list(keys.iter_from(10)) == []
+
+def test_empty_board():
+    board = Leaderboard(15)
+    board.load([])
+    assert board.top(10, NOW) == []
+    assert board.rank(1) is None
+
+def test_emptied_board():
+    board = Leaderboard(15)
+    board.load([user(1, 100), user(2, 200)])
+    board.remove(1)
+    board.remove(2)
+    assert board.top(10, NOW) == []
+    assert len(board) == 0
+
+def test_top_and_rank_by_score():
+    board = Leaderboard(15)
+    # Пользователь 3: 100 TRF и 2.5 часа дохода - 130 накоплено, счёт 137.5
+    board.load([user(1, 100), user(2, 300), user(3, 100, hours_ago=2.5), user(4, 100)])
+    top = board.top(10, NOW)
+    assert [row[0] for row in top] == [2, 3, 1, 4]
+    assert [row[3] for row in top] == [300, 130, 100, 100]
+    assert board.top(2, NOW) == top[:2]
+    assert board.rank(2) == (1, 4)
+    assert board.rank(3) == (2, 4)
+    # Равный счёт - равное место
+    assert board.rank(1) == board.rank(4) == (3, 4)
+
+def test_update_moves_user():
+    board = Leaderboard(15)
+    board.load([user(1, 100), user(2, 200)])
+    board.update(dict(zip(('user_id', 'username', 'first_name', 'trf', 'kkl', 'last_passive_income'),
+                          user(1, 500))))
+    assert board.rank(1) == (1, 2)
+    assert board.rank(2) == (2, 2)
+
+def test_changes_during_load_are_kept():
+    board = Leaderboard(15)
+    board.load([user(1, 100)])
+
+    def rows():
+        # Пока строится новая таблица, процесс меняет пользователей
+        yield user(1, 100)
+        yield user(2, 200)
+        board.update(dict(zip(('user_id', 'username', 'first_name', 'trf', 'kkl', 'last_passive_income'),
+                              user(1, 900))))
+        board.remove(2)
+
+    board.load(rows())
+    assert len(board) == 1
+    assert board.top(10, NOW)[0][3] == 900
@@ -0,0 +1,168 @@
+"""
+Планы всех запросов, которые выполняет Database.
+
+Каждый публичный метод вызывается на небольшой базе, текст запросов
+(с подставленными значениями) собирается trace-колбэком соединений,
+и для каждого снимается EXPLAIN QUERY PLAN. Полный просмотр таблицы
+допустим только в методах из FULL_SCAN_ALLOWED; новый метод Database
+без вызова в WORKLOAD не пройдёт test_workload_covers_database.
+"""
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import Database
+from sqlprofile import normalize
+
+# Методы, которым нужна вся таблица (загрузка при запуске, статистика,
+# сверка, миграции) - по их запросам полный просмотр ожидаем
+FULL_SCAN_ALLOWED = {
+    'migrate', 'schema_version', 'load_leaderboard', 'verify_leaderboard', 'get_stats',
+    'get_all_users', 'get_all_chats', 'get_passive_income_users', 'get_user_balances',
+    'get_timers', 'get_jobs', 'pay_passive_income',
+    # В jobs по строке на фоновую задачу, снятие аренд - при остановке
+    'release_jobs',
+}
+
+# Методы без собственных запросов к таблицам
+WITHOUT_QUERIES = {
+    'get_connection', 'transaction', 'close', 'init_db', 'set_profiling',
+    'explain_query_plans', 'audit_query_plans', 'changed_elsewhere', 'reset_daily_limits',
+}
+
+# (метод, аргументы) - вызываются по порядку
+WORKLOAD = [
+    ('create_user', (1, 'one', 'One')),
+    ('create_user', (2, 'two', 'Two')),
+    ('get_user', (1,)),
+    ('get_user_full', (1,)),
+    ('accrue_passive_income', (1,)),
+    ('update_user', (1,), {'health': 90}),
+    ('add_balance', (1,), {'trf': 10, 'kkl': 1}),
+    ('spend', (1,), {'kkl': 1}),
+    ('increment_user', (1,), {'warnings': 1}),
+    ('take_trf', (1, 5)),
+    ('transfer_trf', (1, 2, 5)),
+    ('add_trf', (2, 1)),
+    ('add_kkl', (2, 1)),
+    ('get_chat', (-10,)),
+    ('update_chat', (-10,), {'ph_level': 6.0}),
+    ('add_chat_members', (-10, [1, 2])),
+    ('get_chat_members', (-10,)),
+    ('get_chat_member_balances', (-10,)),
+    ('damage_chat_members', (-10, 1)),
+    ('remove_chat_member', (-10, 2)),
+    ('add_court_case', (1, 2, 'selezenka', 'Виновен', 10, 'Штраф')),
+    ('add_court_hearing', ('selezenka', 1, 2, -10, 3)),
+    ('set_court_hearing_message', (1, 100)),
+    ('take_court_hearing', (1,)),
+    ('get_user_court_cases', (1,)),
+    ('log_mining', (1, 'kopat', 5)),
+    ('get_user_mining_history', (1,)),
+    ('update_user', (2,), {'is_banned': True,
+                           'banned_until': (datetime.now() - timedelta(hours=1)).isoformat()}),
+    ('get_active_bans', ()),
+    ('unban_expired', ()),
+    ('unban_expired', ([2],)),
+    ('load_bans', ()),
+    ('sweep_bans', ()),
+    ('get_top_users', (10,)),
+    ('load_leaderboard', ()),
+    ('get_user_rank', (1,)),
+    ('verify_leaderboard', ()),
+    ('get_all_users', ()),
+    ('get_passive_income_users', ()),
+    ('pay_passive_income', ()),
+    ('get_user_balances', ()),
+    ('start_turtle_invasion', (-10, 3, 600)),
+    ('get_turtle_invasion', (-10,), {'cached': False}),
+    ('join_turtle_defense', (-10, 1)),
+    ('end_turtle_invasion', (-10,)),
+    ('expire_turtle_invasions', ()),
+    ('claim_due_chats', (50,), {'shard': (0, 2)}),
+    ('register_job', ('dangers', 30)),
+    ('claim_due_jobs', (['dangers'], 'test', 60)),
+    ('finish_job', ('dangers', 'test', time.time(), 0.1)),
+    ('release_jobs', ('test',)),
+    ('next_job_run', (['dangers'],)),
+    ('get_jobs', ()),
+    ('set_timer', ('co2_expire', -10, time.time())),
+    ('get_timers', ()),
+    ('claim_timers', ([('co2_expire', -10, time.time())], time.time() + 60)),
+    ('release_timers', ([('co2_expire', -10)], time.time() + 60)),
+    ('cancel_timer', ('co2_expire', -10)),
+    ('clear_chat_flag', ([-10], 'co2_active')),
+    ('get_all_chats', ()),
+    ('get_stats', ()),
+    ('schema_version', ()),
+    ('migrate', ()),
+]
+
+_FULL_SCAN = re.compile(r'^SCAN \w+( AS \w+)?$')
+_PLANNED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+def _public_methods():
+    return {name for name, attr in vars(Database).items()
+            if callable(attr) and not name.startswith('_')}
+
+class TracedDatabase(Database):
+    """Database, соединения которой записывают выполненные запросы с методом-источником"""
+    def __init__(self, *args, **kwargs):
+        self.statements = []
+        self._codes = {attr.__code__: name for name, attr in vars(Database).items()
+                       if callable(attr) and not name.startswith('_') and hasattr(attr, '__code__')}
+        super().__init__(*args, **kwargs)
+
+    def _connect(self, readonly):
+        conn = super()._connect(readonly)
+        conn.set_trace_callback(self._trace)
+        return conn
+
+    def _trace(self, sql):
+        # Ближайший публичный метод Database в стеке
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code not in self._codes:
+            frame = frame.f_back
+        self.statements.append((self._codes[frame.f_code] if frame else None, sql))
+
+@pytest.fixture(scope='module')
+def traced(tmp_path_factory):
+    # Без кэша пользователей - иначе get_user не доходит до базы
+    db = TracedDatabase(str(tmp_path_factory.mktemp('plans') / 'bot.db'), user_cache_size=0)
+    try:
+        for method, args, *kwargs in WORKLOAD:
+            getattr(db, method)(*args, **(kwargs[0] if kwargs else {}))
+        yield db
+    finally:
+        db.close()
+
+def test_workload_covers_database():
+    called = {method for method, *_ in WORKLOAD}
+    assert _public_methods() - called - WITHOUT_QUERIES == set()
+
+def test_no_unexpected_full_scans(traced):
+    plans = {}
+    conn = sqlite3.connect(traced.db_path)
+    try:
+        for method, sql in traced.statements:
+            if not sql.lstrip().upper().startswith(_PLANNED):
+                continue
+            key = (method, normalize(sql))
+            if key in plans:
+                continue
+            plans[key] = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+    finally:
+        conn.close()
+
+    methods = {method for method, _ in plans}
+    assert _public_methods() - WITHOUT_QUERIES - methods <= {
+        # Запросы выполняют вызванные ими методы
+        'get_user_full', 'get_user_rank', 'load_bans', 'sweep_bans', 'add_trf', 'add_kkl', 'transfer_trf',
+    }
+    scans = {key: plan for key, plan in plans.items()
+             if key[0] not in FULL_SCAN_ALLOWED and any(_FULL_SCAN.match(step) for step in plan)}
+    assert scans == {}
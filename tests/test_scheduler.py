@@ -0,0 +1,38 @@
+import asyncio
+import sqlite3
+
+from database import AsyncDatabase, Database
+from scheduler import Scheduler
+
+def test_database_error_does_not_stop_scheduler(tmp_path):
+    runs = []
+
+    async def job():
+        runs.append(1)
+
+    async def run():
+        db = AsyncDatabase(Database(str(tmp_path / 'bot.db')))
+        next_job_run = db.next_job_run
+        calls = []
+
+        async def locked(names):
+            # Первый расчёт сна падает, как при занятой базе
+            calls.append(names)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return await next_job_run(names)
+
+        db.next_job_run = locked
+        scheduler = Scheduler(db, poll_interval=0.05)
+        try:
+            await scheduler.add_job('job', job, interval=60)
+            scheduler.start()
+            await asyncio.sleep(0.3)
+        finally:
+            await scheduler.stop()
+            db.close()
+        return calls
+
+    # Цикл пережил ошибку и продолжил опрашивать расписание
+    assert len(asyncio.run(run())) >= 2
+    assert runs == [1]
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+from database import AsyncDatabase, Database
+from timers import TimerService
+
+def run_service(tmp_path, handler, seconds):
+    async def run():
+        db = AsyncDatabase(Database(str(tmp_path / 'bot.db')))
+        service = await TimerService(db, {'court_hearing': handler}, resolution=0.01,
+                                     retry_delay=0.05, retry_max_delay=0.2).start()
+        try:
+            await service.schedule('court_hearing', 1, delay=0)
+            await asyncio.sleep(seconds)
+            return service.stats(), await db.get_timers()
+        finally:
+            await service.stop()
+            db.close()
+    return asyncio.run(run())
+
+def test_failed_timer_is_retried(tmp_path):
+    calls = []
+
+    async def handler(items):
+        calls.append(time.monotonic())
+        if len(calls) < 3:
+            raise RuntimeError('database is locked')
+
+    stats, stored = run_service(tmp_path, handler, 0.5)
+    assert len(calls) == 3
+    # Паузы растут: 0.05, затем 0.1
+    assert calls[2] - calls[1] > calls[1] - calls[0]
+    assert stats['fired'] == 1 and stats['failed'] == 2 and stats['retrying'] == 0
+    assert stored == []
+
+def test_failing_timer_stays_in_database(tmp_path):
+    async def handler(items):
+        raise RuntimeError('database is locked')
+
+    stats, stored = run_service(tmp_path, handler, 0.3)
+    assert stats['fired'] == 0 and stats['retrying'] == 1
+    # После перезапуска таймер сработает снова
+    assert [(kind, key) for kind, key, _, _ in stored] == [('court_hearing', 1)]
+
+def test_timers_loaded_by_shard(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    far = time.time() + 3600
+    db.set_timer('turtle_damage', -5, far)
+    db.set_timer('turtle_damage', -4, far)
+    # Заседание 7 в чате -4 - в процессе чата, а не ключа
+    db.set_timer('court_hearing', 7, far, '{"chat_id": -4}')
+    db.close()
+
+    async def load(index):
+        database = AsyncDatabase(Database(str(tmp_path / 'bot.db')))
+        service = await TimerService(database, shard=(index, 2)).start()
+        await service.stop()
+        database.close()
+        return sorted(service._pending)
+
+    assert asyncio.run(load(0)) == [('court_hearing', 7), ('turtle_damage', -4)]
+    assert asyncio.run(load(1)) == [('turtle_damage', -5)]
+
+def test_tracked_timer_fires_from_existing_row(tmp_path):
+    # Запись сделана в транзакции события (как _open_hearing), служба только следит за сроком
+    fired = []
+
+    async def handler(items):
+        fired.extend(items)
+
+    async def run():
+        db = AsyncDatabase(Database(str(tmp_path / 'bot.db')))
+        service = await TimerService(db, {'court_hearing': handler}, resolution=0.01).start()
+        try:
+            at = time.time() + 0.05
+            await db.set_timer('court_hearing', 3, at, '{"chat_id": -1}')
+            service.track('court_hearing', 3, at, {'chat_id': -1})
+            await asyncio.sleep(0.3)
+            return await db.get_timers()
+        finally:
+            await service.stop()
+            db.close()
+
+    assert asyncio.run(run()) == []
+    assert fired == [(3, {'chat_id': -1})]
@@ -0,0 +1,245 @@
+"""
+Отложенные события игры: урон черепашек, окончание CO₂, снятие бана.
+
+Вместо отдельной спящей корутины на каждое событие - одна служба с
+min-кучей сроков. Таймеры пишутся в таблицу timers и загружаются при
+запуске, поэтому переживают перезапуск. Служба просыпается на границах
+шага resolution и передаёт все таймеры одного вида, сработавшие за шаг,
+обработчику одним пакетом. Раньше срока таймер не срабатывает, позже -
+не больше чем на resolution.
+
+Запись таймера удаляется только после успешного обработчика. Если он
+упал, весь пакет повторяется с растущей паузой, поэтому обработчики
+должны выдерживать повтор (заседание снимается take_court_hearing в той
+же транзакции, что и вердикт; снятие флагов и банов повторяемо).
+"""
+import asyncio
+import heapq
+import json
+import logging
+import math
+import time
+from collections import defaultdict
+
+from config import (
+    TIMER_BATCH_SIZE, TIMER_RESOLUTION, TIMER_LEASE, TIMER_RETRY_DELAY, TIMER_RETRY_MAX_DELAY
+)
+
+logger = logging.getLogger(__name__)
+
+def timer_chat(key, payload):
+    """Чат, к которому относится таймер (по нему таймеры делятся между процессами)"""
+    if isinstance(payload, dict) and 'chat_id' in payload:
+        return payload['chat_id']
+    return key
+
+class TimerService:
+    """
+    Таймер определяется видом (kind) и ключом (chat_id или user_id):
+    повторный schedule() того же таймера переносит его. Обработчик вида -
+    корутина, принимающая список [(key, payload)] сработавших таймеров.
+
+    Записи кучи не удаляются при переносе и отмене: устаревшие
+    пропускаются при извлечении (сравнивается срок в _pending).
+
+    При нескольких процессах (shards.py) shard - (номер, всего): из базы
+    загружаются только таймеры чатов этого процесса, чтобы сообщения чата
+    уходили из того же процесса, что и ответы на его команды (лимиты
+    Telegram на чат считает очередь процесса). Чат таймера - payload
+    ['chat_id'], без него - сам ключ.
+    """
+    def __init__(self, db, handlers=None, batch_size=TIMER_BATCH_SIZE, resolution=TIMER_RESOLUTION,
+                 lease=TIMER_LEASE, retry_delay=TIMER_RETRY_DELAY, retry_max_delay=TIMER_RETRY_MAX_DELAY,
+                 shard=(0, 1)):
+        self.db = db
+        self.shard = shard
+        self.batch_size = batch_size
+        self.resolution = resolution
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self._handlers = dict(handlers or {})
+        # (kind, key) -> (fire_at, payload)
+        self._pending = {}
+        self._heap = []
+        # (kind, key) -> неудачных попыток подряд
+        self._attempts = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.fired = 0
+        self.failed = 0
+        self.retried = 0
+
+    def on(self, kind, callback):
+        self._handlers[kind] = callback
+
+    async def start(self):
+        """Загрузка отложенных таймеров из базы и запуск"""
+        index, count = self.shard
+        for kind, key, fire_at, payload in await self.db.get_timers():
+            payload = json.loads(payload) if payload else None
+            if timer_chat(key, payload) % count == index:
+                self._push(kind, key, fire_at, payload)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        # Несработавшие таймеры остаются в базе до следующего запуска
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {'pending': len(self._pending), 'fired': self.fired, 'failed': self.failed,
+                'retried': self.retried, 'retrying': len(self._attempts)}
+
+    async def schedule(self, kind, key, delay=None, at=None, payload=None):
+        """Таймер через delay секунд или на unix-время at"""
+        fire_at = float(at if at is not None else time.time() + delay)
+        self._attempts.pop((kind, key), None)
+        await self.db.set_timer(kind, key, fire_at,
+                                json.dumps(payload) if payload is not None else None)
+        self._push(kind, key, fire_at, payload)
+
+    def track(self, kind, key, at, payload=None):
+        """
+        Таймер, уже записанный в базу (set_timer в транзакции вместе с
+        событием игры): только в кучу, без повторной записи. at должен
+        совпадать со сроком в базе - по нему таймер захватывается
+        """
+        self._attempts.pop((kind, key), None)
+        self._push(kind, key, float(at), payload)
+
+    async def cancel(self, kind, key):
+        self._pending.pop((kind, key), None)
+        self._attempts.pop((kind, key), None)
+        await self.db.cancel_timer(kind, key)
+
+    def _push(self, kind, key, fire_at, payload):
+        self._pending[(kind, key)] = (fire_at, payload)
+        heapq.heappush(self._heap, (fire_at, kind, key))
+        if self._heap[0][0] == fire_at:
+            self._wakeup.set()
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            fire_at, kind, key = heapq.heappop(self._heap)
+            pending = self._pending.get((kind, key))
+            if pending is not None and pending[0] == fire_at:
+                due.append((kind, key, fire_at, pending[1]))
+        return due
+
+    async def _run(self):
+        while True:
+            try:
+                due = self._pop_due(time.time())
+                if due:
+                    await self._fire(due)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка службы таймеров")
+                await asyncio.sleep(1)
+                continue
+
+            self._wakeup.clear()
+            delay = None
+            if self._heap:
+                wake_at = math.ceil(self._heap[0][0] / self.resolution) * self.resolution
+                delay = max(0.0, wake_at - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, due):
+        # Таймер срабатывает, только если его захватил этот вызов
+        lease_until = time.time() + self.lease
+        try:
+            claimed = set(await self.db.claim_timers([(kind, key, fire_at) for kind, key, fire_at, _ in due],
+                                                     lease_until))
+        except Exception:
+            # База занята - таймеры возвращаются в кучу, _run повторит через секунду
+            for kind, key, fire_at, payload in due:
+                if self._pending.get((kind, key), (None,))[0] == fire_at:
+                    heapq.heappush(self._heap, (fire_at, kind, key))
+            raise
+        batches = defaultdict(list)
+        for kind, key, fire_at, payload in due:
+            # За время запроса таймер могли перенести - тогда он остаётся
+            if self._pending.get((kind, key), (None,))[0] == fire_at:
+                del self._pending[(kind, key)]
+            if (kind, key) in claimed:
+                batches[kind].append((key, payload))
+
+        for kind, items in batches.items():
+            handler = self._handlers.get(kind)
+            keys = [(kind, key) for key, _ in items]
+            if handler is None:
+                # Запись остаётся в базе - сработает, когда обработчик появится
+                logger.warning("Нет обработчика таймеров %s, пропущено: %d", kind, len(items))
+                continue
+            try:
+                await handler(items)
+            except Exception:
+                self.failed += len(items)
+                logger.exception("Обработчик таймеров %s завершился с ошибкой", kind)
+                await self._retry(kind, items, lease_until)
+            else:
+                self.fired += len(items)
+                for timer in keys:
+                    self._attempts.pop(timer, None)
+                await self.db.release_timers(keys, lease_until)
+
+    async def _retry(self, kind, items, lease_until):
+        """Повтор упавшего пакета: пауза удваивается с каждой неудачей подряд"""
+        attempts = max(self._attempts.get((kind, key), 0) for key, _ in items) + 1
+        retry_at = time.time() + min(self.retry_max_delay, self.retry_delay * 2 ** (attempts - 1))
+        try:
+            await self.db.release_timers([(kind, key) for key, _ in items], lease_until, retry_at)
+        except Exception:
+            # Срок в базе остался lease_until - по нему и повторяем
+            logger.exception("Не удалось перенести таймеры %s", kind)
+            retry_at = lease_until
+        for key, payload in items:
+            # Таймер, назначенный заново во время обработчика, не откатывается
+            if (kind, key) not in self._pending:
+                self._attempts[(kind, key)] = attempts
+                self._push(kind, key, retry_at, payload)
+        self.retried += len(items)
+        logger.warning("Таймеры %s: повтор %d через %.0f с (%d шт.)",
+                       kind, attempts, retry_at - time.time(), len(items))
+
+# Общая служба процесса - создаётся при запуске бота
+service = None
+
+async def start(db, handlers, **kwargs):
+    global service
+    service = await TimerService(db, handlers, **kwargs).start()
+    return service
+
+async def stop():
+    global service
+    if service is not None:
+        await service.stop()
+        service = None
+
+async def schedule(kind, key, delay=None, at=None, payload=None):
+    if service is None:
+        raise RuntimeError("Служба таймеров не запущена")
+    await service.schedule(kind, key, delay=delay, at=at, payload=payload)
+
+def track(kind, key, at, payload=None):
+    if service is None:
+        raise RuntimeError("Служба таймеров не запущена")
+    service.track(kind, key, at, payload=payload)
+
+async def cancel(kind, key):
+    if service is None:
+        raise RuntimeError("Служба таймеров не запущена")
+    await service.cancel(kind, key)
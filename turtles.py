@@ -0,0 +1,55 @@
+"""
+Нашествия черепашек: кэш процесса поверх таблицы turtle_invasions.
+"""
+import threading
+from array import array
+
+# Участники защиты хранятся упакованным массивом 64-битных user_id
+def pack_ids(user_ids):
+    return array('q', user_ids).tobytes()
+
+def unpack_ids(blob):
+    ids = array('q')
+    if blob:
+        ids.frombytes(blob)
+    return ids.tolist()
+
+class TurtleInvasions:
+    """
+    Активные нашествия по chat_id: {'chat_id', 'count', 'started',
+    'expires_at', 'participants'}, участники - множество user_id.
+
+    Кэш пополняется записью после изменения в базе (write-through),
+    поэтому проверка участника - поиск в множестве. База остаётся главной:
+    вступление в защиту всегда проверяется транзакцией, так что устаревшая
+    запись после действий другого процесса ни на что не влияет.
+    """
+    def __init__(self):
+        self._invasions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._invasions)
+
+    @staticmethod
+    def from_row(row):
+        invasion = dict(row)
+        invasion['participants'] = set(unpack_ids(invasion['participants']))
+        return invasion
+
+    def get(self, chat_id, now):
+        """Нашествие в чате или None; истёкшее удаляется"""
+        with self._lock:
+            invasion = self._invasions.get(chat_id)
+            if invasion is not None and invasion['expires_at'] <= now:
+                del self._invasions[chat_id]
+                return None
+            return invasion
+
+    def put(self, invasion):
+        with self._lock:
+            self._invasions[invasion['chat_id']] = invasion
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._invasions.pop(chat_id, None)
@@ -1,5 +1,5 @@
 import random
-from datetime import datetime, timedelta
+from datetime import datetime
 
 # Импортируем из config
 try:
@@ -134,6 +134,33 @@ def escape_html(text):
             .replace('>', '&gt;')
             .replace('"', '&quot;'))
 
+def _telegram_length(text):
+    """Длина текста так, как её считает Telegram (в единицах UTF-16)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def split_message(lines, header="", footer="", limit=4096):
+    """
+    Разбиение отчёта из строк на сообщения не длиннее limit.
+    Строки не разрываются, header - в начале первого сообщения,
+    footer - в конце последнего.
+    """
+    messages = []
+    current, size = header, _telegram_length(header)
+    for line in lines:
+        line += "\n"
+        line_size = _telegram_length(line)
+        if current and size + line_size > limit:
+            messages.append(current)
+            current, size = "", 0
+        current += line
+        size += line_size
+    
+    if current and size + _telegram_length(footer) > limit:
+        messages.append(current)
+        current = ""
+    messages.append(current + footer)
+    return messages
+
 def get_random_emoji():
     """Получение случайного эмодзи для оформления"""
     emojis = ["🧪", "🪙", "🥬", "⚖️", "⚠️", "🔬", "🌿", "🍄", "💧", "🔥", "🌡️", "💨"]
@@ -0,0 +1,232 @@
+"""
+Приём апдейтов через вебхук: встроенный асинхронный HTTP-сервер.
+
+Telegram присылает каждый апдейт POST-запросом сразу, без задержки
+long polling. Сервер проверяет секретный токен (заголовок
+X-Telegram-Bot-Api-Secret-Token), разбирает тело прямо в Update и
+отдаёт его приложению. Если необработанных апдейтов слишком много,
+отвечает 503 - Telegram повторит доставку позже.
+
+Проверка без Telegram: WEBHOOK_URL=http://127.0.0.1:8443/webhook и
+WEBHOOK_SECRET=test (для http-адреса вебхук в Telegram не регистрируется),
+затем записанный апдейт:
+
+    curl -X POST http://127.0.0.1:8443/webhook \\
+         -H 'X-Telegram-Bot-Api-Secret-Token: test' -d @update.json
+"""
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+import signal
+import ssl
+from urllib.parse import urlparse
+
+from telegram import Update
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_CERT, WEBHOOK_KEY,
+    WEBHOOK_MAX_PENDING, WEBHOOK_MAX_BODY, WEBHOOK_MAX_CONNECTIONS
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+_REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+    503: 'Service Unavailable'
+}
+
+class WebhookServer:
+    """
+    HTTP/1.1 с keep-alive, только то, что нужно Telegram: POST с
+    Content-Length на один путь. Апдейт обрабатывается так же, как при
+    long polling (через update_processor приложения), но число принятых
+    и ещё не обработанных ограничено max_pending.
+    """
+    def __init__(self, application, path, secret, max_pending=WEBHOOK_MAX_PENDING,
+                 max_body=WEBHOOK_MAX_BODY, idle_timeout=60.0):
+        self.application = application
+        self.path = path
+        self._secret = secret.encode()
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self.idle_timeout = idle_timeout
+        self._server = None
+        self._tasks = set()
+
+        self.received = 0
+        self.rejected = 0
+        self.invalid = 0
+
+    @property
+    def pending(self):
+        return len(self._tasks)
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'received': self.received,
+            'rejected': self.rejected,
+            'invalid': self.invalid
+        }
+
+    async def start(self, host, port, ssl_context=None):
+        self._server = await asyncio.start_server(self._serve, host, port, ssl=ssl_context)
+        logger.info("Вебхук слушает %s:%s%s", host, port, self.path)
+        return self
+
+    async def stop(self, timeout=10.0):
+        """Новые запросы не принимаются, принятые апдейты дообрабатываются до timeout"""
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._tasks:
+            _, unfinished = await asyncio.wait(list(self._tasks), timeout=timeout)
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                logger.warning("Не дождались обработки апдейтов: %d", len(unfinished))
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if 'content-length' not in headers and method == 'POST':
+                    # Chunked и тела без длины Telegram не присылает
+                    await self._respond(writer, 411, keep_alive=False)
+                    break
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    await self._respond(writer, 413, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                status = self._accept(method, target, headers, body)
+                await self._respond(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _accept(self, method, target, headers, body):
+        """Проверка запроса и постановка апдейта в обработку; HTTP-статус ответа"""
+        if urlparse(target).path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(), self._secret):
+            self.invalid += 1
+            return 403
+        if self.pending >= self.max_pending:
+            # Обработка не успевает - Telegram повторит доставку позже
+            self.rejected += 1
+            return 503
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            self.invalid += 1
+            return 400
+        if update is None:
+            self.invalid += 1
+            return 400
+
+        self.received += 1
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return 200
+
+    async def _process(self, update):
+        application = self.application
+        try:
+            await application.update_processor.process_update(update, application.process_update(update))
+        except Exception:
+            logger.exception("Ошибка обработки апдейта %s", update.update_id)
+
+    @staticmethod
+    async def _respond(writer, status, keep_alive=True):
+        head = [f'HTTP/1.1 {status} {_REASONS[status]}', 'Content-Length: 0']
+        if status == 503:
+            head.append('Retry-After: 1')
+        head.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+# Сервер процесса, если бот запущен в режиме вебхука
+server = None
+
+async def run(application, url=WEBHOOK_URL, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+              secret=WEBHOOK_SECRET):
+    """
+    Запуск бота на вебхуке до SIGINT/SIGTERM - замена application.run_polling()
+    с тем же порядком post_init/post_shutdown
+    """
+    global server
+    # Без заданного секрета - случайный: вебхук всё равно регистрируется заново
+    secret = secret or secrets.token_urlsafe(32)
+    ssl_context = None
+    if WEBHOOK_CERT:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        server = await WebhookServer(application, urlparse(url).path or '/', secret).start(
+            listen, port, ssl_context
+        )
+        if urlparse(url).scheme == 'https':
+            # Самоподписанный сертификат - содержимым: файл не остаётся открытым
+            certificate = None
+            if WEBHOOK_CERT:
+                with open(WEBHOOK_CERT, 'rb') as cert:
+                    certificate = cert.read()
+            await application.bot.set_webhook(
+                url, secret_token=secret, allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS, certificate=certificate
+            )
+        else:
+            # Telegram принимает только https - локальная проверка записанными апдейтами
+            logger.warning("Вебхук %s не зарегистрирован в Telegram (не https)", url)
+        await stop.wait()
+    finally:
+        # Вебхук в Telegram не удаляется: апдейты дождутся следующего запуска
+        if server:
+            await server.stop()
+            server = None
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)